@@ -0,0 +1,62 @@
+"""
+Ingestion write paths benchmark: rows/second of the 'orm' and 'bulk' INGEST_MODE
+
+    python benchmarks/bench_ingest.py --uri sqlite:////tmp/pamose_bench.db --entities 200 --metrics 20
+
+The database is dropped and re-created, don't point it to a production one.
+"""
+import time
+
+import click
+
+from pamose import models, commands
+from pamose.app import create_app
+from pamose.caches import references
+from pamose.ingest import write_livestates
+
+
+def make_items(entities, livestates, metrics, timestamp):
+    perf_data = ' '.join('metric{0}={1}'.format(i, i * 1.5) for i in range(metrics))
+    items = []
+    for rec_entity in entities:
+        items.append((rec_entity, [
+            {'timestamp': timestamp + i, 'state': 'OK', 'output': 'Benchmark output', 'perf_data': perf_data}
+            for i in range(livestates)
+        ]))
+    return items
+
+
+@click.command()
+@click.option('--uri', default='sqlite:////tmp/pamose_bench.db', help='Database URI')
+@click.option('--entities', default=200, help='Number of services per batch')
+@click.option('--livestates', default=1, help='Livestates per service')
+@click.option('--metrics', default=20, help='Metrics per livestate')
+@click.option('--batches', default=5, help='Number of committed batches per mode')
+def main(uri, entities, livestates, metrics, batches):
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        models.db.drop_all()
+        app.test_cli_runner().invoke(commands.initdb)
+        references.invalidate()
+
+        rec_entities = [models.Entity(name='bench||service{0}'.format(i), parent_entity_id=0,
+                                      entity_type_id=references.get(models.EntityType, 'service'))
+                        for i in range(entities)]
+        models.db.session.add_all(rec_entities)
+        models.db.session.commit()
+
+        rows = entities * livestates * (1 + metrics) * batches
+        timestamp = 1500000000
+        for mode in ('orm', 'bulk'):
+            app.config['INGEST_MODE'] = mode
+            start = time.perf_counter()
+            for _ in range(batches):
+                write_livestates(make_items(rec_entities, livestates, metrics, timestamp))
+                models.db.session.commit()
+                timestamp += livestates
+            elapsed = time.perf_counter() - start
+            click.echo('{0:>5}: {1} rows in {2:.3f}s, {3:,.0f} rows/s'.format(mode, rows, elapsed, rows / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+"""
+Perf data parser micro-benchmark: parse throughput of a typical 50 metrics perf_data string
+
+    python benchmarks/bench_perfdata.py --metrics 50 --repeat 20000
+"""
+import timeit
+
+import click
+
+from pamose import perfdata
+
+
+def make_perf_data(metrics):
+    templates = ["'disk {0} used'=45.5%;80;90;0;100", "rta{0}=0.123ms;100;500;0", "load{0}=1.5;5;10;0",
+                 "'mem {0}'=1024KB;;;0;4096", "packets{0}=123456c"]
+    return ' '.join(templates[i % len(templates)].format(i) for i in range(metrics))
+
+
+@click.command()
+@click.option('--metrics', default=50, help='Metrics per perf_data string')
+@click.option('--repeat', default=20000, help='Number of strings parsed')
+def main(metrics, repeat):
+    raw = make_perf_data(metrics)
+    assert len(perfdata.parse(raw)) == metrics
+    elapsed = min(timeit.repeat(lambda: perfdata.parse(raw), number=repeat, repeat=3))
+    total = metrics * repeat
+    click.echo('{0:,} metrics in {1:.3f}s: {2:,.0f} metrics/s, {3:.3f}s per million metrics'.format(
+        total, elapsed, total / elapsed, elapsed * 1e6 / total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Read path serialization benchmark: marshmallow ModelSchema over ORM instances vs Core rows serialized by
+the serializers module (records and columns), on the same metric rows
+
+    python benchmarks/bench_serialization.py --uri sqlite:////tmp/pamose_bench.db --rows 100000
+
+The database is dropped and re-created, don't point it to a production one.
+"""
+import json
+import time
+import datetime as dt
+
+import click
+
+from pamose import models, commands, serializers
+from pamose.app import create_app
+from pamose.schemas import MetricSchema
+
+
+def timed(label, function, rows):
+    start = time.perf_counter()
+    size = len(function())
+    elapsed = time.perf_counter() - start
+    click.echo('{0:>28}: {1:.3f}s, {2:,.0f} rows/s, {3:,} bytes'.format(label, elapsed, rows / elapsed, size))
+    return elapsed
+
+
+@click.command()
+@click.option('--uri', default='sqlite:////tmp/pamose_bench.db', help='Database URI')
+@click.option('--rows', default=100000, help='Number of metric rows')
+def main(uri, rows):
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        models.db.drop_all()
+        app.test_cli_runner().invoke(commands.initdb)
+        livestate = models.db.engine.execute(models.Livestate.__table__.insert(), entity_id=0, state_id=0,
+                                             timestamp=dt.datetime(2017, 7, 14)).inserted_primary_key[0]
+        start = dt.datetime(2017, 7, 14)
+        models.db.engine.execute(models.Metric.__table__.insert(), [
+            {'timestamp': start + dt.timedelta(seconds=i), 'name': 'metric{0}'.format(i % 10), 'value': i * 0.5,
+             'livestate_id': livestate, 'metric_type_id': 0} for i in range(rows)])
+
+        metric = models.Metric.__table__
+        query = models.db.select([metric.c.timestamp, metric.c.name, metric.c.value]).order_by(metric.c.id)
+        click.echo('{0} backend, {1:,} rows'.format('orjson' if serializers.orjson else 'json', rows))
+
+        def schema():
+            result = MetricSchema(many=True).dump(models.Metric.query.order_by(models.Metric.id).all())
+            models.db.session.remove()
+            return json.dumps(result)
+
+        def records():
+            return serializers.dumps(serializers.records(models.db.session.execute(query)))
+
+        def columns():
+            return serializers.dumps(serializers.columns(models.db.session.execute(query),
+                                                         keys=('timestamps', 'names', 'values')))
+
+        reference = timed('marshmallow ModelSchema', schema, rows)
+        for label, function in (('Core rows, records', records), ('Core rows, columns', columns)):
+            elapsed = timed(label, function, rows)
+            click.echo('{0:>28}  x{1:.1f}'.format('', reference / elapsed))
+
+
+if __name__ == '__main__':
+    main()
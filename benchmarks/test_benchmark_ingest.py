@@ -0,0 +1,42 @@
+"""
+pytest-benchmark suite of the PATCH /host ingest path
+
+    pytest benchmarks --benchmark-autosave
+    pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:10%
+
+PAMOSE_BENCH_URI selects the database (dropped and re-created), default to a SQLite file.
+"""
+import os
+import time
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from loadgen import InProcessTarget, make_payload, payload_rows  # noqa: E402
+
+URI = os.environ.get('PAMOSE_BENCH_URI', 'sqlite:////tmp/pamose_bench.db')
+HOSTS = 20
+
+
+@pytest.fixture(scope='module', params=['orm', 'bulk'])
+def target(request):
+    target = InProcessTarget(URI, config={'INGEST_MODE': request.param})
+    for host in range(HOSTS):  # Entities creation isn't measured
+        target.patch(make_payload(host, 50, 10, time.time()))
+    yield target
+    target.close()
+
+
+@pytest.mark.parametrize('services,metrics', [(10, 10), (50, 20)])
+def test_patch_host(benchmark, target, services, metrics):
+    counter = iter(range(10 ** 9))
+
+    def setup():
+        i = next(counter)
+        return (make_payload(i % HOSTS, services, metrics, time.time() + i),), {}
+
+    target.queries = 0
+    benchmark.pedantic(target.patch, setup=setup, rounds=50)
+    benchmark.extra_info['rows'] = payload_rows(services, metrics)
+    benchmark.extra_info['queries_per_request'] = target.queries / 50.0
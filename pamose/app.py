@@ -8,9 +8,19 @@ from .default_settings import Config
 from .models import db
 from .schemas import ma
 from .ressources import api
+from .caches import references
+from .writebehind import ingest_queue
+from .tokens import tokens
+from .passwords import passwords
+from .entityconfig import entity_configs
+from .pool import pool
+from .events import events
+from .idempotency import idempotency
 from . import commands
 
 from .loggers import register as register_loggers
+from .instrumentation import register as register_instrumentation
+from .exporter import register as register_exporter
 from .errorhandlers import register as register_errorhandlers
 from .shellcontexts import register as register_shellcontexts
 
@@ -38,6 +48,10 @@ def create_app(config=None):
 
     register_loggers(app)
 
+    register_instrumentation(app)
+
+    register_exporter(app)
+
     register_extensions(app=app)
 
     # register_errorhandlers(app)
@@ -49,10 +63,32 @@ def create_app(config=None):
 def register_extensions(app):
     app.logger.debug("Registering database...")
     db.init_app(app=app)
+    pool.init_app(app=app)
 
     app.logger.debug("Registering schemas...")
     ma.init_app(app=app)
 
+    app.logger.debug("Loading reference tables...")
+    references.init_app(app=app)
+
+    app.logger.debug("Registering tokens...")
+    tokens.init_app(app=app)
+
+    app.logger.debug("Registering passwords...")
+    passwords.init_app(app=app)
+
+    app.logger.debug("Registering entity configurations store...")
+    entity_configs.init_app(app=app)
+
+    app.logger.debug("Registering ingest queue...")
+    ingest_queue.init_app(app=app)
+
+    app.logger.debug("Registering events...")
+    events.init_app(app=app)
+
+    app.logger.debug("Registering idempotency keys cache...")
+    idempotency.init_app(app=app)
+
     app.logger.debug("Registering ressources...")
     api(app)
 
@@ -60,4 +96,9 @@ def register_extensions(app):
 def register_commands(app):
     """Register Click commands."""
     app.cli.add_command(commands.initdb)
+    app.cli.add_command(commands.retention)
+    app.cli.add_command(commands.rollup)
+    app.cli.add_command(commands.expiry)
+    app.cli.add_command(commands.deduplicate)
+    app.cli.add_command(commands.serve)
     app.cli.add_command(commands.tests)
@@ -0,0 +1,176 @@
+"""
+ASGI entry point of the ingest endpoints
+
+Serves /login, /host and /hosts to an ASGI server (uvicorn, hypercorn, ...), e.g.:
+
+    uvicorn --factory pamose.asgi:create_asgi_app --workers 4
+
+The connections, and the request bodies while they are uploaded, are handled by the event loop: a process
+holds thousands of agents connections without a thread each. A request only takes a thread once its body is
+received, to run the views of the WSGI application (same models, authentication, idempotency and as_json
+answers). SQLAlchemy 1.3 has no asyncio support, so the database work stays synchronous in these threads.
+They are limited to ASGI_THREADS, default to the connections of the pool (DB_POOL_SIZE + DB_MAX_OVERFLOW) so
+they never wait for one. Up to ASGI_MAX_PENDING requests wait for a thread, the next ones get a 503.
+
+The other endpoints are served by the WSGI application (`pamose serve`).
+"""
+
+import io
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .ressources import as_json
+
+PATHS = ('/login', '/host', '/hosts')
+
+
+class AsgiApp(object):
+    """
+    ASGI application running the ingest views of a Flask application in a bounded thread pool
+    """
+
+    def __init__(self, app):
+        """
+        :param app: flask.Flask. An application created by pamose.app.create_app
+        """
+        self.app = app
+        config = app.config
+        threads = config.get('ASGI_THREADS') or config.get('DB_POOL_SIZE', 10) + config.get('DB_MAX_OVERFLOW', 20)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='pamose-asgi')
+        self.max_pending = config.get('ASGI_MAX_PENDING', 10000)
+        self.max_body_size = config.get('ASGI_MAX_BODY_SIZE', 64 * 1024 * 1024)
+        self.pending = 0  # Requests running or waiting for a thread (only changed by the event loop)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_event_loop().run_in_executor(None, self.executor.shutdown)  # Running requests
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        if scope['path'] not in PATHS:
+            await self._send(send, self._answer(404, issues='Not found, only {0} are served here'.format(
+                ', '.join(PATHS))))
+            return
+
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_size:
+                await self._send(send, self._answer(413, issues='Body larger than {0} bytes'.format(
+                    self.max_body_size)))
+                return
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                break
+
+        if self.pending >= self.max_pending:
+            await self._send(send, self._answer(503, {'Retry-After': '1'}, issues='Server busy, retry later'))
+            return
+        self.pending += 1
+        try:
+            answer = await asyncio.get_event_loop().run_in_executor(
+                self.executor, self._call_wsgi, wsgi_environ(scope, b''.join(chunks)))
+        finally:
+            self.pending -= 1
+        await self._send(send, answer)
+
+    def _call_wsgi(self, environ):
+        """
+        Run the WSGI application, in a thread of the pool
+        :return: (int, list of (str, str), bytes). The status code, headers and body
+        """
+        result = {}
+        body = []
+
+        def start_response(status, headers, exc_info=None):
+            result['status'] = int(status.split(' ', 1)[0])
+            result['headers'] = headers
+            return body.append
+
+        iterable = self.app(environ, start_response)
+        try:
+            body.extend(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        return result['status'], result['headers'], b''.join(body)
+
+    def _answer(self, status, headers=None, **kwargs):
+        """
+        An as_json answer made in the event loop
+        :param kwargs: See ressources.as_json
+        """
+        with self.app.app_context():
+            response = self.app.make_response((as_json(**kwargs), status, headers or {}))
+            return response.status_code, response.headers.to_wsgi_list(), response.get_data()
+
+    @staticmethod
+    async def _send(send, answer):
+        status, headers, body = answer
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def wsgi_environ(scope, body):
+    """
+    The WSGI environ of an ASGI HTTP request
+    :param scope: dict. The ASGI connection scope
+    :param body: bytes. The whole request body
+    :return: dict
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('UTF-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('UTF-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{0}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name not in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):  # The body is already whole
+            key = 'HTTP_' + name
+            environ[key] = '{0},{1}'.format(environ[key], value) if key in environ else value
+    return environ
+
+
+def create_asgi_app(config=None):
+    """
+    The ASGI application factory (`uvicorn --factory pamose.asgi:create_asgi_app`)
+    :param config: dict. An optional Flask configuration dictionnary, see pamose.app.create_app
+    :return: AsgiApp
+    """
+    from .app import create_app
+    return AsgiApp(create_app(config=config))
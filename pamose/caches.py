@@ -0,0 +1,169 @@
+"""
+In-process caches
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import models
+
+
+class TTLCache(object):
+    """
+    Thread safe mapping bounded in size (least recently used entries are evicted first)
+    whose entries expire after a time to live
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        """
+        :param maxsize: int. Maximum number of entries
+        :param ttl: float. Default entries time to live (seconds)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expiration monotonic time, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        :param ttl: float. This entry time to live (seconds), default to the cache one
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def discard_where(self, predicate):
+        """
+        Remove all the entries for which predicate(key, value) is true
+        """
+        with self._lock:
+            for key in [key for key, (_, value) in self._data.items() if predicate(key, value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ReferenceCache(object):
+    """
+    name -> id lookup for the reference tables (State, MetricType, EntityType) used by the ingest path.
+
+    The mappings are loaded at application startup from the rows inserted by `initdb` (or on first use if
+    the tables don't exist yet), so the ingest path never queries them. Any insert/update/delete of one of
+    these tables through the ORM, or an explicit call to `invalidate`, drops the cached mapping and the
+    next lookup reloads it.
+    """
+    TABLES = (models.State, models.MetricType, models.EntityType)
+    EXTENSION_KEY = 'pamose_references'
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions[self.EXTENSION_KEY] = {}
+        with app.app_context():
+            try:
+                self.load()
+            except SQLAlchemyError as e:  # Tables not created yet (before initdb), or DB unreachable
+                app.logger.debug("Reference tables not loaded at startup: %s", e)
+                models.db.session.rollback()
+
+    @property
+    def _mappings(self):
+        return current_app.extensions[self.EXTENSION_KEY]
+
+    def load(self, table=None):
+        """
+        (Re)load the name -> id mapping of one or all the reference tables
+        :param table: models.Model. The table to load, default to all
+        """
+        tables = self.TABLES if table is None else (table,)
+        with self._lock:
+            for t in tables:
+                rows = models.db.session.query(t.name, t.id).all()
+                self._mappings[t] = dict(rows)
+
+    def invalidate(self, table=None):
+        """
+        Forget the cached mapping of one or all the reference tables. It will be reloaded on next lookup
+        :param table: models.Model. The table to invalidate, default to all
+        """
+        if not has_app_context() or self.EXTENSION_KEY not in current_app.extensions:
+            return
+        with self._lock:
+            if table is None:
+                self._mappings.clear()
+            else:
+                self._mappings.pop(table, None)
+
+    def get(self, table, name):
+        """
+        Returns the id of a reference row from its name
+        :param table: models.Model. One of ReferenceCache.TABLES
+        :param name: str. The row name
+        :return: int or None if the name is unknown
+        """
+        return self._mapping(table).get(name)
+
+    def name(self, table, row_id):
+        """
+        Returns the name of a reference row from its id (reverse of get)
+        :param table: models.Model. One of ReferenceCache.TABLES
+        :param row_id: int. The row id
+        :return: str or None if the id is unknown
+        """
+        for name, mapped_id in self._mapping(table).items():
+            if mapped_id == row_id:
+                return name
+        return None
+
+    def _mapping(self, table):
+        mapping = self._mappings.get(table)
+        if mapping is None:
+            self.load(table)
+            mapping = self._mappings[table]
+        return mapping
+
+
+references = ReferenceCache()
+
+
+def _invalidate_references(mapper, connection, target):
+    references.invalidate(type(target))
+
+
+for _table in ReferenceCache.TABLES:
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_table, _event_name, _invalidate_references)
@@ -3,12 +3,16 @@ Extras click commands
 """
 
 import os
+import time
+import datetime as dt
 
 import click
 from flask import current_app
 from flask.cli import with_appcontext
 
-from . import models
+from . import models, partitions, rollups, idempotency, server
+from .expiry import ExpiryScheduler
+from .caches import references
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 PROJECT_ROOT = os.path.join(HERE, os.pardir)
@@ -22,13 +26,14 @@ def initdb():
     Initialize the database (should be runs once)
     """
     current_app.logger.debug("Creating database...")
-    models.db.create_all(app=current_app)
+    partitions.create_all()
 
     current_app.logger.debug("Inserting initial datas...")
     with current_app.app_context():
         for table, datas in models.INITIAL_TABLES.items():
             if table is models.User:
                 for data in datas:
+                    data = dict(data)  # Don't alter INITIAL_TABLES, initdb may run again in the same process
                     password = data.pop('password')
                     user = models.User(**data)
                     user.set_password_hash(password=password)
@@ -39,6 +44,121 @@ def initdb():
                     models.db.session.add(t)
 
         models.db.session.commit()
+        references.invalidate()
+
+
+@click.command()
+@click.option('--days', type=int, default=None, help='Livestates/metrics history to keep, default to RETENTION_DAYS')
+@with_appcontext
+def retention(days):
+    """
+    Purge the expired livestates/metrics history, and create the partitions ahead (if partitioned, even
+    without retention)
+    """
+    days = current_app.config.get('RETENTION_DAYS') if days is None else days
+    if days is None and not partitions.enabled():
+        raise click.UsageError('No retention: set RETENTION_DAYS or --days')
+
+    if days is not None:
+        for result in partitions.purge(before=dt.datetime.now() - dt.timedelta(days=days)):
+            click.echo(result)
+
+    if partitions.enabled():
+        now = dt.datetime.now()
+        for name in partitions.ensure_partitions(now, now + partitions.ahead()):
+            click.echo('created partition {0}'.format(name))
+        for name in partitions.default_rows():
+            click.echo('warning: {0} holds rows outside the range partitions, deleted at the retention cutoff '
+                       '(run this command more often, or raise PARTITIONS_AHEAD)'.format(name), err=True)
+
+
+@click.command()
+@click.option('--batch-size', type=int, default=None, help='Metrics aggregated per transaction, default to ROLLUP_BATCH_SIZE')
+@click.option('--loop', type=float, default=None, help='Keep running, waiting this many seconds once caught up')
+@with_appcontext
+def rollup(batch_size, loop):
+    """
+    Aggregate the new metrics into the 1 minute, 1 hour and 1 day rollups
+    """
+    batch_size = batch_size or current_app.config.get('ROLLUP_BATCH_SIZE', 50000)
+    while True:
+        total = 0
+        while True:
+            count = rollups.rollup(batch_size=batch_size)
+            total += count
+            if count < batch_size:
+                break
+        current_app.logger.info("%s metrics aggregated", total)
+        if loop is None:
+            click.echo('{0} metrics aggregated'.format(total))
+            break
+        time.sleep(loop)
+
+
+@click.command()
+@click.option('--batch-size', type=int, default=100000, help='Ids scanned per transaction')
+@with_appcontext
+def deduplicate(batch_size):
+    """
+    Delete the duplicated livestates/metrics and add their unique indexes (databases created before them)
+    """
+    for result in idempotency.deduplicate(batch_size=batch_size):
+        click.echo(result)
+
+
+@click.command()
+@click.option('--interval', type=float, default=None, help='Maximum seconds between ticks, default to EXPIRY_INTERVAL')
+@click.option('--once', is_flag=True, help='Run a single tick and exit')
+@with_appcontext
+def expiry(interval, once):
+    """
+    Freshness checker daemon: writes EXPIRED livestates for the monitored entities without recent livestates
+    """
+    config = current_app.config
+    interval = interval or config.get('EXPIRY_INTERVAL', 1.0)
+    scheduler = ExpiryScheduler(batch_size=config.get('EXPIRY_BATCH_SIZE', 5000))
+    current_app.logger.info("%s entities scheduled", scheduler.load())
+    last_reload = last_refresh = time.monotonic()
+    while True:
+        expired = scheduler.tick()
+        stats = scheduler.stats()
+        if expired or stats['lag'] > config.get('EXPIRY_LAG_WARNING', 10):
+            current_app.logger.warning("%s entities expired, lag %.1fs, tick %.3fs",
+                                       expired, stats['lag'], stats['tick_duration'])
+        if once:
+            click.echo('{0} entities expired, {1} scheduled, lag {2:.1f}s'.format(
+                expired, stats['entities'], stats['lag']))
+            break
+
+        now = time.monotonic()
+        if now - last_reload >= config.get('EXPIRY_RELOAD_INTERVAL', 300):  # Catch the entities updates/deletions
+            scheduler.load()
+            last_reload = last_refresh = now
+        elif now - last_refresh >= config.get('EXPIRY_REFRESH_INTERVAL', 10):  # Catch the new entities
+            scheduler.load(new_only=True)
+            last_refresh = now
+
+        next_deadline = scheduler.next_deadline()
+        wait = interval if next_deadline is None else min(max(next_deadline - time.time(), 0), interval)
+        if stats['lag'] <= 0:
+            time.sleep(wait)
+
+
+@click.command()
+@click.option('--host', default=None, help='Listening address, default to SERVER_HOST')
+@click.option('--port', type=int, default=None, help='Listening port, default to SERVER_PORT')
+@click.option('--workers', type=int, default=None, help='Worker processes, default to SERVER_WORKERS or the CPU count')
+@click.option('--threads', type=int, default=None, help='Connections at once per worker, default to SERVER_THREADS')
+@click.option('--max-requests', type=int, default=None, help='Requests before a worker is replaced, 0 to keep them')
+@click.option('--reuse-port/--no-reuse-port', default=None, help='One SO_REUSEPORT socket per worker')
+@click.option('--preload', is_flag=True, help='Create the application once in the master, before forking')
+@with_appcontext
+def serve(host, port, workers, threads, max_requests, reuse_port, preload):
+    """
+    Run the pre-forking production server (SIGHUP reloads, SIGTERM stops)
+    """
+    server.serve(current_app._get_current_object(), host=host, port=port, workers=workers, threads=threads,
+                 max_requests=max_requests, reuse_port=reuse_port, preload=preload)
 
 
 @click.command()
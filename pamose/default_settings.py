@@ -7,6 +7,18 @@ class Config(object):
 
     SECRET_KEY = 'PAMOSE_SECRET_KEY'  # TODO: Change me (in install process?)
     TOKEN_EXPIRATION_TIME = 3600
+    TOKEN_CACHE_SIZE = 10000  # Verified tokens kept in memory
+    TOKEN_CACHE_TTL = 300  # Seconds before a cached token is verified again (capped by its expiration)
+    PASSWORD_SCHEMES = ['sha512_crypt', 'sha256_crypt']  # passlib schemes, the first hashes (and rehashes at login)
+    PASSWORD_CONTEXT_OPTIONS = {}  # Extra passlib CryptContext options, e.g. {'sha512_crypt__min_rounds': 100000}
+    PASSWORD_EXECUTOR = 'thread'  # Password verifications run in a 'thread' or 'process' pool
+    PASSWORD_WORKERS = 2  # Verifications running at once per process
+    PASSWORD_MAX_PENDING = 32  # Verifications running or waiting before answering 429
+    PASSWORD_CACHE_SIZE = 10000  # Successful verifications kept in memory
+    PASSWORD_CACHE_TTL = 300  # Seconds a successful verification is reused while the hash is unchanged, 0 to disable
+    LOGIN_RATE_LIMIT = 60  # Login attempts per client address per LOGIN_RATE_WINDOW, None to disable
+    LOGIN_FAILURES_LIMIT = 10  # Failed logins per user name per LOGIN_RATE_WINDOW, None to disable
+    LOGIN_RATE_WINDOW = 60  # Seconds
     APP_DIR = os.path.abspath(os.path.dirname(__file__))  # This directory
     PROJECT_ROOT = os.path.abspath(os.path.join(APP_DIR, os.pardir))
     # DB_PATH = os.path.join(PROJECT_ROOT, DB_NAME)
@@ -15,7 +27,65 @@ class Config(object):
     DEBUG_TB_INTERCEPT_REDIRECTS = False
     CACHE_TYPE = 'simple'  # Can be "memcached", "redis", etc.
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_POOL_SIZE = 10  # Connections kept open per process (not SQLite)
+    DB_MAX_OVERFLOW = 20  # Extra connections opened under burst load, closed when returned
+    DB_POOL_TIMEOUT = 30  # Seconds waiting for a connection before failing
+    DB_POOL_RECYCLE = 1800  # Seconds before a connection is replaced, -1 to keep them
+    DB_POOL_PRE_PING = True  # Test connections on checkout (survives database restarts)
+    DB_STATEMENT_TIMEOUT = None  # PostgreSQL statements timeout (milliseconds), None for no timeout
+    DB_PGBOUNCER = False  # Behind PgBouncer (transaction pooling): no application pool, SET LOCAL timeouts
+    INGEST_MODE = 'orm'  # 'orm' (one ORM object per row) or 'bulk' (plain rows, multi-row INSERT/COPY)
+    INGEST_COPY = True  # In bulk mode, use COPY on PostgreSQL instead of multi-row INSERTs
+    INGEST_ASYNC = False  # Write-behind: PATCH /host answers once queued, a writer thread commits in batches
+    INGEST_QUEUE_SIZE = 10000  # Queued payloads before answering 429
+    INGEST_BATCH_SIZE = 100  # Payloads per commit
+    INGEST_BATCH_INTERVAL = 1.0  # Seconds waiting to fill a batch
+    INGEST_SHUTDOWN_TIMEOUT = 30  # Seconds to flush the queue at exit
+    INGEST_DEDUPLICATE = True  # Drop the livestates already stored (same entity and timestamp) before writing
+    ENTITY_CONFIG_CACHE = True  # Cache the hosts configurations, known hosts being ingested without loading them
+    ENTITY_CONFIG_CACHE_SIZE = 100000  # Hosts configurations kept per process
+    ENTITY_CONFIG_TTL = 600  # Seconds before a cached host configuration is read again from the database
+    ENTITY_CONFIG_REDIS_URL = None  # Share the configurations between processes in Redis (redis://host:6379/0)
+    IDEMPOTENCY_TTL = 3600  # Seconds the answers are replayed to requests repeating an Idempotency-Key, None to disable
+    IDEMPOTENCY_CACHE_SIZE = 10000  # Answers kept per process
     # WEBPACK_MANIFEST_PATH = 'webpack/manifest.json'
+    INGEST_MAX_BODY_SIZE = 16 * 1024 * 1024  # Bytes of a PATCH /host body, or of a PATCH /hosts host, decompressed
+    BULK_CHUNK_SIZE = 200  # Hosts resolved and written together by PATCH /hosts
+    INGEST_MAX_BULK_SIZE = 1024 * 1024 * 1024  # Bytes of a PATCH /hosts body, once decompressed, None for no limit
+    PARTITIONING = None  # PostgreSQL only: None, 'daily' or 'weekly' partitions of livestate/metric (at initdb)
+    PARTITIONS_AHEAD = 7  # Days of partitions created in advance
+    RETENTION_DAYS = None  # Livestates/metrics history kept by `pamose retention`, None to keep everything
+    ROLLUP_BATCH_SIZE = 50000  # Metrics aggregated per transaction by `pamose rollup`
+    ROLLUP_GRACE = 60  # Seconds a metric may stay uncommitted, before being aggregated (not PostgreSQL)
+    EXPIRY_INTERVAL = 1.0  # Maximum seconds between two `pamose expiry` ticks
+    EXPIRY_BATCH_SIZE = 5000  # Maximum entities expired per tick
+    EXPIRY_REFRESH_INTERVAL = 10  # Seconds between two lookups of new entities
+    EXPIRY_RELOAD_INTERVAL = 300  # Seconds between two full reloads of the entities
+    EXPIRY_LAG_WARNING = 10  # Log when the checker is more than this many seconds behind
+    INSTRUMENTATION = True  # Per request SQL and phases timings, aggregated at /_internal/timings
+    SERVER_TIMING = None  # Send the timings in a Server-Timing header, None for debug mode only
+    SLOW_REQUEST_THRESHOLD = 1.0  # Log the requests lasting longer (seconds) with their queries, None to disable
+    METRICS_ENABLED = True  # Prometheus metrics of the server at /metrics
+    METRICS_MULTIPROC_DIR = None  # Directory shared by the worker processes, default to $PROMETHEUS_MULTIPROC_DIR
+    METRICS_FLUSH_INTERVAL = 1.0  # Minimum seconds between two dumps of a process metrics in that directory
+    SERVER_HOST = '127.0.0.1'  # `pamose serve` listening address
+    SERVER_PORT = 5000
+    SERVER_WORKERS = None  # Worker processes, None for the CPU count
+    SERVER_THREADS = 8  # Connections served at once per worker
+    SERVER_MAX_REQUESTS = 10000  # Requests before a worker is replaced (bounds its memory), 0 to keep them
+    SERVER_MAX_REQUESTS_JITTER = 1000  # Random extra requests, so the workers don't restart together
+    SERVER_GRACEFUL_TIMEOUT = 30  # Seconds the stopping workers get to finish their requests
+    SERVER_KEEPALIVE = 5  # Seconds an idle keep-alive connection is kept
+    SERVER_REUSE_PORT = True  # One SO_REUSEPORT socket per worker (where available), else a shared socket
+    SERVER_BACKLOG = 1024  # Listen queue size
+    ASGI_THREADS = None  # Threads running the ASGI ingest requests, None for DB_POOL_SIZE + DB_MAX_OVERFLOW
+    ASGI_MAX_PENDING = 10000  # ASGI requests waiting for a thread before answering 503
+    ASGI_MAX_BODY_SIZE = 64 * 1024 * 1024  # Bytes of an ASGI request body (buffered) before answering 413
+    EVENTS_ENABLED = True  # Livestate transitions stream at /events
+    EVENTS_BUFFER_SIZE = 10000  # Transitions kept in memory for the consumers catching up
+    EVENTS_NOTIFY = True  # PostgreSQL only: share the transitions between processes with LISTEN/NOTIFY
+    EVENTS_KEEPALIVE = 15  # Seconds between two keepalive comments of the /events streams
+    LIVESTATE_STORE = 'all'  # 'all' livestates, or only the 'transitions' (and the ones carrying metrics)
     LOG_DIR = '/tmp'
     LOG_LEVEL = 'WARNING'
     LOG_FORMAT = '<%(asctime)s> <%(levelname)s> %(message)s'
@@ -0,0 +1,68 @@
+"""
+Time series downsampling to a maximum number of points, both keeping a subset of the original points:
+    lttb: Largest-Triangle-Three-Buckets (Steinarsson, 2013), keeps the visual shape of the series
+    minmax: the lowest and the highest point of each bucket, keeps all the peaks
+"""
+
+METHODS = ('lttb', 'minmax')
+
+
+def downsample(points, threshold, method='lttb', key=lambda point: point[1]):
+    """
+    :param points: list of tuples, sorted by their first item (the x value, a number)
+    :param threshold: int. Maximum number of points returned
+    :param method: str. One of METHODS
+    :param key: function. Gives the y value of a point
+    :return: list of tuples. A subset of points, in the same order
+    """
+    if method == 'minmax':
+        return minmax(points, threshold, key)
+    return lttb(points, threshold, key)
+
+
+def lttb(points, threshold, key=lambda point: point[1]):
+    if threshold >= len(points):
+        return list(points)
+    if threshold < 3:  # Not enough for any bucket, keep the ends
+        return [points[0], points[-1]][:threshold]
+
+    sampled = [points[0]]
+    every = (len(points) - 2) / float(threshold - 2)  # Bucket size, the first and last points aside
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket, the third point of the triangle
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        next_points = points[next_start:next_end]
+        avg_x = sum(point[0] for point in next_points) / len(next_points)
+        avg_y = sum(key(point) for point in next_points) / len(next_points)
+
+        # The point of the current bucket making the largest triangle with the previous selected one
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        a_x, a_y = points[a][0], key(points[a])
+        max_area, chosen = -1.0, start
+        for j in range(start, end):
+            area = abs((a_x - avg_x) * (key(points[j]) - a_y) - (a_x - points[j][0]) * (avg_y - a_y))
+            if area > max_area:
+                max_area, chosen = area, j
+        sampled.append(points[chosen])
+        a = chosen
+    sampled.append(points[-1])
+    return sampled
+
+
+def minmax(points, threshold, key=lambda point: point[1]):
+    if threshold >= len(points):
+        return list(points)
+    buckets = max(threshold // 2, 1)
+    every = len(points) / float(buckets)
+    sampled = []
+    for i in range(buckets):
+        bucket = range(int(i * every), int((i + 1) * every))
+        if not len(bucket):
+            continue
+        low = min(bucket, key=lambda j: key(points[j]))
+        high = max(bucket, key=lambda j: key(points[j]))
+        sampled.extend(points[j] for j in sorted(set((low, high))))
+    return sampled
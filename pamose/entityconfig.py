@@ -0,0 +1,307 @@
+"""
+Entity configuration store
+
+The configuration of each host needed by the ingest path (the ids and flags of the host and of its services
+entities) and by its PATCH feedback (check_interval, freshness_threshold, passive_check_enabled), cached by
+host name. A payload whose host and services are all known is ingested without loading any ORM object (see
+ingest.ingest_host): only its livestates are written.
+
+The configurations are built by the ingest path from the committed entities, and invalidated when an entity
+of the host is updated or deleted through the ORM (created entities are simply not known yet, a payload with
+a new service takes the slow path). Changes made otherwise (Core statements, SQL) need `invalidate`.
+
+Entries are versioned per host, so a configuration read before a concurrent change is never stored over it.
+The store is in process (ENTITY_CONFIG_CACHE_SIZE hosts), or shared by all the processes in Redis with
+ENTITY_CONFIG_REDIS_URL (optional, `pip install redis`).
+"""
+
+import json
+import threading
+from collections import namedtuple
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from . import models
+from .caches import TTLCache
+
+try:
+    import redis
+except ImportError:  # Optional
+    redis = None
+
+PENDING_KEY = 'pamose_entity_configs_pending'  # Session.info key of the configurations waiting for the commit
+INVALIDATED_KEY = 'pamose_entity_configs_invalidated'  # Session.info key of the hosts to invalidate at commit
+
+EntityConfig = namedtuple('EntityConfig', ('id', 'name', 'entity_type_id', 'is_auto_acknowledge'))
+
+
+class HostConfig(namedtuple('HostConfig', EntityConfig._fields + (
+        'checkall_interval', 'heartbeat_interval', 'is_monitored', 'services'))):
+    """
+    An host configuration. Usable in place of the host record by the ingest path and ingest.host_feedback,
+    services maps the services entities names to their EntityConfig.
+    """
+    __slots__ = ()
+
+    def livestates(self, json_data):
+        """
+        The livestates of a payload for this host, with their entities
+        :param json_data: dict. A validated host payload
+        :return: list of (EntityConfig, list of dict) tuples, or None if the payload has unknown services
+        """
+        pending_livestates = []
+        livestate = json_data.get('livestate', None)
+        if livestate:
+            pending_livestates.append((self, livestate))
+        for service in json_data.get('services', None) or []:
+            config = self.services.get('{0}||{1}'.format(self.name, service.get('name', None)))
+            if config is None:
+                return None
+            livestate = service.get('livestate', None)
+            if livestate:
+                pending_livestates.append((config, livestate))
+        return pending_livestates
+
+    def dumps(self):
+        return json.dumps(self[:-1] + (list(self.services.values()),))
+
+    @classmethod
+    def loads(cls, data):
+        values = json.loads(data)
+        services = dict((service[1], EntityConfig(*service)) for service in values[-1])
+        return cls(*values[:-1] + [services])
+
+
+class EntityConfigStore(object):
+    """
+    Per application store of the hosts configurations
+    """
+    EXTENSION_KEY = 'pamose_entity_configs'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('ENTITY_CONFIG_CACHE', True):
+            return
+        ttl = app.config.get('ENTITY_CONFIG_TTL', 600)
+        url = app.config.get('ENTITY_CONFIG_REDIS_URL')
+        if url:
+            if redis is None:
+                raise RuntimeError('ENTITY_CONFIG_REDIS_URL needs the redis library')
+            backend = _RedisBackend(redis.Redis.from_url(url), ttl)
+        else:
+            backend = _LocalBackend(app.config.get('ENTITY_CONFIG_CACHE_SIZE', 100000), ttl)
+        app.extensions[self.EXTENSION_KEY] = backend
+
+    @property
+    def enabled(self):
+        return self.EXTENSION_KEY in current_app.extensions
+
+    @property
+    def _backend(self):
+        return current_app.extensions[self.EXTENSION_KEY]
+
+    def get_many(self, host_names):
+        """
+        :param host_names: list of str
+        :return: dict. host name -> HostConfig, for the cached ones
+        """
+        if not self.enabled or not host_names:
+            return {}
+        try:
+            return self._backend.get_many(host_names)
+        except Exception:  # The shared store is down, ingest from the database
+            current_app.logger.exception("Entity configurations lookup failed")
+            return {}
+
+    def get(self, host_name):
+        """
+        :return: HostConfig, or None if not cached
+        """
+        return self.get_many([host_name]).get(host_name)
+
+    def versions(self, host_names):
+        """
+        The current versions of hosts configurations, to read before their entities (see store)
+        :return: dict. host name -> version
+        """
+        if not self.enabled or not host_names:
+            return {}
+        try:
+            return self._backend.versions(host_names)
+        except Exception:
+            current_app.logger.exception("Entity configurations versions lookup failed")
+            return {}
+
+    def store(self, session, rec_hosts, versions):
+        """
+        Build the configurations of hosts from their entities (the session being flushed), cached once (if)
+        the session commits and if they weren't invalidated since their versions were read
+        :param session: sqlalchemy Session (or scoped_session)
+        :param rec_hosts: list of models.Entity. The hosts records
+        :param versions: dict. host name -> version, read before the entities (see versions)
+        """
+        rec_hosts = [rec_host for rec_host in rec_hosts if rec_host.name in versions]
+        if not rec_hosts:
+            return
+        entity = models.Entity.__table__
+        services = dict((rec_host.id, {}) for rec_host in rec_hosts)
+        host_ids = list(services)
+        for i in range(0, len(host_ids), 500):
+            query = models.db.select([entity.c.parent_entity_id, entity.c.id, entity.c.name, entity.c.entity_type_id,
+                                      entity.c.is_auto_acknowledge]).where(
+                entity.c.parent_entity_id.in_(host_ids[i:i + 500]))
+            for row in session.execute(query):
+                services[row.parent_entity_id][row.name] = EntityConfig(*row[1:])
+        pending = session.info.setdefault(PENDING_KEY, {})
+        for rec_host in rec_hosts:
+            config = HostConfig(rec_host.id, rec_host.name, rec_host.entity_type_id, rec_host.is_auto_acknowledge,
+                                rec_host.checkall_interval, rec_host.heartbeat_interval, rec_host.is_monitored,
+                                services[rec_host.id])
+            pending[rec_host.name] = (config, versions[rec_host.name])
+
+    def invalidate(self, host_names):
+        """
+        Forget hosts configurations, in this process or in the shared store
+        :param host_names: iterable of str
+        """
+        host_names = list(host_names)
+        if host_names and has_app_context() and self.enabled:
+            try:
+                self._backend.invalidate(host_names)
+            except Exception:
+                current_app.logger.exception("Entity configurations invalidation failed")
+
+    def clear(self):
+        if self.enabled:
+            self._backend.clear()
+
+    def _commit(self, pending):
+        try:
+            self._backend.set_many(pending)
+        except Exception:
+            current_app.logger.exception("Entity configurations update failed")
+
+
+class _LocalBackend(object):
+    """
+    In process configurations, with the versions of the hosts invalidated by this process
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)  # host name -> (version, HostConfig)
+        self.host_versions = {}
+        self.lock = threading.Lock()
+
+    def get_many(self, host_names):
+        result = {}
+        for host_name in host_names:
+            item = self.cache.get(host_name)
+            if item is not None and item[0] == self.host_versions.get(host_name, 0):
+                result[host_name] = item[1]
+        return result
+
+    def versions(self, host_names):
+        return dict((host_name, self.host_versions.get(host_name, 0)) for host_name in host_names)
+
+    def set_many(self, pending):
+        with self.lock:
+            for host_name, (config, version) in pending.items():
+                if self.host_versions.get(host_name, 0) == version:
+                    self.cache.set(host_name, (version, config))
+
+    def invalidate(self, host_names):
+        with self.lock:
+            for host_name in host_names:
+                self.host_versions[host_name] = self.host_versions.get(host_name, 0) + 1
+                self.cache.pop(host_name)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+
+class _RedisBackend(object):
+    """
+    Configurations shared in Redis. A configuration is only set while its host version key is unchanged
+    (atomically, by a script), and invalidating deletes it and increments the version.
+    """
+    PREFIX = 'pamose:entity_config:'
+    VERSION_PREFIX = 'pamose:entity_config_version:'
+    SET_SCRIPT = """
+        if tonumber(redis.call('GET', KEYS[2]) or '0') == tonumber(ARGV[1]) then
+            redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+        end
+    """
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = int(ttl)
+        self.set_script = client.register_script(self.SET_SCRIPT)
+
+    def get_many(self, host_names):
+        values = self.client.mget([self.PREFIX + host_name for host_name in host_names])
+        return dict((host_name, HostConfig.loads(value)) for host_name, value in zip(host_names, values)
+                    if value is not None)
+
+    def versions(self, host_names):
+        values = self.client.mget([self.VERSION_PREFIX + host_name for host_name in host_names])
+        return dict((host_name, int(value or 0)) for host_name, value in zip(host_names, values))
+
+    def set_many(self, pending):
+        pipeline = self.client.pipeline(transaction=False)
+        for host_name, (config, version) in pending.items():
+            self.set_script(keys=[self.PREFIX + host_name, self.VERSION_PREFIX + host_name],
+                            args=[version, config.dumps(), self.ttl], client=pipeline)
+        pipeline.execute()
+
+    def invalidate(self, host_names):
+        pipeline = self.client.pipeline(transaction=True)
+        for host_name in host_names:
+            pipeline.incr(self.VERSION_PREFIX + host_name)
+            pipeline.delete(self.PREFIX + host_name)
+        pipeline.execute()
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.PREFIX + '*'):
+            self.client.delete(key)
+
+
+entity_configs = EntityConfigStore()
+
+
+@event.listens_for(models.Entity, 'after_update')
+def _entity_updated(mapper, connection, target):
+    session = object_session(target)
+    if session is not None and session.is_modified(target, include_collections=False):  # Not only new childs
+        _entity_changed(mapper, connection, target)
+
+
+@event.listens_for(models.Entity, 'after_delete')
+def _entity_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        names = [target.name] + list(inspect(target).attrs.name.history.deleted or ())  # Renamed
+        session.info.setdefault(INVALIDATED_KEY, set()).update(name.split('||', 1)[0] for name in names if name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    invalidated = session.info.pop(INVALIDATED_KEY, None)
+    pending = session.info.pop(PENDING_KEY, None)
+    if not has_app_context() or not entity_configs.enabled:
+        return
+    if invalidated:
+        entity_configs.invalidate(invalidated)
+    if pending:
+        entity_configs._commit(pending)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(INVALIDATED_KEY, None)
+    session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,185 @@
+"""
+Livestate transitions notifications
+
+The ingest path detects the state transitions (see ingest.detect_transitions) and records them with the
+transaction writing them. Once committed, they are published to an in-memory ring buffer (EVENTS_BUFFER_SIZE
+events) fanned out to the /events consumers, by server-sent events or long polling.
+
+On PostgreSQL (with EVENTS_NOTIFY), the transitions are sent with NOTIFY in the writing transaction instead,
+and every worker process LISTENs to feed its own buffer: all the workers see the transitions of all the
+others (and of `pamose expiry`). Events ids are per process.
+"""
+
+import json
+import time
+import select
+import itertools
+import threading
+from collections import deque
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import models
+
+CHANNEL = 'pamose_transitions'
+PENDING_KEY = 'pamose_events_pending'  # Session.info key of the transitions waiting for the commit
+NOTIFY_MAX_BYTES = 7000  # NOTIFY payloads are limited to 8000 bytes
+
+
+class EventBus(object):
+    """
+    Ring buffer of the last events, with blocking reads
+    """
+
+    def __init__(self, size=10000):
+        self.events = deque(maxlen=size)
+        self.last_id = 0
+        self.condition = threading.Condition()
+
+    def publish(self, events):
+        """
+        :param events: list of dict. Get their 'id' here
+        """
+        with self.condition:
+            for item in events:
+                self.last_id += 1
+                self.events.append(dict(item, id=self.last_id))
+            self.condition.notify_all()
+
+    def since(self, last_id, timeout=0):
+        """
+        The events following an event, waiting for them if there are none yet
+        :param last_id: int. The last event id received by the consumer, 0 for none
+        :param timeout: float. Maximum seconds to wait
+        :return: (list of dict, bool). The events, and whether some were already dropped from the buffer
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            last_id = min(last_id, self.last_id)  # Ids from before a restart
+            while self.last_id <= last_id:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return [], False
+                self.condition.wait(remaining)
+            first_id = self.events[0]['id']
+            return list(itertools.islice(self.events, max(last_id + 1 - first_id, 0), None)), last_id + 1 < first_id
+
+
+class Events(object):
+    """
+    Per application event bus, and its PostgreSQL listener thread
+    """
+    EXTENSION_KEY = 'pamose_events'
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('EVENTS_ENABLED', True):
+            app.extensions[self.EXTENSION_KEY] = {'bus': EventBus(app.config.get('EVENTS_BUFFER_SIZE', 10000)),
+                                                  'listener': None}
+
+    @property
+    def enabled(self):
+        return self.EXTENSION_KEY in current_app.extensions
+
+    @property
+    def bus(self):
+        return current_app.extensions[self.EXTENSION_KEY]['bus']
+
+    def notifying(self, connection):
+        return current_app.config.get('EVENTS_NOTIFY', True) and connection.dialect.name == 'postgresql'
+
+    def record(self, session, transitions):
+        """
+        Publish transitions once (if) the session commits
+        :param session: sqlalchemy Session (or scoped_session)
+        :param transitions: list of dict
+        """
+        if not transitions or not self.enabled:
+            return
+        connection = session.connection()
+        if not self.notifying(connection):
+            session.info.setdefault(PENDING_KEY, []).extend(transitions)
+            return
+        chunk, size = [], 0
+        for transition in transitions:  # Delivered by PostgreSQL at commit, to all the listeners
+            encoded = json.dumps(transition)
+            if chunk and size + len(encoded) > NOTIFY_MAX_BYTES:
+                self._notify(connection, chunk)
+                chunk, size = [], 0
+            chunk.append(encoded)
+            size += len(encoded) + 1
+        self._notify(connection, chunk)
+
+    @staticmethod
+    def _notify(connection, encoded):
+        connection.execute(models.db.text('SELECT pg_notify(:channel, :payload)'),
+                           channel=CHANNEL, payload='[{0}]'.format(','.join(encoded)))
+
+    def wait(self, last_id, timeout):
+        """
+        See EventBus.since
+        """
+        self.start_listener()
+        return self.bus.since(last_id, timeout)
+
+    def start_listener(self):
+        """
+        Start the LISTEN thread of this process, if notifications go through PostgreSQL
+        """
+        state = current_app.extensions[self.EXTENSION_KEY]
+        if state['listener'] is not None and state['listener'].is_alive():
+            return
+        if not self.notifying(models.db.engine):
+            return
+        with self._lock:
+            if state['listener'] is not None and state['listener'].is_alive():
+                return
+            state['listener'] = threading.Thread(target=self._listen, args=(current_app._get_current_object(),),
+                                                 name='pamose-events', daemon=True)
+            state['listener'].start()
+
+    def _listen(self, app):
+        with app.app_context():
+            bus = self.bus
+            while True:
+                connection = None
+                try:
+                    connection = models.db.engine.raw_connection()
+                    connection.detach()  # Dedicated, out of the pool
+                    dbapi_connection = connection.connection
+                    dbapi_connection.autocommit = True
+                    cursor = dbapi_connection.cursor()
+                    cursor.execute('LISTEN {0}'.format(CHANNEL))
+                    while True:
+                        if select.select([dbapi_connection], [], [], 5) == ([], [], []):
+                            continue
+                        dbapi_connection.poll()
+                        while dbapi_connection.notifies:
+                            bus.publish(json.loads(dbapi_connection.notifies.pop(0).payload))
+                except Exception:
+                    app.logger.exception("Transitions listener failed, reconnecting")
+                    time.sleep(1)
+                finally:
+                    if connection is not None:
+                        connection.close()
+
+
+events = Events()
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending and has_app_context() and events.enabled:
+        events.bus.publish(pending)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,152 @@
+"""
+Freshness checking: monitored entities not receiving any livestate within their heartbeat_interval get an
+EXPIRED livestate
+
+The scheduler keeps a min-heap of the entities next deadlines (last livestate timestamp + heartbeat_interval)
+so each tick only looks at the entities actually due, whatever the number of monitored entities. Due entities
+are checked against current_livestate (they may have received data from another process meanwhile) in one
+query, and the EXPIRED livestates are written in one batch.
+"""
+
+import time
+import heapq
+import datetime as dt
+
+from . import models, partitions
+from .caches import references
+from .ingest import write_rows, upsert_current_livestates
+from .events import events
+
+EXPIRED_OUTPUT = 'No livestate received within the heartbeat interval'
+
+
+class ExpiryScheduler(object):
+    """
+    In-memory deadlines of the monitored and expirable entities
+    """
+
+    def __init__(self, batch_size=5000, chunk_size=500):
+        """
+        :param batch_size: int. Maximum number of due entities handled per tick
+        :param chunk_size: int. Maximum number of ids in a single IN clause
+        """
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.heap = []  # (deadline, entity_id), may contain stale entries
+        self.deadlines = {}  # entity_id -> current deadline (epoch seconds)
+        self.entities = {}  # entity_id -> (heartbeat_interval, is_auto_acknowledge, name)
+        self.max_entity_id = None
+        self.lag = 0.0  # Seconds the oldest due deadline is behind, after the last tick
+        self.tick_duration = 0.0
+        self.expired = 0  # Total of EXPIRED livestates written
+
+    def stats(self):
+        """
+        :return: dict. Scheduled entities, lag and last tick duration (seconds), EXPIRED livestates written
+        """
+        return {'entities': len(self.deadlines), 'lag': self.lag, 'tick_duration': self.tick_duration,
+                'expired': self.expired}
+
+    def load(self, new_only=False):
+        """
+        (Re)load the monitored and expirable entities and their deadlines
+        :param new_only: bool. Only load the entities created since the last load
+        :return: int. The number of entities loaded
+        """
+        entity = models.Entity.__table__
+        current = models.CurrentLivestate.__table__
+        query = models.db.select([
+            entity.c.id, entity.c.name, entity.c.heartbeat_interval, entity.c.is_auto_acknowledge, current.c.timestamp
+        ]).select_from(
+            entity.outerjoin(current, current.c.entity_id == entity.c.id)
+        ).where(entity.c.is_monitored.is_(True)).where(entity.c.is_expirable.is_(True))
+        if new_only and self.max_entity_id is not None:
+            query = query.where(entity.c.id > self.max_entity_id)
+        else:
+            self.heap, self.deadlines, self.entities, self.max_entity_id = [], {}, {}, None
+
+        now = time.time()
+        count = 0
+        for row in models.db.session.execute(query):
+            self.entities[row.id] = (row.heartbeat_interval, row.is_auto_acknowledge, row.name)
+            last = row.timestamp.timestamp() if row.timestamp is not None else now
+            self.schedule(row.id, last + row.heartbeat_interval)
+            self.max_entity_id = row.id if self.max_entity_id is None else max(self.max_entity_id, row.id)
+            count += 1
+        if len(self.heap) > 2 * len(self.deadlines):  # Too many stale entries
+            self.heap = [(deadline, entity_id) for entity_id, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+        models.db.session.commit()
+        return count
+
+    def schedule(self, entity_id, deadline):
+        self.deadlines[entity_id] = deadline
+        heapq.heappush(self.heap, (deadline, entity_id))
+
+    def next_deadline(self):
+        """
+        :return: float. The earliest deadline (epoch seconds), or None if nothing is scheduled
+        """
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)  # Stale
+        return self.heap[0][0] if self.heap else None
+
+    def tick(self, now=None):
+        """
+        Expire the due entities not having received a livestate since, and reschedule all of them
+        :param now: float. Current epoch time
+        :return: int. The number of EXPIRED livestates written
+        """
+        started = time.monotonic()
+        now = time.time() if now is None else now
+        due = []
+        while len(due) < self.batch_size and self.next_deadline() is not None and self.heap[0][0] <= now:
+            deadline, entity_id = heapq.heappop(self.heap)
+            del self.deadlines[entity_id]
+            due.append(entity_id)
+
+        rows, transitions = [], []
+        timestamp = dt.datetime.fromtimestamp(now)
+        if due and partitions.enabled():  # Before the transaction reads anything (see partitions.ensure)
+            partitions.ensure([timestamp])
+        if due:
+            current = models.CurrentLivestate.__table__
+            stored = {}
+            for i in range(0, len(due), self.chunk_size):
+                query = models.db.select([current.c.entity_id, current.c.timestamp, current.c.state_id]).where(
+                    current.c.entity_id.in_(due[i:i + self.chunk_size]))
+                for row in models.db.session.execute(query):
+                    stored[row.entity_id] = row
+
+            expired_id = references.get(models.State, 'EXPIRED')
+            for entity_id in due:
+                heartbeat_interval, is_auto_acknowledge, name = self.entities[entity_id]
+                row = stored.get(entity_id)
+                if row is not None and row.timestamp.timestamp() + heartbeat_interval > now:  # Fresh data
+                    self.schedule(entity_id, row.timestamp.timestamp() + heartbeat_interval)
+                    continue
+                if row is None or row.state_id != expired_id:
+                    rows.append({
+                        'entity_id': entity_id, 'state_id': expired_id, 'timestamp': timestamp,
+                        'output': EXPIRED_OUTPUT, 'long_output': None, 'is_acknowledged': is_auto_acknowledge,
+                    })
+                    transitions.append({
+                        'entity_id': entity_id, 'entity': name, 'state': 'EXPIRED', 'timestamp': now,
+                        'previous_state': references.name(models.State, row.state_id) if row is not None else None,
+                        'output': EXPIRED_OUTPUT,
+                    })
+                self.schedule(entity_id, now + heartbeat_interval)
+
+            if rows:
+                connection = models.db.session.connection()
+                write_rows(connection, [(row, []) for row in rows])
+                upsert_current_livestates(connection, [dict((key, row[key]) for key in (
+                    'entity_id', 'state_id', 'timestamp', 'output', 'is_acknowledged')) for row in rows])
+                events.record(models.db.session, transitions)
+            models.db.session.commit()
+            self.expired += len(rows)
+
+        next_deadline = self.next_deadline()
+        self.lag = max(now - next_deadline, 0.0) if next_deadline is not None else 0.0
+        self.tick_duration = time.monotonic() - started
+        return len(rows)
@@ -0,0 +1,376 @@
+"""
+Prometheus metrics of the server itself, served at /metrics in the text exposition format
+
+Counters and histograms are sharded per thread: each thread only ever writes its own dict, without any
+lock, and the shards are summed when collected. The shard of a finished thread is folded into the retired
+values. The ingest counters are only added once their transaction commits. Pool and write-behind queue
+statistics are read when collected.
+
+With several worker processes (`pamose serve`), set METRICS_MULTIPROC_DIR to a directory shared by the
+workers (emptied before starting them): each process dumps its values there (at most every
+METRICS_FLUSH_INTERVAL seconds, after a request) and /metrics aggregates the files of all the processes, the
+live statistics being labelled by pid. The files of the exited processes are removed, their counters and
+histograms folded into a retired file, their live statistics dropped.
+"""
+
+import os
+import json
+import errno
+import fcntl
+import weakref
+import time
+import bisect
+import threading
+from collections import OrderedDict
+
+from flask import g, request, current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+COUNTER, GAUGE, HISTOGRAM = 'counter', 'gauge', 'histogram'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PENDING_KEY = 'pamose_metrics_pending'  # Session.info key of the ingest counters waiting for the commit
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+RETIRED_FILENAME = 'pamose_retired.json'  # Values of the exited processes, in the multiprocess directory
+
+
+class Registry(object):
+    """
+    Metrics definitions and their per thread shards of values
+    """
+
+    def __init__(self):
+        self.metrics = OrderedDict()  # name -> (type, help, buckets)
+        self._local = threading.local()
+        self._shards = {}  # id -> shard of a running thread
+        self._retired = {}  # The values of the finished threads
+        self._lock = threading.Lock()  # Only taken when a thread creates or retires its shard, and when collecting
+
+    def define(self, name, kind, help, buckets=None):
+        self.metrics[name] = (kind, help, buckets)
+        return name
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards[id(shard)] = shard
+            finalizer = weakref.finalize(threading.current_thread(), self._retire, shard)
+            finalizer.atexit = False
+        return shard
+
+    def _retire(self, shard):
+        """
+        Fold the shard of a finished thread (its Thread object collected) into the retired values
+        """
+        with self._lock:
+            self._shards.pop(id(shard), None)
+            for key, value in shard.items():
+                merge(self._retired, key, value, self.metrics[key[0]][0])
+
+    def inc(self, name, value=1, labels=()):
+        """
+        :param labels: tuple of (label name, value) tuples
+        """
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def set_max(self, name, value, labels=()):
+        """
+        Raise a gauge to value (a timestamp of the last occurrence of something, ...)
+        """
+        shard = self._shard()
+        key = (name, labels)
+        if value > shard.get(key, value - 1):
+            shard[key] = value
+
+    def observe(self, name, value, labels=()):
+        buckets = self.metrics[name][2]
+        shard = self._shard()
+        key = (name, labels)
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [0] * (len(buckets) + 3)  # Buckets, +Inf, sum, count
+        entry[bisect.bisect_left(buckets, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def collect(self):
+        """
+        :return: dict. (name, labels) -> value (a list for the histograms), summed over the threads
+        """
+        with self._lock:
+            shards = list(self._shards.values())
+            values = {}
+            for key, value in self._retired.items():
+                merge(values, key, value, self.metrics[key[0]][0])
+        for shard in shards:
+            for key, value in list(shard.items()):
+                merge(values, key, value, self.metrics[key[0]][0])
+        return values
+
+
+def merge(values, key, value, kind):
+    """
+    Merge a value into collected ones: counters and histograms add up, gauges keep the maximum
+    """
+    current = values.get(key)
+    if current is None:
+        values[key] = list(value) if isinstance(value, list) else value
+    elif kind == HISTOGRAM:
+        values[key] = [a + b for a, b in zip(current, value)]
+    elif kind == GAUGE:
+        values[key] = max(current, value)
+    else:
+        values[key] = current + value
+
+
+registry = Registry()
+INGEST_ENTITIES = registry.define('pamose_ingest_entities_total', COUNTER,
+                                  'Entities having received livestates, by entity type')
+INGEST_LIVESTATES = registry.define('pamose_ingest_livestates_total', COUNTER, 'Livestates written')
+INGEST_METRICS = registry.define('pamose_ingest_metrics_total', COUNTER, 'Metrics written')
+INGEST_COMMITS = registry.define('pamose_ingest_commits_total', COUNTER, 'Transactions having written livestates')
+INGEST_LAST_COMMIT = registry.define('pamose_ingest_last_commit_timestamp_seconds', GAUGE,
+                                     'Time of the last transaction having written livestates')
+REQUESTS = registry.define('pamose_http_requests_total', COUNTER, 'HTTP requests, by route, method and status')
+REQUEST_DURATION = registry.define('pamose_http_request_duration_seconds', HISTOGRAM,
+                                   'HTTP requests duration, by route and method', LATENCY_BUCKETS)
+INGEST_QUEUE_LATENCY = registry.define('pamose_ingest_queue_latency_seconds', HISTOGRAM,
+                                       'Write-behind payloads latency, from their enqueuing to their commit',
+                                       LATENCY_BUCKETS)
+
+
+def add_pending(session, name, value=1, labels=()):
+    """
+    Count something written by a session, added to the metrics if (when) the session commits
+    :param session: sqlalchemy Session (or scoped_session)
+    """
+    pending = session.info.setdefault(PENDING_KEY, {})
+    key = (name, labels)
+    pending[key] = pending.get(key, 0) + value
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending:
+        for (name, labels), value in pending.items():
+            registry.inc(name, value, labels)
+        registry.inc(INGEST_COMMITS)
+        registry.set_max(INGEST_LAST_COMMIT, time.time())
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+POOL_STATS = OrderedDict((  # pool.stats() key -> metric name, the ones ending in _total being counters
+    ('size', 'pamose_db_pool_size'),
+    ('checked_out', 'pamose_db_pool_checked_out'),
+    ('checked_in', 'pamose_db_pool_checked_in'),
+    ('overflow', 'pamose_db_pool_overflow'),
+    ('max_wait_time', 'pamose_db_pool_max_wait_time'),
+    ('checkouts', 'pamose_db_pool_checkouts_total'),
+    ('waits', 'pamose_db_pool_waits_total'),
+    ('wait_time', 'pamose_db_pool_wait_seconds_total'),
+    ('timeouts', 'pamose_db_pool_timeouts_total'),
+))
+QUEUE_STATS = OrderedDict((  # ingest_queue.stats() key -> metric name (the latencies are a histogram)
+    ('depth', 'pamose_ingest_queue_depth'),
+    ('capacity', 'pamose_ingest_queue_capacity'),
+    ('max_depth', 'pamose_ingest_queue_max_depth'),
+    ('enqueued', 'pamose_ingest_queue_enqueued_total'),
+    ('rejected', 'pamose_ingest_queue_rejected_total'),
+    ('written', 'pamose_ingest_queue_written_total'),
+    ('failed', 'pamose_ingest_queue_failed_total'),
+))
+
+
+def live_gauges():
+    """
+    The statistics read on demand: connection pool and write-behind queue of this process (gauges, and
+    counters for the names ending in _total)
+    :return: dict. (name, labels) -> value
+    """
+    from .pool import pool
+    from .writebehind import ingest_queue
+
+    gauges = {}
+    stats = pool.stats()
+    for key, name in POOL_STATS.items():
+        if key in stats:
+            gauges[(name, ())] = stats[key]
+    stats = ingest_queue.stats()
+    if stats is not None:
+        for key, name in QUEUE_STATS.items():
+            gauges[(name, ())] = stats[key]
+    return gauges
+
+
+def dump(directory):
+    """
+    Write the values of this process in the multiprocess directory (atomically)
+    """
+    values = [[name, list(labels), value] for (name, labels), value in registry.collect().items()]
+    gauges = [[name, list(labels), value] for (name, labels), value in live_gauges().items()]
+    path = os.path.join(directory, 'pamose_{0}.json'.format(os.getpid()))
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'values': values, 'gauges': gauges}, f)
+    os.replace(path + '.tmp', path)
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH  # EPERM: someone else's
+    return True
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):  # Removed or being replaced meanwhile
+        return None
+
+
+def prune_directory(directory):
+    """
+    Remove the files of the exited processes, their counters and histograms being folded into the retired
+    file. To be called with the directory lock held (see collect_directory).
+    """
+    stale = []
+    for filename in os.listdir(directory):
+        pid = filename[len('pamose_'):-len('.json')]
+        if filename.startswith('pamose_') and filename.endswith('.json') and pid.isdigit() and \
+                not process_exists(int(pid)):
+            stale.append(os.path.join(directory, filename))
+    if not stale:
+        return
+    retired_path = os.path.join(directory, RETIRED_FILENAME)
+    retired = {}
+    for path in [retired_path] + stale:
+        for name, labels, value in (_read(path) or {}).get('values', []):
+            if name in registry.metrics:
+                merge(retired, (name, tuple(tuple(label) for label in labels)), value, registry.metrics[name][0])
+    with open(retired_path + '.tmp', 'w') as f:
+        json.dump({'values': [[name, list(labels), value] for (name, labels), value in retired.items()],
+                   'gauges': []}, f)
+    os.replace(retired_path + '.tmp', retired_path)
+    for path in stale:
+        os.unlink(path)
+
+
+def collect_directory(directory):
+    """
+    Aggregate the values dumped by all the processes (and retired ones)
+    :return: (dict of values, dict of gauges), see Registry.collect and live_gauges
+    """
+    values, gauges = {}, {}
+    with open(os.path.join(directory, 'pamose.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # Not reading the files another process is folding
+        prune_directory(directory)
+        for filename in os.listdir(directory):
+            if not (filename.startswith('pamose_') and filename.endswith('.json')):
+                continue
+            data = _read(os.path.join(directory, filename))
+            if data is None:
+                continue
+            pid = filename[len('pamose_'):-len('.json')]
+            for name, labels, value in data['values']:
+                if name in registry.metrics:
+                    merge(values, (name, tuple(tuple(label) for label in labels)), value,
+                          registry.metrics[name][0])
+            for name, labels, value in data['gauges']:
+                gauges[(name, tuple(tuple(label) for label in labels) + (('pid', pid),))] = value
+    return values, gauges
+
+
+def render(values, gauges):
+    """
+    :return: str. The text exposition format
+    """
+    lines = []
+    for name, (kind, help, buckets) in registry.metrics.items():
+        samples = sorted((key, value) for key, value in values.items() if key[0] == name)
+        if not samples:
+            continue
+        lines.append('# HELP {0} {1}'.format(name, help))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+        for (_, labels), value in samples:
+            if kind != HISTOGRAM:
+                lines.append('{0}{1} {2}'.format(name, format_labels(labels), format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + (float('inf'),), value):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, format_labels(labels + (('le', format_value(bound)),)), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), format_value(value[-2])))
+            lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), value[-1]))
+    for name in sorted(set(key[0] for key in gauges)):
+        lines.append('# TYPE {0} {1}'.format(name, COUNTER if name.endswith('_total') else GAUGE))
+        for (_, labels), value in sorted((key, value) for key, value in gauges.items() if key[0] == name):
+            lines.append('{0}{1} {2}'.format(name, format_labels(labels), format_value(value)))
+    return ''.join(line + '\n' for line in lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                               .replace('\n', r'\n')) for key, value in labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition():
+    """
+    :return: str. The metrics of this process, or of all the processes in multiprocess mode
+    """
+    directory = multiproc_dir()
+    if directory:
+        dump(directory)
+        return render(*collect_directory(directory))
+    return render(registry.collect(), live_gauges())
+
+
+def multiproc_dir():
+    return current_app.config.get('METRICS_MULTIPROC_DIR') or os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+def register(app):
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    state = {'last_dump': 0.0}
+
+    @app.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def count_request(response):
+        start = g.get('metrics_start')
+        if start is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        registry.inc(REQUESTS, labels=(('route', route), ('method', request.method),
+                                       ('status', str(response.status_code))))
+        registry.observe(REQUEST_DURATION, time.perf_counter() - start,
+                         labels=(('route', route), ('method', request.method)))
+
+        directory = multiproc_dir()
+        now = time.monotonic()
+        if directory and now - state['last_dump'] >= current_app.config.get('METRICS_FLUSH_INTERVAL', 1.0):
+            state['last_dump'] = now
+            dump(directory)
+        return response
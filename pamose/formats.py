@@ -0,0 +1,224 @@
+"""
+Request body formats of the ingest endpoints, negotiated by the request headers
+
+Content-Encoding: identity, gzip, deflate or zstd (needs `zstandard`)
+Content-Type: application/json (NDJSON accepted by the bulk endpoint) or application/msgpack (needs `msgpack`)
+
+MessagePack payloads have the JSON structure. In both formats, a livestate may carry its metrics already
+parsed in a 'metrics' list of [name, value] or [name, value, cumulative] items, instead of a perf_data string.
+"""
+
+import gzip
+import json
+import zlib
+
+from . import streams
+from .streams import BodyTooLarge
+
+try:
+    import msgpack
+except ImportError:  # Optional
+    msgpack = None
+try:
+    import zstandard
+except ImportError:  # Optional
+    zstandard = None
+
+JSON_TYPES = ('application/json', 'application/x-ndjson', 'application/jsonlines', '')
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+READ_SIZE = 65536
+STREAM_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class UnsupportedFormat(Exception):
+    """
+    The body encoding or type isn't supported (or its optional library isn't installed)
+    """
+
+
+def content_encoding(request):
+    return request.headers.get('Content-Encoding', 'identity').strip().lower() or 'identity'
+
+
+def content_type(request):
+    mimetype = request.mimetype
+    if mimetype in JSON_TYPES:
+        return 'json'
+    if mimetype in MSGPACK_TYPES:
+        if msgpack is None:
+            raise UnsupportedFormat('MessagePack bodies need the msgpack library on the server')
+        return 'msgpack'
+    raise UnsupportedFormat('Unsupported Content-Type {0}'.format(mimetype))
+
+
+def decompress(data, encoding, max_size):
+    """
+    :param data: bytes. The raw body
+    :param encoding: str. The Content-Encoding
+    :param max_size: int. Maximum decompressed size
+    :return: bytes
+    :raise UnsupportedFormat: unknown encoding
+    :raise BodyTooLarge: more than max_size once decompressed
+    :raise ValueError: corrupted data
+    """
+    if encoding == 'identity':
+        return data
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding != 'deflate' else zlib.MAX_WBITS)
+        try:
+            result = decompressor.decompress(data, max_size + 1)
+        except zlib.error as e:
+            raise ValueError('Corrupted {0} body: {1}'.format(encoding, e))
+        if not decompressor.eof and len(result) <= max_size:
+            raise ValueError('Truncated {0} body'.format(encoding))
+    elif encoding == 'zstd':
+        if zstandard is None:
+            raise UnsupportedFormat('zstd bodies need the zstandard library on the server')
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                result = reader.read(max_size + 1)
+        except zstandard.ZstdError as e:
+            raise ValueError('Corrupted zstd body: {0}'.format(e))
+    else:
+        raise UnsupportedFormat('Unsupported Content-Encoding {0}'.format(encoding))
+    if len(result) > max_size:
+        raise BodyTooLarge('Body larger than {0} bytes once decompressed'.format(max_size))
+    return result
+
+
+def decode_host(request, max_size):
+    """
+    The host payload of a request
+    :param request: flask.Request
+    :param max_size: int. Maximum body size, as received and once decompressed
+    :return: The decoded document, None for an empty body
+    :raise UnsupportedFormat: unknown encoding/type
+    :raise BodyTooLarge: body larger than max_size
+    :raise ValueError: malformed body
+    """
+    kind = content_type(request)
+    if request.content_length is not None and request.content_length > max_size:  # Not read at all
+        raise BodyTooLarge('Body larger than {0} bytes'.format(max_size))
+    data = request.stream.read(max_size + 1)  # Bounded, whatever the Content-Length says
+    if len(data) > max_size:
+        raise BodyTooLarge('Body larger than {0} bytes'.format(max_size))
+    data = decompress(data, content_encoding(request), max_size)
+    if not data.strip():
+        return None
+    if kind == 'msgpack':
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except (msgpack.UnpackException, TypeError) as e:
+            raise ValueError('Malformed MessagePack body: {0}'.format(e))
+    return json.loads(data.decode('UTF-8'))
+
+
+def decompressed_stream(stream, encoding):
+    """
+    :param stream: file-like object of bytes
+    :param encoding: str. The Content-Encoding
+    :return: file-like object of the decompressed bytes, decompressed as read
+    """
+    if encoding == 'identity':
+        return stream
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if encoding == 'deflate':
+        return _DeflateReader(stream)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise UnsupportedFormat('zstd bodies need the zstandard library on the server')
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise UnsupportedFormat('Unsupported Content-Encoding {0}'.format(encoding))
+
+
+class _DeflateReader(object):
+    """
+    Returns at most size decompressed bytes per read, keeping the compressed data not inflated yet
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj()
+
+    def read(self, size=READ_SIZE):
+        if size is None or size < 0:
+            size = READ_SIZE
+        while True:
+            data = self.decompressor.unconsumed_tail or self.stream.read(READ_SIZE)
+            if not data:
+                return self.decompressor.flush()
+            result = self.decompressor.decompress(data, size)
+            if result:
+                return result
+
+
+class _LimitedReader(object):
+    """
+    Counts the bytes read from a stream, raising BodyTooLarge beyond max_size
+    """
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+
+    def read(self, size=READ_SIZE):
+        data = self.stream.read(size)
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise BodyTooLarge('Body larger than {0} bytes once decompressed'.format(self.max_size))
+        return data
+
+
+def iter_hosts(request, max_document_size, max_size=None):
+    """
+    Iterate over the host documents of a bulk request body, decompressed and decoded as read: a JSON array,
+    NDJSON, or MessagePack (an array of hosts, or a sequence of host maps)
+    :param max_document_size: int. Maximum size of a host document
+    :param max_size: int. Maximum size of the whole body once decompressed, None for no limit
+    :raise UnsupportedFormat: unknown encoding/type
+    :return: generator, raising BodyTooLarge on a too large body or document, ValueError on malformed data
+    """
+    kind = content_type(request)
+    stream = decompressed_stream(request.stream, content_encoding(request))
+    if max_size is not None:
+        stream = _LimitedReader(stream, max_size)
+    if kind == 'msgpack':
+        return _iter_msgpack(stream, max_document_size)
+    return _iter_json(stream, max_document_size)
+
+
+def _iter_json(stream, max_document_size):
+    try:
+        for document in streams.iter_documents(stream, max_size=max_document_size):
+            yield document
+    except STREAM_ERRORS as e:  # Corrupted compressed stream
+        raise ValueError('Corrupted body: {0}'.format(e))
+
+
+def _iter_msgpack(stream, max_document_size):
+    # Fed chunk by chunk: the header of a top level array is skipped, its hosts are unpacked one at a time
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=max_document_size + READ_SIZE)
+    header = None  # Whether the body starts with an array header not read yet
+    size = 0
+    try:
+        for chunk in iter(lambda: stream.read(READ_SIZE), b''):
+            unpacker.feed(chunk)
+            size += len(chunk)
+            if header is None:
+                header = 0x90 <= chunk[0] <= 0x9f or chunk[0] in (0xdc, 0xdd)
+            if header:
+                try:
+                    unpacker.read_array_header()
+                except msgpack.OutOfData:
+                    continue
+                header = False
+            for document in unpacker:
+                yield document
+    except msgpack.BufferFull:
+        raise BodyTooLarge('Document larger than {0} bytes'.format(max_document_size))
+    except STREAM_ERRORS + (msgpack.UnpackException, TypeError) as e:
+        raise ValueError('Malformed MessagePack body: {0}'.format(e))
+    if unpacker.tell() != size:
+        raise ValueError('Truncated MessagePack body')
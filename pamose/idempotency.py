@@ -0,0 +1,154 @@
+"""
+Idempotency-Key support of the ingest endpoints
+
+An agent retrying a PATCH (after a timeout, ...) with the same Idempotency-Key header gets the answer of the
+first request again, without touching the database. The successful answers are kept IDEMPOTENCY_TTL seconds
+per user and key, in process: with several workers, a retry reaching another one is written again, and its
+livestates dropped as duplicates by the ingest path (see ingest.drop_duplicates).
+The answers given before the commit (write-behind queue) aren't kept: the writer may still drop the payload.
+
+Databases created before the livestate and metric unique constraints are upgraded by `pamose deduplicate`.
+"""
+
+import functools
+
+from flask import g, current_app, request, Response
+
+from . import models, partitions
+from .caches import TTLCache
+from .tokens import tokens
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyCache(object):
+    """
+    Per application cache of the answers, by (user, method, path, key)
+    """
+    EXTENSION_KEY = 'pamose_idempotency'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        ttl = app.config.get('IDEMPOTENCY_TTL', 3600)
+        if ttl:
+            app.extensions[self.EXTENSION_KEY] = TTLCache(maxsize=app.config.get('IDEMPOTENCY_CACHE_SIZE', 10000),
+                                                          ttl=ttl)
+
+    @property
+    def enabled(self):
+        return self.EXTENSION_KEY in current_app.extensions
+
+    def key(self):
+        """
+        :return: tuple. The cache key of the current request, or None if it has no (usable) Idempotency-Key
+        """
+        value = request.headers.get(HEADER)
+        if not value or len(value) > MAX_KEY_LENGTH or not self.enabled:
+            return None
+        authorization = request.authorization
+        user_id = tokens.verify(authorization.username.encode('UTF-8')) if authorization else None
+        return user_id, request.method, request.path, value
+
+    def get(self, key):
+        """
+        :return: flask.Response. The answer cached for this key, or None
+        """
+        cached = current_app.extensions[self.EXTENSION_KEY].get(key)
+        if cached is None:
+            return None
+        body, status, mimetype = cached
+        return Response(body, status=status, mimetype=mimetype, headers={'Idempotent-Replayed': 'true'})
+
+    def uncommitted(self):
+        """
+        Don't keep the answer of the current request: its data isn't committed yet (write-behind queue), and
+        may still be dropped, so a retry must be written for real
+        """
+        g.idempotency_uncommitted = True
+
+    def set(self, key, response):
+        """
+        Keep a successful answer (others, 409 or 429 ones in particular, must be retried for real), unless
+        the request data isn't committed (see uncommitted)
+        :param response: flask.Response
+        """
+        if g.get('idempotency_uncommitted'):
+            return
+        if 200 <= response.status_code < 300 and not response.is_streamed:
+            current_app.extensions[self.EXTENSION_KEY].set(key, (response.get_data(), response.status_code,
+                                                                 response.mimetype))
+
+
+idempotency = IdempotencyCache()
+
+
+def idempotent(view):
+    """
+    View decorator answering the requests repeating an Idempotency-Key from the cache. To be applied after
+    the authentication one (first in the MethodView decorators).
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = idempotency.key()
+        if key is None:
+            return view(*args, **kwargs)
+        response = idempotency.get(key)
+        if response is None:
+            response = current_app.make_response(view(*args, **kwargs))
+            idempotency.set(key, response)
+        return response
+    return wrapper
+
+
+DUPLICATED_LIVESTATE = ('EXISTS (SELECT 1 FROM livestate earlier WHERE earlier.entity_id = {0}.entity_id '
+                        'AND earlier.timestamp = {0}.timestamp AND earlier.id < {0}.id)')
+
+
+def deduplicate(batch_size=100000):
+    """
+    Delete the duplicated livestates (keeping the first one of each entity and timestamp, with its metrics)
+    and metrics, then create the unique indexes of the constraints, on a database created without them.
+    Rows are deleted by ranges of batch_size ids, one transaction each, a row being a duplicate when a lower
+    id has the same key (looked up with the indexes replaced at the end).
+    :param batch_size: int. Ids scanned per transaction
+    :return: list of str. What was deleted/created, for display
+    """
+    statements = (
+        ('metric', 'DELETE FROM metric WHERE id >= :low AND id < :high AND EXISTS ('
+                   'SELECT 1 FROM livestate WHERE livestate.id = metric.livestate_id AND {0})'.format(
+                       DUPLICATED_LIVESTATE.format('livestate'))),
+        ('livestate', 'DELETE FROM livestate WHERE id >= :low AND id < :high AND {0}'.format(
+            DUPLICATED_LIVESTATE.format('livestate'))),
+        ('metric', 'DELETE FROM metric WHERE id >= :low AND id < :high AND EXISTS ('
+                   'SELECT 1 FROM metric earlier WHERE earlier.livestate_id = metric.livestate_id '
+                   'AND earlier.name = metric.name AND earlier.id < metric.id)'),
+    )
+    results = []
+    for table, statement in statements:
+        high_id = models.db.session.execute(models.db.text('SELECT MAX(id) FROM {0}'.format(table))).scalar() or 0
+        models.db.session.commit()
+        deleted = 0
+        for low in range(0, high_id + 1, batch_size):
+            with models.db.engine.begin() as connection:
+                deleted += connection.execute(models.db.text(statement), low=low, high=low + batch_size).rowcount
+        results.append('deleted {0} duplicated rows from {1}'.format(deleted, table))
+
+    with models.db.engine.begin() as connection:
+        for model, index in ((models.Livestate, 'ix_livestate_entity_id_timestamp'),
+                             (models.Metric, 'ix_metric_livestate_id_name')):
+            table = model.__table__
+            for constraint in table.constraints:
+                if not isinstance(constraint, models.db.UniqueConstraint):
+                    continue
+                columns = [column.name for column in constraint.columns]
+                if partitions.enabled(connection) and partitions.PARTITION_KEY not in columns:
+                    columns.append(partitions.PARTITION_KEY)
+                connection.execute(models.db.text('CREATE UNIQUE INDEX IF NOT EXISTS "{0}" ON "{1}" ({2})'.format(
+                    constraint.name, table.name, ', '.join('"{0}"'.format(column) for column in columns))))
+                results.append('created unique index {0}'.format(constraint.name))
+            connection.execute(models.db.text('DROP INDEX IF EXISTS "{0}"'.format(index)))  # Replaced
+    return results
@@ -0,0 +1,743 @@
+"""
+Livestates and metrics ingestion
+
+Two write paths are available, selected by the INGEST_MODE setting:
+    orm: one ORM object per livestate/metric, flushed by the session unit of work
+    bulk: plain row mappings written with executemany / multi-row INSERT, or COPY on PostgreSQL
+
+Ingestion is idempotent: livestates are unique per (entity, timestamp) and metrics per (livestate, name).
+The livestates already stored are dropped before writing (INGEST_DEDUPLICATE), and concurrent duplicates are
+ignored by the database (INSERT ... ON CONFLICT DO NOTHING, INSERT OR IGNORE on SQLite) in bulk mode, or
+fail the transaction on the unique constraints in orm mode.
+
+State transitions are detected against current_livestate and published (see events). With LIVESTATE_STORE
+set to 'transitions', only the livestates changing the entity state (or carrying metrics, which need their
+livestate) are stored, current_livestate still getting the latest one.
+"""
+
+import io
+import datetime as dt
+
+from flask import current_app
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+from . import models, perfdata
+from .instrumentation import phase
+from . import exporter
+from .events import events
+from .entityconfig import entity_configs
+from .caches import references
+
+
+def write_livestates(items):
+    """
+    Insert the livestates (and their metrics) of several entities, using the configured INGEST_MODE
+    :param items: list of (models.Entity or entityconfig.EntityConfig, list of dict) tuples. The livestates to
+        insert per entity
+    :return: Nothing
+    """
+    models.db.session.flush()  # New entities need their ids
+    if current_app.config.get('INGEST_DEDUPLICATE', True):
+        with phase('dedup'):
+            items = drop_duplicates(items)
+
+    stored_items, transitions = items, []
+    if events.enabled or current_app.config.get('LIVESTATE_STORE', 'all') == 'transitions':
+        with phase('transitions'):
+            stored_items, transitions = detect_transitions(items)
+
+    with phase('livestates'):
+        if current_app.config.get('INGEST_MODE', 'orm') == 'bulk':
+            bulk_insert_livestates(stored_items)
+        else:
+            for rec_entity, livestates in stored_items:
+                insert_livestates(rec_parent=rec_entity, livestates=livestates)
+    with phase('current'):
+        update_current_livestates(items)
+    count_livestates(stored_items)
+    events.record(models.db.session, transitions)
+
+
+def drop_duplicates(items, chunk_size=500):
+    """
+    Drop the livestates already stored (a retried payload), or repeated in items, by (entity, timestamp)
+    :param items: list of (models.Entity, list of dict) tuples
+    :return: list of (models.Entity, list of dict) tuples. The new livestates
+    """
+    models.db.session.flush()  # New entities need their ids
+    now = dt.datetime.now().timestamp()
+    timestamps = {}  # entity id -> set of the items timestamps
+    for rec_entity, livestates in items:
+        for livestate in livestates:
+            livestate.setdefault('timestamp', now)  # Its key
+            timestamps.setdefault(rec_entity.id, set()).add(dt.datetime.fromtimestamp(livestate['timestamp']))
+
+    livestate = models.Livestate.__table__
+    seen = set()  # (entity id, timestamp)
+    entity_ids = list(timestamps)
+    for i in range(0, len(entity_ids), chunk_size):
+        chunk = entity_ids[i:i + chunk_size]
+        query = models.db.select([livestate.c.entity_id, livestate.c.timestamp]).where(models.db.and_(
+            livestate.c.entity_id.in_(chunk),
+            livestate.c.timestamp.in_(list(set().union(*(timestamps[entity_id] for entity_id in chunk))))))
+        seen.update((row.entity_id, row.timestamp) for row in models.db.session.execute(query))
+
+    result = []
+    for rec_entity, livestates in items:
+        kept = []
+        for livestate in livestates:
+            key = (rec_entity.id, dt.datetime.fromtimestamp(livestate['timestamp']))
+            if key not in seen:
+                seen.add(key)
+                kept.append(livestate)
+        result.append((rec_entity, kept))
+    return result
+
+
+def detect_transitions(items, chunk_size=500):
+    """
+    Find the livestates changing the state of their entity, compared to its previous livestate (the stored
+    current one, or the previous one in items). Late livestates, older than the current one, are never
+    transitions. The first livestate of an entity is one.
+    :param items: list of (models.Entity, list of dict) tuples
+    :return: (items to store, list of dict transitions). The items to store are all of them, unless
+        LIVESTATE_STORE is 'transitions'
+    """
+    models.db.session.flush()  # New entities need their ids
+    current = models.CurrentLivestate.__table__
+    entity_ids = [rec_entity.id for rec_entity, livestates in items if livestates]
+    stored = {}
+    for i in range(0, len(entity_ids), chunk_size):
+        query = models.db.select([current.c.entity_id, current.c.state_id, current.c.timestamp]).where(
+            current.c.entity_id.in_(entity_ids[i:i + chunk_size]))
+        for row in models.db.session.execute(query):
+            stored[row.entity_id] = (row.state_id, row.timestamp)
+
+    store_all = current_app.config.get('LIVESTATE_STORE', 'all') != 'transitions'
+    now = dt.datetime.now().timestamp()
+    stored_items, transitions = [], []
+    for rec_entity, livestates in items:
+        previous = stored.get(rec_entity.id)  # (state_id, timestamp)
+        kept = []
+        for livestate in sorted(livestates, key=lambda livestate: livestate.get('timestamp', now)):
+            timestamp = dt.datetime.fromtimestamp(livestate.get('timestamp', now))
+            state_id = references.get(models.State, livestate.get('state'))
+            is_transition = False
+            if previous is None or previous[1] <= timestamp:
+                is_transition = previous is None or previous[0] != state_id
+                if is_transition:
+                    transitions.append({
+                        'entity_id': rec_entity.id,
+                        'entity': rec_entity.name,
+                        'previous_state': references.name(models.State, previous[0]) if previous else None,
+                        'state': livestate.get('state'),
+                        'timestamp': timestamp.timestamp(),
+                        'output': livestate.get('output'),
+                    })
+                previous = (state_id, timestamp)
+            if store_all or is_transition or livestate.get('perf_data') or livestate.get('metrics'):
+                kept.append(livestate)
+        stored_items.append((rec_entity, kept))
+    return stored_items, transitions
+
+
+def count_livestates(items):
+    """
+    Count the written entities (by type) and livestates in the exported metrics, once committed
+    :param items: list of (models.Entity, list of dict) tuples
+    """
+    types = dict((references.get(models.EntityType, name), name) for name in ('host', 'service'))
+    entities, livestates = {}, 0
+    for rec_entity, entity_livestates in items:
+        if entity_livestates:
+            entity_type = types.get(rec_entity.entity_type_id, 'other')
+            entities[entity_type] = entities.get(entity_type, 0) + 1
+            livestates += len(entity_livestates)
+    session = models.db.session
+    for entity_type, count in entities.items():
+        exporter.add_pending(session, exporter.INGEST_ENTITIES, count, labels=(('type', entity_type),))
+    if livestates:
+        exporter.add_pending(session, exporter.INGEST_LIVESTATES, livestates)
+
+
+class UnknownState(ValueError):
+    """
+    A livestate state isn't one of the State table
+    """
+
+
+def state_id(name):
+    """
+    :param name: str. A livestate state
+    :return: int. Its State id
+    :raise UnknownState: not a known state
+    """
+    result = references.get(models.State, name)
+    if result is None:
+        raise UnknownState('Unknown state {0!r}'.format(name))
+    return result
+
+
+def validate_host(json_data):
+    """
+    Check the structure of an host payload (see ressources.HostRessource), and its livestates states
+    :param json_data: dict. The decoded payload
+    :return: str. The issue found, or None if the payload is usable
+    """
+    if not isinstance(json_data, dict):
+        return 'Host data must be an object'
+    if not isinstance(json_data.get('name'), str) or not json_data['name']:
+        return 'Missing host name'
+    services = json_data.get('services', None) or []
+    if not isinstance(services, list) or not all(isinstance(service, dict) for service in services):
+        return 'Services must be a list of objects'
+    for livestates in [json_data.get('livestate', None)] + [service.get('livestate', None) for service in services]:
+        if not livestates:
+            continue
+        if not isinstance(livestates, list) or not all(isinstance(livestate, dict) for livestate in livestates):
+            return 'Livestates must be a list of objects'
+        for livestate in livestates:
+            if references.get(models.State, livestate.get('state')) is None:
+                return 'Unknown state {0!r}'.format(livestate.get('state'))
+    return None
+
+
+def ingest_host(json_data):
+    """
+    Get/create the host (and its realm) and services entities of a payload and insert their livestates.
+    The session is not committed.
+    If the host and its services are known by the entity configuration store, no entity is loaded.
+    :param json_data: dict. A validated host payload
+    :return: models.Entity or entityconfig.HostConfig. The host record, or its cached configuration
+    """
+    host_name = json_data.get('name')
+    with phase('lookup'):
+        config = entity_configs.get(host_name)
+        pending_livestates = config.livestates(json_data) if config is not None else None
+        if pending_livestates is not None:
+            write_livestates(pending_livestates)
+            return config
+
+        versions = entity_configs.versions([host_name])
+        # Realm, host and services get, in one query
+        entities = get_entities(entity_names(json_data))
+        rec_entity_host, pending_livestates = resolve_host(json_data, entities)
+    write_livestates(pending_livestates)
+    entity_configs.store(models.db.session, [rec_entity_host], versions)
+    return rec_entity_host
+
+
+def ingest_hosts(payloads, chunk_size=200):
+    """
+    Ingest many host payloads, chunk by chunk: one entities query and one livestates write per chunk.
+    The session is not committed.
+    :param payloads: iterable of dict. The host payloads (validated here)
+    :param chunk_size: int. Payloads resolved together
+    :return: generator of (host name, feedback dict or None, issue or None), one per payload
+    """
+    chunk = []
+    for json_data in payloads:
+        chunk.append(json_data)
+        if len(chunk) >= chunk_size:
+            for result in _ingest_chunk(chunk):
+                yield result
+            chunk = []
+    if chunk:
+        for result in _ingest_chunk(chunk):
+            yield result
+
+
+def _ingest_chunk(chunk):
+    issues = [validate_host(json_data) for json_data in chunk]
+    results, pending_livestates, rec_hosts = [], [], []
+    with phase('lookup'):
+        configs = entity_configs.get_many([json_data['name'] for json_data, issue in zip(chunk, issues)
+                                           if issue is None])
+        cached, host_names, names = {}, [], []
+        for index, (json_data, issue) in enumerate(zip(chunk, issues)):
+            if issue is None:
+                config = configs.get(json_data['name'])
+                host_livestates = config.livestates(json_data) if config is not None else None
+                if host_livestates is None:
+                    host_names.append(json_data['name'])
+                    names.extend(entity_names(json_data))
+                else:
+                    cached[index] = (config, host_livestates)
+        versions = entity_configs.versions(host_names)
+        entities = get_entities(names)
+
+        for index, (json_data, issue) in enumerate(zip(chunk, issues)):
+            if issue is not None:
+                name = json_data.get('name') if isinstance(json_data, dict) else None
+                results.append((name, None, issue))
+                continue
+            if index in cached:
+                rec_entity_host, host_livestates = cached[index]
+            else:
+                rec_entity_host, host_livestates = resolve_host(json_data, entities)
+                rec_hosts.append(rec_entity_host)
+            pending_livestates.extend(host_livestates)
+            results.append((rec_entity_host, None, None))
+    write_livestates(pending_livestates)
+    with phase('flush'):
+        models.db.session.flush()
+    entity_configs.store(models.db.session, rec_hosts, versions)
+    return [(result[0].name, host_feedback(result[0]), None) if result[2] is None else result for result in results]
+
+
+def entity_names(json_data):
+    """
+    :param json_data: dict. A validated host payload
+    :return: list of str. The realm, host and services entities names of the payload
+    """
+    host_name = json_data.get('name')
+    template = json_data.get('template', None) or {}  # TODO: Better solution for realm info retrieving
+    services = json_data.get('services', None) or []
+    return ([template.get('_realm', None), host_name] +
+            [service_entity_name(host_name, service) for service in services])
+
+
+def service_entity_name(host_name, service):
+    return "{0}||{1}".format(host_name, service.get('name', None))  # For uniqueness
+
+
+def resolve_host(json_data, entities):
+    """
+    Get/create the host (and its realm) and services entities of a payload
+    :param json_data: dict. A validated host payload
+    :param entities: dict. name -> models.Entity, the already fetched entities (see entity_names).
+        The created entities are added to it
+    :return: (models.Entity, list of (models.Entity, list of dict)). The host record and the livestates to insert
+    """
+    host_name = json_data.get('name')
+    is_monitored = json_data.get('passive_checks_enabled', False)
+
+    template = json_data.get('template', None) or {}  # TODO: Better solution for realm info retrieving
+    realm_name = template.get('_realm', None)
+    # host_templates = template.get('_templates', None)  # TODO: Define templates
+
+    services = json_data.get('services', None) or []
+    current_app.logger.debug("services: {0}".format(services))
+    service_names = [service_entity_name(host_name, service) for service in services]
+
+    # Host create
+    rec_entity_host = entities.get(host_name)
+    if not rec_entity_host:  # Create it
+        # Realm get/create
+        rec_entity_realm = entities.get(realm_name)
+        if not rec_entity_realm:  # Create it
+            default_realm = models.Entity.query.get(0)
+            rec_entity_realm = models.Entity(name=realm_name,
+                                             entity_type_id=references.get(models.EntityType, 'realm')
+                                             )
+            default_realm.childs.append(rec_entity_realm)
+            models.db.session.add(rec_entity_realm)
+            if realm_name is not None:
+                entities[realm_name] = rec_entity_realm
+
+        rec_entity_host = models.Entity(name=host_name,
+                                        entity_type_id=references.get(models.EntityType, 'host'),
+                                        is_monitored=is_monitored
+                                        )
+        rec_entity_realm.childs.append(rec_entity_host)
+        models.db.session.add(rec_entity_host)
+        entities[host_name] = rec_entity_host
+
+    # Services create, only the missing ones
+    rec_new_services = []
+    for service, service_name in zip(services, service_names):
+        if service_name not in entities:
+            rec_entity_service = models.Entity(name=service_name,
+                                               entity_type_id=references.get(models.EntityType, 'service'),
+                                               is_monitored=service.get('passive_checks_enabled', False)
+                                               )
+            rec_entity_host.childs.append(rec_entity_service)
+            entities[service_name] = rec_entity_service
+            rec_new_services.append(rec_entity_service)
+    models.db.session.add_all(rec_new_services)
+
+    # Host and services Livestates
+    pending_livestates = []
+    livestate = json_data.get('livestate', None)
+    if livestate:
+        pending_livestates.append((rec_entity_host, livestate))
+    for service, service_name in zip(services, service_names):
+        livestate = service.get('livestate', None)
+        if livestate:
+            pending_livestates.append((entities[service_name], livestate))
+
+    return rec_entity_host, pending_livestates
+
+
+def host_feedback(rec_entity_host):
+    """
+    The feedback returned to the agent for its host
+    :param rec_entity_host: models.Entity. The host record
+    :return: dict
+    """
+    return {
+        'check_interval': rec_entity_host.checkall_interval,
+        'freshness_threshold': rec_entity_host.heartbeat_interval,
+        'passive_check_enabled': rec_entity_host.is_monitored,
+        'active_check_enabled': False
+    }
+
+
+def get_entities(names, chunk_size=500):
+    """
+    Fetch the existing entities matching the given names, with one IN query per chunk of names
+    :param names: list of str. The entities names (None values are ignored)
+    :param chunk_size: int. Maximum number of names in a single IN clause
+    :return: dict. name -> models.Entity
+    """
+    names = list(set(name for name in names if name is not None))
+    entities = {}
+    for i in range(0, len(names), chunk_size):
+        chunk = names[i:i + chunk_size]
+        for rec_entity in models.Entity.query.filter(models.Entity.name.in_(chunk)):
+            entities[rec_entity.name] = rec_entity
+    return entities
+
+
+def parse_metrics(raw_metrics):
+    """
+    Parse a perf_data string (see the perfdata module for the format)
+    :param raw_metrics: str. Metrics in raw format. A value with the 'c' unit is cumulative, else raw value
+    :return: list of (name, value, metric_type_id) tuples
+    """
+    cumulative_id = references.get(models.MetricType, 'cumulative')
+    raw_id = references.get(models.MetricType, 'raw')
+    with phase('perfdata'):
+        metrics = unique_metrics([(metric.name, metric.value, cumulative_id if metric.cumulative else raw_id)
+                                  for metric in perfdata.parse(raw_metrics)])
+    exporter.add_pending(models.db.session, exporter.INGEST_METRICS, len(metrics))
+    return metrics
+
+
+def livestate_metrics(livestate):
+    """
+    The metrics of a livestate: its pre-parsed 'metrics' list of [name, value] or [name, value, cumulative]
+    items (malformed ones skipped) if any, else its parsed perf_data string
+    :param livestate: dict. A livestate, as received
+    :return: list of (name, value, metric_type_id) tuples
+    """
+    items = livestate.get('metrics')
+    if items is None:
+        raw_metrics = livestate.get('perf_data', None)
+        return parse_metrics(raw_metrics) if raw_metrics else []
+
+    cumulative_id = references.get(models.MetricType, 'cumulative')
+    raw_id = references.get(models.MetricType, 'raw')
+    metrics = []
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, list) or not 2 <= len(item) <= 3 or not isinstance(item[0], str) or not item[0]:
+            continue
+        value = item[1]
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            continue
+        metrics.append((item[0], value, cumulative_id if len(item) == 3 and item[2] else raw_id))
+    metrics = unique_metrics(metrics)
+    exporter.add_pending(models.db.session, exporter.INGEST_METRICS, len(metrics))
+    return metrics
+
+
+def unique_metrics(metrics):
+    """
+    Keep the first metric of each name, a livestate having one metric per name
+    :param metrics: list of (name, value, metric_type_id) tuples
+    :return: list of (name, value, metric_type_id) tuples
+    """
+    names = set()
+    unique = []
+    for metric in metrics:
+        if metric[0] not in names:
+            names.add(metric[0])
+            unique.append(metric)
+    return unique
+
+
+def insert_livestates(rec_parent, livestates):
+    """
+    Insert Livestates in DB for an parent entity
+    :param rec_parent: models.Entity (Host or Service) with its id, or its entityconfig.EntityConfig
+    :param livestates: list of dict. The livestates to insert
+    :return: Nothing
+    """
+    # current_app.logger.debug(livestates)
+    for livestate in livestates:
+        timestamp = livestate.get('timestamp', dt.datetime.now().timestamp())
+        state = livestate.get('state')
+        output = livestate.get('output')
+        long_output = livestate.get('long_output')
+
+        rec_livestate = models.Livestate(
+            timestamp=dt.datetime.fromtimestamp(timestamp),
+            output=output,
+            long_output=long_output,
+            entity_id=rec_parent.id,
+            state_id=state_id(state),
+            is_acknowledged=rec_parent.is_auto_acknowledge
+        )
+        # Metric create
+        metrics = livestate_metrics(livestate)
+        if metrics:
+            insert_metrics(rec_livestate=rec_livestate, metrics=metrics)
+
+        models.db.session.add(rec_livestate)  # Not appended to rec_parent.livestates, that would load them all
+
+
+def insert_metrics(rec_livestate, metrics):
+    """
+    Insert Metrics in DB
+    :param rec_livestate: models.Livestate. A Livestate record
+    :param metrics: list of (name, value, metric_type_id) tuples (see livestate_metrics)
+    :return: Nothing
+    """
+    for name, value, metric_type_id in metrics:
+        rec_metric = models.Metric(
+            timestamp=rec_livestate.timestamp,
+            name=name,
+            value=value,
+            metric_type_id=metric_type_id
+        )
+        rec_livestate.metrics.append(rec_metric)
+        models.db.session.add(rec_metric)
+
+
+def livestate_rows(entity_id, is_acknowledged, livestates):
+    """
+    Build the plain row mappings of livestates and their metrics
+    :param entity_id: int. The livestates entity id
+    :param is_acknowledged: bool. The entity is_auto_acknowledge flag
+    :param livestates: list of dict. The livestates, as received
+    :return: list of (livestate row, list of metric rows) tuples. Metric rows lack their livestate_id
+    """
+    rows = []
+    for livestate in livestates:
+        timestamp = dt.datetime.fromtimestamp(livestate.get('timestamp', dt.datetime.now().timestamp()))
+        livestate_row = {
+            'entity_id': entity_id,
+            'state_id': state_id(livestate.get('state')),
+            'timestamp': timestamp,
+            'output': livestate.get('output'),
+            'long_output': livestate.get('long_output'),
+            'is_acknowledged': is_acknowledged,
+        }
+        metric_rows = [{'timestamp': timestamp, 'name': name, 'value': value, 'metric_type_id': metric_type_id}
+                       for name, value, metric_type_id in livestate_metrics(livestate)]
+        rows.append((livestate_row, metric_rows))
+    return rows
+
+
+def bulk_insert_livestates(items):
+    """
+    Insert livestates and metrics of several entities as plain rows, bypassing the ORM unit of work.
+    Livestates ids are only fetched for the livestates having metrics.
+    :param items: list of (models.Entity, list of dict) tuples
+    :return: Nothing
+    """
+    models.db.session.flush()  # New entities need their ids
+    rows = []
+    for rec_entity, livestates in items:
+        rows.extend(livestate_rows(rec_entity.id, rec_entity.is_auto_acknowledge, livestates))
+    if rows:
+        write_rows(models.db.session.connection(), rows)
+
+
+def write_rows(connection, rows):
+    """
+    Write livestates and metrics rows built by livestate_rows. The rows conflicting with stored ones (same
+    entity and timestamp, same livestate and metric name) are ignored, with the metrics of the ignored livestates
+    :param connection: sqlalchemy.engine.Connection. The connection, in the current transaction
+    :param rows: list of (livestate row, list of metric rows) tuples
+    :return: Nothing
+    """
+    livestate_table = models.Livestate.__table__
+    metric_table = models.Metric.__table__
+    postgresql = connection.dialect.name == 'postgresql'
+
+    without_metrics = [livestate_row for livestate_row, metric_rows in rows if not metric_rows]
+    with_metrics = [(livestate_row, metric_rows) for livestate_row, metric_rows in rows if metric_rows]
+
+    if postgresql and with_metrics:  # Take the ids from the sequence beforehand, so all rows can be sent at once
+        ids = next_ids(connection, livestate_table, len(with_metrics))
+        for livestate_id, (livestate_row, metric_rows) in zip(ids, with_metrics):
+            livestate_row['id'] = livestate_id
+        inserted = set()
+        for i in range(0, len(with_metrics), 1000):
+            statement = postgresql_insert(livestate_table).values(
+                [livestate_row for livestate_row, _ in with_metrics[i:i + 1000]])
+            inserted.update(row[0] for row in connection.execute(
+                statement.on_conflict_do_nothing().returning(livestate_table.c.id)))
+        with_metrics = [item for item in with_metrics if item[0]['id'] in inserted]
+    else:
+        inserted = []
+        for livestate_row, metric_rows in with_metrics:
+            result = connection.execute(insert_ignore(connection, livestate_table), livestate_row)
+            if result.rowcount:
+                livestate_row['id'] = result.inserted_primary_key[0]
+                inserted.append((livestate_row, metric_rows))
+        with_metrics = inserted
+    insert_rows(connection, livestate_table, without_metrics, ignore_conflicts=True)
+
+    all_metric_rows = []
+    for livestate_row, metric_rows in with_metrics:
+        for metric_row in metric_rows:
+            metric_row['livestate_id'] = livestate_row['id']
+        all_metric_rows.extend(metric_rows)
+    insert_rows(connection, metric_table, all_metric_rows, ignore_conflicts=True)
+
+
+def update_current_livestates(items):
+    """
+    Upsert the current_livestate row of each entity with its latest received livestate
+    :param items: list of (models.Entity, list of dict) tuples
+    :return: Nothing
+    """
+    models.db.session.flush()  # New entities need their ids
+    rows = {}
+    for rec_entity, livestates in items:
+        for livestate in livestates:
+            timestamp = dt.datetime.fromtimestamp(livestate.get('timestamp', dt.datetime.now().timestamp()))
+            current = rows.get(rec_entity.id)
+            if current is None or current['timestamp'] <= timestamp:
+                rows[rec_entity.id] = {
+                    'entity_id': rec_entity.id,
+                    'state_id': state_id(livestate.get('state')),
+                    'timestamp': timestamp,
+                    'output': livestate.get('output'),
+                    'is_acknowledged': rec_entity.is_auto_acknowledge,
+                }
+    if rows:
+        upsert_current_livestates(models.db.session.connection(), list(rows.values()))
+
+
+def upsert_current_livestates(connection, rows):
+    """
+    Insert or update current_livestate rows, unless the stored livestate is more recent.
+    A single INSERT ... ON CONFLICT on PostgreSQL, a SELECT then UPDATEs/INSERT elsewhere
+    :param connection: sqlalchemy.engine.Connection
+    :param rows: list of dict. One row per entity
+    :return: Nothing
+    """
+    table = models.CurrentLivestate.__table__
+    if connection.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.entity_id],
+            set_={column: statement.excluded[column] for column in ('state_id', 'timestamp', 'output',
+                                                                      'is_acknowledged')},
+            where=table.c.timestamp <= statement.excluded.timestamp
+        )
+        connection.execute(statement)
+        return
+
+    stored = {}
+    entity_ids = [row['entity_id'] for row in rows]
+    for i in range(0, len(entity_ids), 500):
+        query = models.db.select([table.c.entity_id, table.c.timestamp]).where(
+            table.c.entity_id.in_(entity_ids[i:i + 500]))
+        stored.update(connection.execute(query).fetchall())
+    updates = [dict(row, _entity_id=row['entity_id']) for row in rows
+               if row['entity_id'] in stored and stored[row['entity_id']] <= row['timestamp']]
+    inserts = [row for row in rows if row['entity_id'] not in stored]
+    if updates:
+        connection.execute(
+            table.update().where(table.c.entity_id == models.db.bindparam('_entity_id')),
+            updates
+        )
+    if inserts:
+        connection.execute(table.insert(), inserts)
+
+
+def next_ids(connection, table, count):
+    """
+    Reserve `count` ids from the PostgreSQL sequence of a table primary key
+    :return: list of int
+    """
+    sequence = '{0}_id_seq'.format(table.name)
+    result = connection.execute(
+        models.db.text("SELECT nextval(:sequence) FROM generate_series(1, :count)"),
+        sequence=sequence, count=count
+    )
+    return [row[0] for row in result]
+
+
+def insert_rows(connection, table, rows, chunk_size=1000, ignore_conflicts=False):
+    """
+    Insert plain rows in a table: COPY (if INGEST_COPY) or multi-row INSERTs on PostgreSQL, executemany elsewhere
+    :param connection: sqlalchemy.engine.Connection
+    :param table: sqlalchemy.Table
+    :param rows: list of dict. All the rows must have the same keys
+    :param chunk_size: int. Rows per multi-row INSERT statement
+    :param ignore_conflicts: bool. Skip the rows violating a unique constraint instead of failing
+    :return: Nothing
+    """
+    if not rows:
+        return
+    if connection.dialect.name != 'postgresql':
+        connection.execute(insert_ignore(connection, table) if ignore_conflicts else table.insert(), rows)
+    elif current_app.config.get('INGEST_COPY', True):
+        copy_rows(connection, table, rows, ignore_conflicts=ignore_conflicts)
+    else:
+        for i in range(0, len(rows), chunk_size):
+            statement = postgresql_insert(table).values(rows[i:i + chunk_size])
+            connection.execute(statement.on_conflict_do_nothing() if ignore_conflicts else statement)
+
+
+def insert_ignore(connection, table):
+    """
+    :return: An INSERT statement skipping the rows violating a unique constraint, for the connection dialect
+    """
+    if connection.dialect.name == 'postgresql':
+        return postgresql_insert(table).on_conflict_do_nothing()
+    if connection.dialect.name == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    if connection.dialect.name == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
+
+
+def copy_rows(connection, table, rows, ignore_conflicts=False):
+    """
+    Insert plain rows with PostgreSQL COPY FROM STDIN (text format). COPY can't skip conflicting rows: with
+    ignore_conflicts, they are copied to a temporary staging table, then moved with INSERT ... ON CONFLICT
+    """
+    columns = list(rows[0].keys())
+    target = table.name
+    if ignore_conflicts:
+        target = '{0}_staging'.format(table.name)
+        connection.execute(models.db.text(
+            'CREATE TEMPORARY TABLE IF NOT EXISTS "{0}" (LIKE "{1}" INCLUDING DEFAULTS) ON COMMIT DROP'.format(
+                target, table.name)))
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(row[column]) for column in columns))
+        buffer.write('\n')
+    buffer.seek(0)
+    names = ', '.join('"{0}"'.format(column) for column in columns)
+    statement = 'COPY "{0}" ({1}) FROM STDIN'.format(target, names)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    finally:
+        cursor.close()
+    if ignore_conflicts:
+        connection.execute(models.db.text(
+            'INSERT INTO "{0}" ({1}) SELECT {1} FROM "{2}" ON CONFLICT DO NOTHING'.format(table.name, names, target)))
+        connection.execute(models.db.text('TRUNCATE "{0}"'.format(target)))
+
+
+def copy_value(value):
+    """
+    Format a python value for the COPY text format
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, dt.datetime):
+        return value.isoformat(' ')
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
@@ -0,0 +1,206 @@
+"""
+Per request SQL and timing instrumentation
+
+Each request counts its SQL statements and their cumulative time (engine events), and the time spent in
+named phases (see `phase`, phases may nest). The measures are:
+    - sent back in a Server-Timing header in debug mode (or if SERVER_TIMING is set)
+    - aggregated into per endpoint histograms, served at /_internal/timings
+    - logged with the statements breakdown when the request lasts more than SLOW_REQUEST_THRESHOLD seconds
+"""
+
+import time
+import bisect
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+EXTENSION_KEY = 'pamose_instrumentation'
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds, +Inf implied
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SLOW_STATEMENTS = 5  # Statements detailed in the slow requests log
+
+
+class RequestTimings(object):
+    """
+    The measures of the current request
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.phases = OrderedDict()  # name -> seconds
+        self.statements = {}  # SQL text -> [count, seconds]
+
+    def add_query(self, statement, elapsed):
+        self.queries += 1
+        self.sql_time += elapsed
+        entry = self.statements.get(statement)
+        if entry is None:
+            self.statements[statement] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def add_phase(self, name, elapsed):
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def server_timing(self, total):
+        """
+        :return: str. The Server-Timing header value (durations in milliseconds)
+        """
+        metrics = ['sql;dur={0:.2f};desc="{1} queries"'.format(self.sql_time * 1000, self.queries)]
+        metrics.extend('{0};dur={1:.2f}'.format(name, elapsed * 1000) for name, elapsed in self.phases.items())
+        metrics.append('total;dur={0:.2f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+    def slowest_statements(self, count=SLOW_STATEMENTS):
+        """
+        :return: list of (SQL text, executions, seconds), slowest first
+        """
+        statements = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:count]
+        return [(statement, executions, elapsed) for statement, (executions, elapsed) in statements]
+
+
+class Histogram(object):
+    """
+    Cumulative distribution of observed values over fixed buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one for the values above all the buckets
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        cumulative, buckets = 0, OrderedDict()
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class Histograms(object):
+    """
+    Per endpoint histograms of the requests durations, SQL time and queries, and phases durations
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}  # endpoint -> {measure name -> Histogram}
+
+    def observe(self, endpoint, timings, total):
+        with self.lock:
+            histograms = self.endpoints.setdefault(endpoint, {})
+            values = [('total', total), ('sql', timings.sql_time)] + list(timings.phases.items())
+            for name, value in values:
+                histogram = histograms.get(name)
+                if histogram is None:
+                    histogram = histograms[name] = Histogram()
+                histogram.observe(value)
+            histogram = histograms.get('queries')
+            if histogram is None:
+                histogram = histograms['queries'] = Histogram(QUERIES_BUCKETS)
+            histogram.observe(timings.queries)
+
+    def as_dict(self):
+        with self.lock:
+            return dict((endpoint, dict((name, histogram.as_dict()) for name, histogram in histograms.items()))
+                        for endpoint, histograms in self.endpoints.items())
+
+
+def current_timings():
+    """
+    :return: RequestTimings of the current request, or None outside of an instrumented request
+    """
+    if not has_request_context():
+        return None
+    return g.get('timings')
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a block of code as a named phase of the current request. A no-op outside of a request.
+    Entered several times in the same request, a phase accumulates.
+    """
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add_phase(name, time.perf_counter() - start)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_timings() is not None:
+        conn.info.setdefault('pamose_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = current_timings()
+    starts = conn.info.get('pamose_query_start')
+    if timings is not None and starts:
+        timings.add_query(statement, time.perf_counter() - starts.pop())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('pamose_query_start'):
+        connection.info['pamose_query_start'].pop()
+
+
+def register(app):
+    if not app.config.get('INSTRUMENTATION', True):
+        return
+    app.extensions[EXTENSION_KEY] = Histograms()
+
+    @app.before_request
+    def start_timings():
+        g.timings = RequestTimings()
+
+    @app.after_request
+    def stop_timings(response):
+        timings = g.get('timings')
+        if timings is None:
+            return response
+        total = time.perf_counter() - timings.start
+        config = current_app.config
+        server_timing = config.get('SERVER_TIMING')
+        if server_timing or (server_timing is None and current_app.debug):
+            response.headers['Server-Timing'] = timings.server_timing(total)
+        current_app.extensions[EXTENSION_KEY].observe(request.endpoint or 'unknown', timings, total)
+
+        threshold = config.get('SLOW_REQUEST_THRESHOLD')
+        if threshold is not None and total >= threshold:
+            current_app.logger.warning(
+                "Slow request %s %s: %.3fs, %d queries in %.3fs, phases: %s, slowest statements:\n%s",
+                request.method, request.path, total, timings.queries, timings.sql_time,
+                ', '.join('{0} {1:.3f}s'.format(name, elapsed) for name, elapsed in timings.phases.items()),
+                '\n'.join('    {0:.3f}s x{1}: {2}'.format(elapsed, executions, ' '.join(statement.split())[:300])
+                          for statement, executions, elapsed in timings.slowest_statements()))
+        return response
+
+
+def histograms():
+    """
+    :return: dict. endpoint -> measure -> histogram, or None if the instrumentation is disabled
+    """
+    histograms = current_app.extensions.get(EXTENSION_KEY)
+    return histograms.as_dict() if histograms is not None else None
@@ -5,8 +5,7 @@ Database models definitions
 import datetime as dt
 from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from passlib.apps import custom_app_context as pwd_context
-from itsdangerous import (TimedJSONWebSignatureSerializer as Serializer, BadSignature, SignatureExpired)
+from sqlalchemy.ext.declarative import declared_attr
 
 
 db = SQLAlchemy()
@@ -46,44 +45,41 @@ class User(db.Model):
 
     def set_password_hash(self, password):
         """
-        Encrypt the provided password and store it in the db
+        Encrypt the provided password and store it in the db (see passwords.PasswordStore)
         :param password: str. The plain password to encrypt and store
         """
-        self.password_hash = pwd_context.encrypt(password)
+        self.password_hash = current_app.extensions['pamose_passwords'].context.hash(password)
 
     def verify_password(self, password):
         """
-        Compares the provided password with the stored and encrypted one
+        Compares the provided password with the stored and encrypted one (cached, see passwords.PasswordStore).
+        A hash with a deprecated scheme or settings is replaced, to be committed by the caller.
         :param password: str. The plain password to compare
         :return: bool. True if passwords match, else False
+        :raise passwords.PasswordsBusy: too many verifications running or waiting
         """
-        return pwd_context.verify(password, self.password_hash)
+        verified, new_hash = current_app.extensions['pamose_passwords'].verify(self.id, password, self.password_hash)
+        if new_hash:
+            self.password_hash = new_hash
+        return verified
 
     def new_token(self):
         """
         Returns a new serialized token, bassed on
-        app.SECRET_KEY and app.TOKEN_EXIRATION_TIME
+        app.SECRET_KEY and app.TOKEN_EXIRATION_TIME (see tokens.TokenStore)
 
         :return: str. the serialized new token with the user's id in it
         """
-        s = Serializer(current_app.config['SECRET_KEY'], expires_in=current_app.config['TOKEN_EXPIRATION_TIME'])
-        token = s.dumps({'id': self.id})
-        return token
+        return current_app.extensions['pamose_tokens'].serializer.dumps({'id': self.id})
 
     @staticmethod
     def verify_token(token):
         """
-        Verifies the provided token.
+        Verifies the provided token (cached, see tokens.TokenStore).
         :param token: str. the token to verify
         :return: bool. True if the token is ok, else False
         """
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except (SignatureExpired, BadSignature):
-            return False
-        user = User.query.get(data['id'])
-        return user is not None
+        return current_app.extensions['pamose_tokens'].verify(token) is not None
 
 
 class UserGroup(db.Model):
@@ -132,6 +128,7 @@ class Entity(db.Model):
     # parent = db.relationship("Entity", remote_side=[id])
     childs = db.relationship("Entity", backref=db.backref('parent', remote_side=[id]))
     livestates = db.relationship('Livestate', backref='entity', lazy=True)
+    current_livestate = db.relationship('CurrentLivestate', backref='entity', uselist=False, lazy=True)
     is_auto_acknowledge = db.Column(db.Boolean, nullable=False, default=False)
     is_template = db.Column(db.Boolean, nullable=False, default=False)
     is_monitored = db.Column(db.Boolean, nullable=False, default=False)
@@ -186,24 +183,44 @@ class Livestate(db.Model):
     For storing entities livestates
     """
     __tablename__ = 'livestate'
+    __table_args__ = (
+        db.UniqueConstraint('entity_id', 'timestamp', name='uq_livestate_entity_id_timestamp'),  # Idempotent ingest
+    )
     id = db.Column(db.Integer, primary_key=True)
     entity_id = db.Column(db.Integer, db.ForeignKey('entity.id'))
     state_id = db.Column(db.Integer, db.ForeignKey('state.id'))
     state = db.relationship('State', backref='livestates', lazy=True)
-    timestamp = db.Column(db.DateTime, default=dt.datetime.now())
+    timestamp = db.Column(db.DateTime, default=dt.datetime.now(), index=True)  # Partition key (see partitions)
     output = db.Column(db.String, unique=False, nullable=True)
     long_output = db.Column(db.String, unique=False, nullable=True)
     is_acknowledged = db.Column(db.Boolean, default=False, nullable=False)
     metrics = db.relationship('Metric', backref='livestate', lazy=True)
 
 
+class CurrentLivestate(db.Model):
+    """
+    Latest livestate of each entity, upserted at ingestion (livestate keeps the whole history)
+    """
+    __tablename__ = 'current_livestate'
+    entity_id = db.Column(db.Integer, db.ForeignKey('entity.id'), primary_key=True)
+    state_id = db.Column(db.Integer, db.ForeignKey('state.id'))
+    state = db.relationship('State', lazy=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    output = db.Column(db.String, unique=False, nullable=True)
+    is_acknowledged = db.Column(db.Boolean, default=False, nullable=False)
+
+
 class Metric(db.Model):
     """
     For storing livestates metrics
     """
     __tablename__ = 'metric'
+    __table_args__ = (
+        # Idempotent ingest, and the series of an entity (see rollups)
+        db.UniqueConstraint('livestate_id', 'name', name='uq_metric_livestate_id_name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=dt.datetime.now())
+    timestamp = db.Column(db.DateTime, default=dt.datetime.now(), index=True)  # Partition key (see partitions)
     name = db.Column(db.String, unique=False, nullable=False)
     value = db.Column(db.Float, unique=False, nullable=True)
     livestate_id = db.Column(db.Integer, db.ForeignKey('livestate.id'))
@@ -221,6 +238,59 @@ class MetricType(db.Model):
     description = db.Column(db.String, unique=False, nullable=True)
 
 
+class RollupMixin(object):
+    """
+    Metrics aggregated per (entity, metric name, time bucket), see rollups.
+    For cumulative metrics the aggregates are computed on rates (per second) and `last` is the last counter value
+    """
+    @declared_attr
+    def entity_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('entity.id'), primary_key=True)
+
+    name = db.Column(db.String, primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)  # Bucket start
+    count = db.Column(db.Integer, nullable=False)
+    sum = db.Column(db.Float, nullable=False)
+    min = db.Column(db.Float, nullable=False)
+    max = db.Column(db.Float, nullable=False)
+    last = db.Column(db.Float, nullable=True)  # Last raw value of the bucket
+    last_timestamp = db.Column(db.DateTime, nullable=True)
+
+
+class MetricRollupMinute(RollupMixin, db.Model):
+    """
+    Metrics aggregated by minute
+    """
+    __tablename__ = 'metric_rollup_1m'
+
+
+class MetricRollupHour(RollupMixin, db.Model):
+    """
+    Metrics aggregated by hour
+    """
+    __tablename__ = 'metric_rollup_1h'
+
+
+class MetricRollupDay(RollupMixin, db.Model):
+    """
+    Metrics aggregated by day
+    """
+    __tablename__ = 'metric_rollup_1d'
+
+
+class RollupState(db.Model):
+    """
+    Rollups high-water mark: the last aggregated metric id, and the highest one safe to aggregate (see
+    rollups.advance_safe_id)
+    """
+    __tablename__ = 'rollup_state'
+    name = db.Column(db.String, primary_key=True)
+    last_metric_id = db.Column(db.Integer, nullable=False, default=0)
+    safe_metric_id = db.Column(db.Integer, nullable=False, default=0)  # No transaction writing lower ids left
+    seen_metric_id = db.Column(db.Integer, nullable=True)  # The highest metric id at seen_at
+    seen_at = db.Column(db.DateTime, nullable=True)
+
+
 INITIAL_TABLES = {
     MetricType: [
         {'name': 'raw', 'description': 'Valeur indépendante et fluctuante'},
@@ -253,6 +323,7 @@ INITIAL_TABLES = {
         {'name': 'KO', 'severity_id': 3},
         {'name': 'WARNING', 'severity_id': 2},
         {'name': 'CRITICAL', 'severity_id': 3},
+        {'name': 'EXPIRED', 'severity_id': 2},
     ],
     Right: [
         {'name': 'create'},
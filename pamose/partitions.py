@@ -0,0 +1,264 @@
+"""
+Time partitioning and retention of the livestate and metric history tables
+
+With PARTITIONING set to 'daily' or 'weekly' on PostgreSQL, livestate and metric are created by `initdb` as
+native range partitioned tables on their timestamp (plus a DEFAULT partition catching out of range rows).
+Partitions are created ahead of time (PARTITIONS_AHEAD days) by `pamose retention`, to run daily at least:
+the ingest path never runs DDL, rows outside the existing partitions land in the DEFAULT one. They are moved
+to their partition when it is created. Retention drops whole expired partitions, and DELETEs the expired rows
+of the DEFAULT ones. Elsewhere (SQLite, ...) the tables are plain ones and retention DELETEs.
+"""
+
+import re
+import threading
+import datetime as dt
+
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import models
+
+PARTITIONED_TABLES = ('livestate', 'metric')
+PARTITION_KEY = 'timestamp'
+PERIODS = {'daily': dt.timedelta(days=1), 'weekly': dt.timedelta(weeks=1)}
+
+_BOUNDS_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+_known = set()  # (table name, partition start) already created, for this process
+_failed = set()  # (table name, partition start) whose creation failed, not retried by `ensure`
+_known_lock = threading.Lock()
+
+
+def enabled(bind=None):
+    """
+    :param bind: sqlalchemy Engine or Connection, default to the application engine
+    :return: bool. True if the history tables are (to be) partitioned
+    """
+    bind = models.db.engine if bind is None else bind
+    return current_app.config.get('PARTITIONING') in PERIODS and bind.dialect.name == 'postgresql'
+
+
+def period_start(timestamp):
+    """
+    :param timestamp: datetime.datetime
+    :return: datetime.datetime. The start of the partition holding this timestamp
+    """
+    start = dt.datetime.combine(timestamp.date(), dt.time())
+    if current_app.config['PARTITIONING'] == 'weekly':
+        start -= dt.timedelta(days=start.weekday())
+    return start
+
+
+def create_all():
+    """
+    Create all the tables, the history ones being partitioned if enabled
+    """
+    if not enabled():
+        models.db.create_all()
+        return
+    metadata = models.db.Model.metadata
+    with models.db.engine.begin() as connection:
+        metadata.create_all(bind=connection,
+                            tables=[table for table in metadata.sorted_tables if table.name not in PARTITIONED_TABLES])
+        for name in PARTITIONED_TABLES:
+            create_partitioned_table(connection, metadata.tables[name])
+    today = dt.datetime.now()
+    ensure_partitions(today - PERIODS[current_app.config['PARTITIONING']], today + ahead())
+
+
+def create_partitioned_table(connection, table):
+    """
+    Create a range partitioned table from a model table (PostgreSQL). The primary key and the unique
+    constraints get the partition key, and foreign keys to partitioned tables are left out.
+    """
+    if connection.dialect.has_table(connection, table.name):
+        return
+    lines = []
+    for column in table.columns:
+        if column.name == 'id':
+            lines.append('id SERIAL NOT NULL')
+            continue
+        line = '"{0}" {1}'.format(column.name, column.type.compile(dialect=connection.dialect))
+        if not column.nullable or column.name == PARTITION_KEY:
+            line += ' NOT NULL'
+        for foreign_key in column.foreign_keys:
+            if foreign_key.column.table.name not in PARTITIONED_TABLES:
+                line += ' REFERENCES "{0}" ("{1}")'.format(foreign_key.column.table.name, foreign_key.column.name)
+        lines.append(line)
+    lines.append('PRIMARY KEY (id, "{0}")'.format(PARTITION_KEY))
+    for constraint in table.constraints:
+        if isinstance(constraint, models.db.UniqueConstraint):
+            columns = [column.name for column in constraint.columns]
+            if PARTITION_KEY not in columns:
+                columns.append(PARTITION_KEY)
+            lines.append('UNIQUE ({0})'.format(', '.join('"{0}"'.format(column) for column in columns)))
+
+    connection.execute(models.db.text('CREATE TABLE "{0}" (\n    {1}\n) PARTITION BY RANGE ("{2}")'.format(
+        table.name, ',\n    '.join(lines), PARTITION_KEY)))
+    for index in table.indexes:
+        index.create(bind=connection)
+    connection.execute(models.db.text('CREATE TABLE "{0}_default" PARTITION OF "{0}" DEFAULT'.format(table.name)))
+
+
+def ahead():
+    """
+    :return: datetime.timedelta. How far in the future partitions are created
+    """
+    return dt.timedelta(days=current_app.config.get('PARTITIONS_AHEAD', 7))
+
+
+def ensure_partitions(start, end):
+    """
+    Create the missing partitions of the history tables between two datetimes, in their own transaction
+    :return: list of str. The created partitions names
+    """
+    period = PERIODS[current_app.config['PARTITIONING']]
+    starts = []
+    current = period_start(start)
+    while current < end:
+        starts.append(current)
+        current += period
+    return ensure(starts, retry_failed=True)
+
+
+def ensure(timestamps, retry_failed=False):
+    """
+    Make sure the partitions holding the given timestamps exist, each in its own transaction on its own
+    connection. The DDL locks the parent tables: never call it while the session holds locks on them (after
+    writing livestates or metrics in the current transaction), it would wait for itself. Cheap when the
+    partitions are already known by this process.
+    :param timestamps: iterable of datetime.datetime
+    :param retry_failed: bool. Try again the partitions whose creation failed in this process (lock timeout,
+        ...)
+    :return: list of str. The created partitions names
+    """
+    period = PERIODS[current_app.config['PARTITIONING']]
+    starts = set(period_start(timestamp) for timestamp in timestamps)
+    missing = [(table, start) for table in PARTITIONED_TABLES for start in starts
+               if (table, start) not in _known and (retry_failed or (table, start) not in _failed)]
+    if not missing:
+        return []
+
+    created = []
+    with models.db.engine.connect() as connection:
+        if not _known:
+            _load_known(connection)
+        for table, start in missing:
+            if (table, start) in _known:
+                continue
+            name = '{0}_p{1:%Y%m%d}'.format(table, start)
+            try:
+                with connection.begin():
+                    create_partition(connection, table, name, start, start + period)
+            except SQLAlchemyError as e:  # Concurrently created, overlapping bounds, ...
+                current_app.logger.warning("Partition %s not created: %s", name, e)
+                with _known_lock:
+                    _failed.add((table, start))
+                continue
+            created.append(name)
+            with _known_lock:
+                _known.add((table, start))
+                _failed.discard((table, start))
+    if created:
+        current_app.logger.info("Partitions created: %s", ', '.join(created))
+    return created
+
+
+def create_partition(connection, table, name, start, end):
+    """
+    Create a range partition, in the current transaction. The rows of its range already in the DEFAULT
+    partition (inserted before it existed) are moved to it: the DEFAULT partition is detached meanwhile,
+    PostgreSQL refusing the new partition otherwise.
+    :param table: str. The partitioned table name
+    :param name: str. The partition name
+    :param start: datetime.datetime
+    :param end: datetime.datetime
+    """
+    params = {'start': start, 'end': end}
+    default = '{0}_default'.format(table)
+    in_default = connection.execute(models.db.text(
+        'SELECT EXISTS (SELECT 1 FROM "{0}" WHERE "{1}" >= :start AND "{1}" < :end)'.format(
+            default, PARTITION_KEY)), **params).scalar()
+    if in_default:
+        connection.execute(models.db.text('ALTER TABLE "{0}" DETACH PARTITION "{1}"'.format(table, default)))
+    connection.execute(models.db.text(
+        'CREATE TABLE IF NOT EXISTS "{0}" PARTITION OF "{1}" FOR VALUES FROM (\'{2}\') TO (\'{3}\')'.format(
+            name, table, start.isoformat(' '), end.isoformat(' '))))
+    if in_default:
+        result = connection.execute(models.db.text(
+            'WITH moved AS (DELETE FROM "{0}" WHERE "{2}" >= :start AND "{2}" < :end RETURNING *) '
+            'INSERT INTO "{1}" SELECT * FROM moved'.format(default, name, PARTITION_KEY)), **params)
+        connection.execute(models.db.text('ALTER TABLE "{0}" ATTACH PARTITION "{1}" DEFAULT'.format(table, default)))
+        current_app.logger.warning("%s rows moved from %s to the new partition %s", result.rowcount, default, name)
+
+
+def default_rows():
+    """
+    The DEFAULT partitions holding rows (outside the range partitions, their partition missing when they
+    were written, or out of the partitioned range)
+    :return: list of str. Their names
+    """
+    names = []
+    with models.db.engine.connect() as connection:
+        for table in PARTITIONED_TABLES:
+            default = '{0}_default'.format(table)
+            if connection.execute(models.db.text('SELECT EXISTS (SELECT 1 FROM "{0}")'.format(default))).scalar():
+                names.append(default)
+    return names
+
+
+def _load_known(connection):
+    for table in PARTITIONED_TABLES:
+        for _, start, _ in list_partitions(connection, table):
+            with _known_lock:
+                _known.add((table, start))
+
+
+def list_partitions(connection, table):
+    """
+    The range partitions of a partitioned table (the DEFAULT one excluded)
+    :return: list of (name, start datetime, end datetime) tuples, sorted by start
+    """
+    rows = connection.execute(models.db.text(
+        "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+        "FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :table"), table=table)
+    partitions = []
+    for name, bounds in rows:
+        match = _BOUNDS_RE.search(bounds or '')
+        if match:
+            partitions.append((name, dt.datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S'),
+                               dt.datetime.strptime(match.group(2), '%Y-%m-%d %H:%M:%S')))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def purge(before):
+    """
+    Remove the livestates and metrics older than a datetime: drop the expired partitions if the tables
+    are partitioned (only whole partitions, ending before the cutoff) and DELETE the expired rows of the
+    DEFAULT partitions, DELETE the rows otherwise
+    :param before: datetime.datetime. The cutoff
+    :return: list of str. What was dropped/deleted, for display
+    """
+    results = []
+    with models.db.engine.begin() as connection:
+        if enabled(connection):
+            for table in PARTITIONED_TABLES:
+                for name, start, end in list_partitions(connection, table):
+                    if end <= before:
+                        connection.execute(models.db.text('DROP TABLE "{0}"'.format(name)))
+                        with _known_lock:
+                            _known.discard((table, start))
+                        results.append('dropped partition {0}'.format(name))
+            for name in reversed(PARTITIONED_TABLES):
+                result = connection.execute(models.db.text('DELETE FROM "{0}_default" WHERE "{1}" < :before'.format(
+                    name, PARTITION_KEY)), before=before)
+                results.append('deleted {0} rows from {1}_default'.format(result.rowcount, name))
+        else:
+            for name in reversed(PARTITIONED_TABLES):  # Metrics first, they reference livestates
+                table = models.db.Model.metadata.tables[name]
+                result = connection.execute(table.delete().where(table.c[PARTITION_KEY] < before))
+                results.append('deleted {0} rows from {1}'.format(result.rowcount, name))
+    return results
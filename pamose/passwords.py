@@ -0,0 +1,195 @@
+"""
+Users passwords hashing and verification, and login rate limiting
+
+Passwords are hashed with the first of the PASSWORD_SCHEMES (passlib schemes, tuned by the
+PASSWORD_CONTEXT_OPTIONS CryptContext options). A password hashed with another scheme, or with settings
+below the current ones, is rehashed when its user logs in.
+
+Hash verifications are CPU bound: they run in a pool of PASSWORD_WORKERS threads ('thread'), or processes
+('process', verifying in parallel despite the GIL), so a burst of logins can't take every request thread.
+Beyond PASSWORD_MAX_PENDING verifications running or waiting, logins get a 429. A successful verification
+is reused for PASSWORD_CACHE_TTL seconds, as long as the user's hash is unchanged (agents logging in again
+after a restart are only verified once).
+
+Logins are limited per client address (LOGIN_RATE_LIMIT attempts) and per user name (LOGIN_FAILURES_LIMIT
+failed attempts), per LOGIN_RATE_WINDOW seconds.
+"""
+
+import hmac
+import math
+import time
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from flask import current_app
+from passlib.context import CryptContext
+
+from .caches import TTLCache
+
+_contexts = {}  # CryptContext configuration -> CryptContext, per process
+
+
+class PasswordsBusy(Exception):
+    """
+    Too many hash verifications running or waiting
+    """
+
+
+def _verify_and_update(config, password, password_hash):
+    """
+    Verify a password, in a thread or process of the pool
+    :param config: str. The CryptContext configuration (CryptContext.to_string)
+    :return: (bool, str). Whether the password matches, and its new hash if it must be rehashed, else None
+    """
+    context = _contexts.get(config)
+    if context is None:
+        context = _contexts.setdefault(config, CryptContext.from_string(config))
+    return context.verify_and_update(password, password_hash)
+
+
+class RateLimiter(object):
+    """
+    Thread safe counters of attempts per key, over fixed windows
+    """
+
+    def __init__(self, limit, window, maxsize=100000):
+        """
+        :param limit: int. Attempts allowed per window
+        :param window: float. Window duration (seconds)
+        """
+        self.limit = limit
+        self.window = window
+        self.counters = TTLCache(maxsize=maxsize, ttl=window)  # key -> [attempts, window end monotonic time]
+        self.lock = threading.Lock()
+
+    def hit(self, key):
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = [0, time.monotonic() + self.window]
+                self.counters.set(key, counter)
+            counter[0] += 1
+
+    def retry_after(self, key):
+        """
+        :return: int. Seconds before key gets attempts again, 0 if it has some left
+        """
+        counter = self.counters.get(key)
+        if counter is None or counter[0] < self.limit:
+            return 0
+        return max(int(math.ceil(counter[1] - time.monotonic())), 1)
+
+
+class PasswordStore(object):
+    """
+    Hashes and verifies the users passwords, with one CryptContext, verification pool and cache per application
+    """
+    EXTENSION_KEY = 'pamose_passwords'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions[self.EXTENSION_KEY] = _Passwords(app)
+
+    @property
+    def _passwords(self):
+        return current_app.extensions[self.EXTENSION_KEY]
+
+    def hash(self, password):
+        """
+        :param password: str
+        :return: str. The hash of the password with the default scheme
+        """
+        return self._passwords.context.hash(password)
+
+    def verify(self, user_id, password, password_hash):
+        """
+        :param user_id: int
+        :param password: str. The plain password to verify
+        :param password_hash: str. The user's stored hash
+        :return: (bool, str). Whether the password matches, and its new hash if it must be rehashed, else None
+        :raise PasswordsBusy: too many verifications running or waiting
+        """
+        return self._passwords.verify(user_id, password, password_hash)
+
+    def login_retry_after(self, username, address):
+        """
+        Count a login attempt, unless it's over the limits
+        :param username: str
+        :param address: str. The client address
+        :return: int. Seconds before a new attempt is allowed, 0 if this one is
+        """
+        passwords = self._passwords
+        retry_after = max(passwords.addresses.retry_after(address) if passwords.addresses else 0,
+                          passwords.failures.retry_after(username) if passwords.failures else 0)
+        if not retry_after and passwords.addresses:
+            passwords.addresses.hit(address)
+        return retry_after
+
+    def login_failed(self, username):
+        """
+        Count a failed login of an user name
+        """
+        if self._passwords.failures:
+            self._passwords.failures.hit(username)
+
+
+class _Passwords(object):
+    """
+    The per application CryptContext, verification pool, verified passwords cache and login rate limiters
+    """
+
+    def __init__(self, app):
+        config = app.config
+        self.context = CryptContext(schemes=config.get('PASSWORD_SCHEMES', ['sha512_crypt', 'sha256_crypt']),
+                                    deprecated='auto', **config.get('PASSWORD_CONTEXT_OPTIONS', {}))
+        self.config = self.context.to_string()
+        self.secret = config['SECRET_KEY'].encode('UTF-8')
+        self.executor_type = config.get('PASSWORD_EXECUTOR', 'thread')
+        self.workers = config.get('PASSWORD_WORKERS', 2)
+        self.executor = None  # Created at first use, after the `pamose serve` workers are forked
+        self.executor_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(config.get('PASSWORD_MAX_PENDING', 32))
+        self.cache = TTLCache(maxsize=config.get('PASSWORD_CACHE_SIZE', 10000),
+                              ttl=config.get('PASSWORD_CACHE_TTL', 300))
+        window = config.get('LOGIN_RATE_WINDOW', 60)
+        self.addresses = RateLimiter(config['LOGIN_RATE_LIMIT'], window) if config.get('LOGIN_RATE_LIMIT') else None
+        self.failures = RateLimiter(config['LOGIN_FAILURES_LIMIT'], window) if config.get(
+            'LOGIN_FAILURES_LIMIT') else None
+
+    def _executor(self):
+        if self.executor is None:
+            with self.executor_lock:
+                if self.executor is None:
+                    if self.executor_type == 'process':  # Spawned: forking a threaded process isn't safe
+                        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                            mp_context=multiprocessing.get_context('spawn'))
+                    else:
+                        self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                           thread_name_prefix='pamose-passwords')
+        return self.executor
+
+    def verify(self, user_id, password, password_hash):
+        if not password_hash:
+            return False, None
+        digest = hmac.new(self.secret, password.encode('UTF-8'), hashlib.sha256).digest()  # No plain password kept
+        if self.cache.get((user_id, password_hash, digest)):
+            return True, None
+
+        if not self.slots.acquire(blocking=False):
+            raise PasswordsBusy('Too many logins in progress, retry later')
+        try:
+            verified, new_hash = self._executor().submit(_verify_and_update, self.config, password,
+                                                         password_hash).result()
+        finally:
+            self.slots.release()
+        if verified:
+            self.cache.set((user_id, new_hash or password_hash, digest), True)
+        return verified, new_hash
+
+
+passwords = PasswordStore()
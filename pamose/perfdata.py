@@ -0,0 +1,80 @@
+"""
+Nagios plugins performance data parser
+
+Grammar (https://nagios-plugins.org/doc/guidelines.html#AEN200), space separated:
+
+    'label'=value[UOM];[warn];[crit];[min];[max]
+
+    label: quoted with single quotes if it contains spaces or '=' (a quote inside is doubled)
+    value: a number, or 'U' if it can't be determined
+    UOM: optional unit of measure (s, ms, us, %, B, KB, MB, TB, c). 'c' is a continuous counter (cumulative)
+    warn, crit: optional threshold ranges, kept as strings ('10', '10:', '~:10', '@10:20', ...)
+    min, max: optional numbers
+"""
+
+import re
+from collections import namedtuple
+
+PerfData = namedtuple('PerfData', ['name', 'value', 'unit', 'warn', 'crit', 'min', 'max', 'cumulative'])
+
+_NUMBER = r"[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?"
+
+_METRIC_RE = re.compile(r"""
+    \s*
+    (?:'(?P<quoted>(?:[^']|'')+)'|(?P<label>[^'=\s][^=\s]*))
+    =
+    (?P<value>""" + _NUMBER + r"""|U)
+    (?P<unit>[a-zA-Z%]*)
+    (?:;(?P<warn>[^;\s]*)
+        (?:;(?P<crit>[^;\s]*)
+            (?:;(?P<min>[^;\s]*)
+                (?:;(?P<max>[^;\s]*))?
+            )?
+        )?
+    )?
+    ;*
+    (?=\s|$)
+""", re.VERBOSE)
+
+_TOKEN_END_RE = re.compile(r"\S*")
+
+
+def _to_float(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse(raw):
+    """
+    Parse a performance data string in a single pass
+    :param raw: str. The perf_data string
+    :return: list of PerfData. Malformed metrics are skipped
+    """
+    metrics = []
+    match = _METRIC_RE.match
+    position, length = 0, len(raw)
+    while position < length:
+        m = match(raw, position)
+        if m is None:
+            if raw[position].isspace():
+                position += 1
+            else:  # Skip the malformed token
+                position = _TOKEN_END_RE.match(raw, position).end()
+            continue
+        position = m.end()
+        quoted, label, value, unit, warn, crit, minimum, maximum = m.groups()
+        metrics.append(PerfData(
+            quoted.replace("''", "'") if quoted is not None else label,
+            None if value == 'U' else float(value),
+            unit or None,
+            warn or None,
+            crit or None,
+            _to_float(minimum),
+            _to_float(maximum),
+            unit == 'c',
+        ))
+    return metrics
@@ -0,0 +1,173 @@
+"""
+Database connection pool tuning and statistics
+
+The engine options (pool sizing, pre-ping, recycling, statement timeout) are built from the DB_* settings.
+Connections inherited through a fork (gunicorn --preload, ...) are never reused by the child process: they
+are detected on checkout and replaced by new ones, the parent's sockets being left untouched.
+
+With DB_PGBOUNCER set, pooling is left to PgBouncer (transaction pooling): no connection is kept open by
+the application and the statement timeout is set per transaction with SET LOCAL, session settings being
+unusable behind it.
+"""
+
+import os
+import time
+import threading
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, NullPool
+
+from . import models
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool counting the checkouts, the time spent waiting for a connection and the timeouts
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.checkouts = 0
+            self.waits = 0  # Checkouts which had to wait for a connection to be returned
+            self.wait_time = 0.0
+            self.max_wait_time = 0.0
+            self.timeouts = 0
+            self.forked = 0  # Inherited connections replaced after a fork
+
+    def _do_get(self):
+        waiting = self._pool.empty() and -1 < self._max_overflow <= self._overflow
+        started = time.monotonic()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                if waiting:
+                    self.waits += 1
+                self.wait_time += elapsed
+                self.max_wait_time = max(self.max_wait_time, elapsed)
+
+    def stats(self):
+        """
+        :return: dict. Pool occupancy and counters, times in seconds
+        """
+        with self._stats_lock:
+            return {
+                'size': self.size(),
+                'checked_in': self.checkedin(),
+                'checked_out': self.checkedout(),
+                'overflow': self.overflow(),
+                'max_overflow': self._max_overflow,
+                'timeout': self._timeout,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'avg_wait_time': self.wait_time / self.checkouts if self.checkouts else 0.0,
+                'max_wait_time': self.max_wait_time,
+                'timeouts': self.timeouts,
+                'forked': self.forked,
+            }
+
+
+@event.listens_for(TimedQueuePool, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(TimedQueuePool, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info['pid'] != os.getpid():  # Created by the parent process, before a fork
+        connection_record.connection = connection_proxy.connection = None  # Don't close the parent's socket
+        pool = connection_proxy._pool
+        with pool._stats_lock:
+            pool.forked += 1
+        raise exc.DisconnectionError('Connection created by process {0}, now in process {1}'.format(
+            connection_record.info['pid'], os.getpid()))
+
+
+@event.listens_for(Engine, 'begin')
+def _on_begin(connection):
+    if not has_app_context() or connection.dialect.name != 'postgresql':
+        return
+    config = current_app.config
+    if config.get('DB_PGBOUNCER') and config.get('DB_STATEMENT_TIMEOUT'):
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute('SET LOCAL statement_timeout = {0:d}'.format(int(config['DB_STATEMENT_TIMEOUT'])))
+        finally:
+            cursor.close()
+
+
+class ConnectionPool(object):
+    """
+    Engine options from the DB_* settings, and pool statistics
+    """
+    EXTENSION_KEY = 'pamose_pool'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        To be called after db.init_app. Options explicitly given in SQLALCHEMY_ENGINE_OPTIONS take precedence.
+        """
+        options = engine_options(app.config)
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+        app.extensions[self.EXTENSION_KEY] = self
+
+    def stats(self):
+        """
+        :return: dict. The application engine pool statistics
+        """
+        engine = models.db.engine
+        result = {'pool': type(engine.pool).__name__, 'pgbouncer': bool(current_app.config.get('DB_PGBOUNCER'))}
+        if isinstance(engine.pool, TimedQueuePool):
+            result.update(engine.pool.stats())
+        else:
+            result['status'] = engine.pool.status()
+        return result
+
+
+def engine_options(config):
+    """
+    The create_engine options for the configured database. SQLite is left to Flask-SQLAlchemy's defaults.
+    :param config: dict. The application configuration
+    :return: dict
+    """
+    url = make_url(config.get('SQLALCHEMY_DATABASE_URI') or 'sqlite://')
+    if url.drivername.startswith('sqlite'):
+        return {}
+
+    timeout = config.get('DB_STATEMENT_TIMEOUT')
+    if config.get('DB_PGBOUNCER'):
+        return {'poolclass': NullPool}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': config.get('DB_POOL_SIZE', 10),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 20),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', -1),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+    }
+    if timeout and url.get_backend_name() == 'postgresql' and url.get_driver_name() == 'psycopg2':
+        options['connect_args'] = {'options': '-c statement_timeout={0:d}'.format(int(timeout))}
+    return options
+
+
+pool = ConnectionPool()
@@ -0,0 +1,93 @@
+"""
+Read side queries
+"""
+
+from . import models
+
+MAX_DEPTH = 32  # Guards the recursive walk against a cycle in the entities tree
+
+
+def subtree(name):
+    """
+    An entity and all its descendants with their type, tags and current state (from current_livestate),
+    fetched in a single query walking the tree with a recursive CTE
+    :param name: str. The subtree root entity name
+    :return: list of dict, parents before their children. Empty if the entity doesn't exist
+    """
+    entity = models.Entity.__table__
+    child = entity.alias('child')
+    entity_type = models.EntityType.__table__
+    current = models.CurrentLivestate.__table__
+    state = models.State.__table__
+    severity = models.Severity.__table__
+    entity_tag = models.entity_tag_table
+    tag = models.Tag.__table__
+
+    tree = models.db.select([
+        entity.c.id, entity.c.parent_entity_id, models.db.literal(0).label('depth')
+    ]).where(entity.c.name == name).cte('tree', recursive=True)
+    tree = tree.union_all(models.db.select([
+        child.c.id, child.c.parent_entity_id, (tree.c.depth + 1).label('depth')
+    ]).where(child.c.parent_entity_id == tree.c.id).where(tree.c.depth < MAX_DEPTH))
+
+    query = models.db.select([
+        tree.c.id, tree.c.parent_entity_id, tree.c.depth, entity.c.name, entity.c.alias,
+        entity_type.c.name.label('entity_type'), state.c.name.label('state'), severity.c.value.label('severity'),
+        current.c.timestamp, current.c.output, current.c.is_acknowledged, tag.c.name.label('tag')
+    ]).select_from(
+        tree.join(entity, entity.c.id == tree.c.id)
+        .outerjoin(entity_type, entity_type.c.id == entity.c.entity_type_id)
+        .outerjoin(current, current.c.entity_id == entity.c.id)
+        .outerjoin(state, state.c.id == current.c.state_id)
+        .outerjoin(severity, severity.c.id == state.c.severity_id)
+        .outerjoin(entity_tag, entity_tag.c.entity_id == entity.c.id)
+        .outerjoin(tag, tag.c.id == entity_tag.c.tag_id)
+    ).order_by(tree.c.depth, tree.c.id)
+
+    nodes = {}
+    for row in models.db.session.execute(query):
+        node = nodes.get(row.id)
+        if node is None:
+            node = nodes[row.id] = {
+                'id': row.id,
+                'parent_id': row.parent_entity_id,
+                'depth': row.depth,
+                'name': row.name,
+                'alias': row.alias,
+                'entity_type': row.entity_type,
+                'tags': [],
+                'state': row.state,
+                'severity': row.severity,
+                'timestamp': row.timestamp.timestamp() if row.timestamp is not None else None,
+                'output': row.output,
+                'is_acknowledged': row.is_acknowledged,
+            }
+        if row.tag is not None:
+            node['tags'].append(row.tag)
+    return list(nodes.values())
+
+
+def build_tree(nodes):
+    """
+    Nest the subtree nodes and roll the severities up: each node gets the worst severity of its subtree
+    :param nodes: list of dict, see subtree
+    :return: dict. The root node, with its 'children' and 'worst_severity', or None if nodes is empty
+    """
+    if not nodes:
+        return None
+    by_id = {}
+    for node in nodes:
+        node['children'] = []
+        node['worst_severity'] = node['severity']
+        by_id[node['id']] = node
+    for node in reversed(nodes):  # Deepest first, so children are complete before their parent
+        parent = by_id.get(node['parent_id'])
+        if parent is None or node is nodes[0]:
+            continue
+        parent['children'].append(node)
+        if node['worst_severity'] is not None and (parent['worst_severity'] is None or
+                                                   node['worst_severity'] > parent['worst_severity']):
+            parent['worst_severity'] = node['worst_severity']
+    for node in nodes:
+        node['children'].reverse()  # Appended in reverse, back to the query order
+    return nodes[0]
@@ -2,12 +2,22 @@
 The publicly exposed ressources
 """
 
+import time
+import queue
 import datetime as dt
 
 from flask_httpauth import HTTPBasicAuth
-from flask import request, current_app, jsonify
+from flask import request, current_app, Response
 from flask.views import View, MethodView
-from . import models, schemas
+from sqlalchemy.exc import IntegrityError
+from . import models, queries, exporter, rollups, downsampling, serializers, formats
+from .ingest import validate_host, ingest_host, ingest_hosts, host_feedback, UnknownState
+from .writebehind import ingest_queue
+from .pool import pool
+from .events import events
+from .idempotency import idempotent, idempotency
+from .passwords import passwords, PasswordsBusy
+from .instrumentation import phase, histograms
 
 auth = HTTPBasicAuth()
 
@@ -65,12 +75,14 @@ def as_json(result=None, feedback=None, issues=None):
     if issues:
         response['_issues'] = issues
 
-    return jsonify(response)
+    return serializers.response(response)
 
 
 class LoginRessource(MethodView):
     """
     Used to returns a token from a username/password REST POST
+
+    Logins are rate limited per client address and per user name failures (429, see passwords)
     """
     def post(self):
         """
@@ -86,11 +98,22 @@ class LoginRessource(MethodView):
         if username is None or password is None:
             return as_json(issues='No enought data provided'), 400
 
+        retry_after = passwords.login_retry_after(username, request.remote_addr)
+        if retry_after:
+            return as_json(issues='Too many login attempts, retry later'), 429, {'Retry-After': str(retry_after)}
+
         user = models.User.query.filter_by(name=username).first()
-        if user is None or not user.verify_password(password=password):
+        try:
+            verified = user is not None and user.verify_password(password=password)
+        except PasswordsBusy as e:
+            return as_json(issues=str(e)), 429, {'Retry-After': '1'}
+        if not verified:
+            passwords.login_failed(username)
             return as_json(issues='Bad credentials'), 400
 
         token = user.new_token()
+        if models.db.session.is_modified(user):  # Rehashed
+            models.db.session.commit()
 
         return as_json(result=token.decode('UTF-8')), 200
 
@@ -137,142 +160,308 @@ class HostRessource(MethodView):
                 output: Simulated Service
                 perf_data: _PERFDATA_
 
+    The body may also be MessagePack (Content-Type: application/msgpack) and compressed (Content-Encoding:
+    gzip, deflate or zstd), and a livestate may give its metrics already parsed instead of a perf_data string:
+                metrics: [[_NAME_, _VALUE_], [_COUNTER_NAME_, _VALUE_, true]]  # [name, value, cumulative]
+    See the formats module. Unsupported formats get a 415.
+
+    A retried request carrying the same Idempotency-Key header gets the first answer back (see idempotency).
     """
-    decorators = [auth.login_required]
+    decorators = [idempotent, auth.login_required]
 
     def patch(self):
-        json_data = request.get_json()
+        try:
+            with phase('parse'):
+                json_data = formats.decode_host(request, current_app.config['INGEST_MAX_BODY_SIZE'])
+                issue = validate_host(json_data) if json_data else None
+        except formats.UnsupportedFormat as e:
+            return as_json(issues=str(e)), 415
+        except formats.BodyTooLarge as e:
+            return as_json(issues=str(e)), 413
+        except ValueError as e:
+            return as_json(issues='Malformed host data: {0}'.format(e)), 400
         if not json_data:
             return as_json(issues='No input data provided'), 400
+        if issue:
+            return as_json(issues=issue), 400
+
+        if ingest_queue.enabled:  # Write-behind: answer now, the writer thread commits later
+            try:
+                ingest_queue.put(json_data)
+            except queue.Full:
+                return as_json(issues='Ingest queue full, retry later'), 429, {'Retry-After': '1'}
+            idempotency.uncommitted()  # The writer thread may still drop it, the retries are written again
+            return as_json(feedback=ingest_queue.feedback(json_data)), 200
+
+        try:
+            rec_entity_host = ingest_host(json_data)
+            with phase('flush'):
+                models.db.session.flush()
+            feedback = host_feedback(rec_entity_host)  # Before the commit expires the host record
+            with phase('commit'):
+                models.db.session.commit()
+        except IntegrityError:  # The same livestates written concurrently (orm mode), a retry will skip them
+            models.db.session.rollback()
+            return as_json(issues='Concurrent duplicate submission, retry'), 409, {'Retry-After': '1'}
+        except UnknownState as e:  # Checked by validate_host, unless the State table changed meanwhile
+            models.db.session.rollback()
+            return as_json(issues=str(e)), 400
 
-        host_name = json_data.get('name')
-        is_monitored = json_data.get('passive_checks_enabled', False)
-
-        # Host get/create
-        rec_entity_host = models.Entity.query.filter_by(name=host_name).first()
-        if not rec_entity_host:  # Create it
-            # Realm get/create
-            template = json_data.get('template', None)  # TODO: Better solution for realm info retrieving
-            realm_name = template.get('_realm', None)
-            # host_templates = template.get('_templates', None)  # TODO: Define templates
-            rec_entity_realm = models.Entity.query.filter_by(name=realm_name).first()
-            if not rec_entity_realm:  # Create it
-                default_realm = models.Entity.query.get(0)
-                rec_entity_realm = models.Entity(name=realm_name,
-                                                 entity_type_id=models.EntityType.query.filter_by(
-                                                     name='realm').first().id
-                                                 )
-                default_realm.childs.append(rec_entity_realm)
-                models.db.session.add(rec_entity_realm)
-
-            rec_entity_host = models.Entity(name=host_name,
-                                            entity_type_id=models.EntityType.query.filter_by(name='host').first().id,
-                                            is_monitored=is_monitored
-                                            )
-            rec_entity_realm.childs.append(rec_entity_host)
-            models.db.session.add(rec_entity_host)
-
-        # Host Livestate create
-        livestate = json_data.get('livestate', None)
-        if livestate:
-            insert_livestates(rec_parent=rec_entity_host, livestates=livestate)
-
-        # Services get/create
-        services = json_data.get('services', None)
-        current_app.logger.debug("services: {0}".format(services))
-        if services:
-            for service in services:
-                service_name = service.get('name', None)
-                service_name = "{0}||{1}".format(host_name, service_name)  # For uniqueness
-                is_monitored = service.get('passive_checks_enabled', False)
-
-                rec_entity_service = models.Entity.query.filter_by(name=service_name).first()
-                if not rec_entity_service:  # Create it
-                    rec_entity_service = models.Entity(name=service_name,
-                                                       parent_entity_id=rec_entity_host.id,
-                                                       entity_type_id=models.EntityType.query.filter_by(
-                                                           name='service').first().id,
-                                                       is_monitored=is_monitored
-                                                       )
-                    rec_entity_host.childs.append(rec_entity_service)
-                    models.db.session.add(rec_entity_service)
-
-                # Service Livestate create
-                livestate = service.get('livestate', None)
-                if livestate:
-                    insert_livestates(rec_parent=rec_entity_service, livestates=livestate)
-
-        models.db.session.commit()
-
-        feedback = {
-            'check_interval': rec_entity_host.checkall_interval,
-            'freshness_threshold': rec_entity_host.heartbeat_interval,
-            'passive_check_enabled': rec_entity_host.is_monitored,
-            'active_check_enabled': False
-        }
         return as_json(feedback=feedback), 200
 
 
-def insert_livestates(rec_parent, livestates):
+class HostsRessource(MethodView):
+    """
+    Bulk version of HostRessource: many hosts in one PATCH, as a JSON array or as NDJSON (one host per line),
+    or as MessagePack (an array or a sequence of hosts), possibly compressed, each host in the HostRessource
+    format. The body is parsed as it is read, the hosts are resolved and
+    written chunk by chunk (BULK_CHUNK_SIZE) and all of them committed in a single transaction.
+
+    Returns one result per host, in the submission order:
+        {'name': _HOSTNAME_, '_status': 'OK', '_feedback': {...}}
+        or {'name': _HOSTNAME_, '_status': 'ERR', '_issues': '...'} for an invalid host, the others being written
+    """
+    decorators = [idempotent, auth.login_required]
+
+    def patch(self):
+        results = []
+        try:
+            documents = formats.iter_hosts(request, current_app.config['INGEST_MAX_BODY_SIZE'],
+                                           current_app.config.get('INGEST_MAX_BULK_SIZE'))
+        except formats.UnsupportedFormat as e:
+            return as_json(issues=str(e)), 415
+        try:
+            for name, feedback, issue in ingest_hosts(documents, chunk_size=current_app.config['BULK_CHUNK_SIZE']):
+                if issue is None:
+                    results.append({'name': name, '_status': 'OK', '_feedback': feedback})
+                else:
+                    results.append({'name': name, '_status': 'ERR', '_issues': issue})
+            if results:
+                with phase('commit'):
+                    models.db.session.commit()
+        except formats.BodyTooLarge as e:
+            models.db.session.rollback()
+            return as_json(issues=str(e)), 413
+        except ValueError as e:  # Malformed JSON, nothing is written
+            models.db.session.rollback()
+            return as_json(issues='Malformed hosts data: {0}'.format(e)), 400
+        except IntegrityError:  # The same livestates written concurrently (orm mode), a retry will skip them
+            models.db.session.rollback()
+            return as_json(issues='Concurrent duplicate submission, retry'), 409, {'Retry-After': '1'}
+        if not results:
+            return as_json(issues='No input data provided'), 400
+        return as_json(result=results), 200
+
+
+class CurrentStatesRessource(MethodView):
+    """
+    Returns the current state of an entity and of all its descendants (a realm, an host and its services, ...)
+    read from the current_livestate projection, without touching the livestates history
+    """
+    decorators = [auth.login_required]
+
+    def get(self, name):
+        nodes = queries.subtree(name)
+        if not nodes:
+            return as_json(issues='Unknown entity'), 404
+        keys = ('name', 'entity_type', 'state', 'timestamp', 'output', 'is_acknowledged')
+        return as_json(result=[dict((key, node[key]) for key in keys) for node in nodes
+                               if node['timestamp'] is not None]), 200
+
+
+class TreeRessource(MethodView):
+    """
+    Returns an entity subtree (types, tags and current states), each node carrying the worst severity
+    of its own subtree
+    """
+    decorators = [auth.login_required]
+
+    def get(self, name):
+        root = queries.build_tree(queries.subtree(name))
+        if root is None:
+            return as_json(issues='Unknown entity'), 404
+        return as_json(result=root), 200
+
+
+class SeriesRessource(MethodView):
+    """
+    Returns metrics series of an entity over a time range, downsampled server side
+
+    Query parameters:
+        names: comma separated metrics names (required)
+        start, end: epoch seconds, default to the last 24 hours
+        points: maximum number of points per series, default to 500
+        method: 'lttb' (default) or 'minmax'
+
+    The series are read from the coarsest rollup still giving enough points (raw metrics if none does,
+    cumulative ones as rates) and streamed as columns, values being the buckets averages:
+        {'_status': 'OK', '_result': {'resolution': 60, 'series': {'load1': {'timestamps': [...], 'values': [...],
+                                                                             'min': [...], 'max': [...]}}}}
+    """
+    decorators = [auth.login_required]
+
+    def get(self, name):
+        names = [metric for metric in request.args.get('names', '').split(',') if metric]
+        if not names:
+            return as_json(issues='The metrics names are required'), 400
+        try:
+            end = float(request.args.get('end', dt.datetime.now().timestamp()))
+            start = float(request.args.get('start', end - 86400))
+            points = int(request.args.get('points', 500))
+        except ValueError:
+            return as_json(issues='start, end and points must be numbers'), 400
+        method = request.args.get('method', 'lttb')
+        if method not in downsampling.METHODS or points < 1 or start >= end:
+            return as_json(issues='Invalid method, points or time range'), 400
+
+        rec_entity = models.Entity.query.filter_by(name=name).first()
+        if rec_entity is None:
+            return as_json(issues='Unknown entity'), 404
+        resolution, series = rollups.query_series(rec_entity.id, names, dt.datetime.fromtimestamp(start),
+                                                  dt.datetime.fromtimestamp(end), points)
+        models.db.session.commit()  # The rows are all fetched, end the transaction before streaming
+
+        def generate():
+            yield b'{"_status":"OK","_result":{"resolution":' + serializers.dumps(resolution) + b',"series":{'
+            for i, (metric, rows) in enumerate(series.items()):
+                rows = downsampling.downsample([(row[0].timestamp(),) + tuple(row[1:]) for row in rows], points,
+                                               method)
+                columns = serializers.columns(rows, keys=('timestamps', 'values', 'min', 'max'))
+                yield (b',' if i else b'') + serializers.dumps(metric) + b':' + serializers.dumps(columns)
+            yield b'}}}\n'
+
+        return Response(generate(), mimetype=serializers.MIMETYPE)
+
+
+class EventsRessource(MethodView):
+    """
+    Stream of the livestates state transitions
+
+    Query parameters:
+        since: last event id received (or the Last-Event-ID header), default to the next events only
+        entity: only the transitions of this entity and of its descendants (services of an host, ...)
+        timeout: long polling only, maximum seconds to wait for an event, default to 30
+
+    With an `Accept: text/event-stream` header, server-sent events ('transition' events, and a 'reset' event
+    when the consumer is too late and some were dropped from the buffer). Long polling otherwise:
+        {'_status': 'OK', '_result': {'events': [...], 'last_id': 12, 'missed': False}}
+    """
+    decorators = [auth.login_required]
+
+    def get(self):
+        if not events.enabled:
+            return as_json(issues='Events are disabled'), 404
+        try:
+            since = request.headers.get('Last-Event-ID', request.args.get('since'))
+            since = int(since) if since is not None else None
+            timeout = min(float(request.args.get('timeout', 30)), 300)
+        except ValueError:
+            return as_json(issues='since and timeout must be numbers'), 400
+        entity = request.args.get('entity')
+
+        def matching(items):
+            if entity is None:
+                return items
+            prefix = entity + '||'
+            return [item for item in items if item['entity'] == entity or item['entity'].startswith(prefix)]
+
+        events.start_listener()
+        bus = events.bus  # The generator runs out of the application context
+        if since is None:
+            since = bus.last_id
+        models.db.session.commit()  # Don't keep a connection while waiting
+
+        if request.accept_mimetypes.best == 'text/event-stream':
+            keepalive = current_app.config.get('EVENTS_KEEPALIVE', 15)
+
+            def generate(last_id):
+                yield 'retry: 1000\n\n'
+                while True:
+                    items, missed = bus.since(last_id, keepalive)
+                    if not items:
+                        yield ': keepalive\n\n'
+                        continue
+                    if missed:
+                        yield 'event: reset\ndata: {}\n\n'
+                    matched = matching(items)
+                    for item in matched:
+                        yield 'id: {0}\nevent: transition\ndata: {1}\n\n'.format(
+                            item['id'], serializers.dumps(item).decode('UTF-8'))
+                    last_id = items[-1]['id']
+                    if not matched or matched[-1]['id'] != last_id:  # Still move the consumer forward
+                        yield 'id: {0}\n\n'.format(last_id)
+
+            return Response(generate(since), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+        deadline = time.monotonic() + timeout
+        while True:  # Wait for the matching events only
+            items, missed = bus.since(since, max(deadline - time.monotonic(), 0))
+            last_id = items[-1]['id'] if items else since
+            items = matching(items)
+            if items or missed or time.monotonic() >= deadline:
+                break
+            since = last_id
+        return as_json(result={'events': items, 'last_id': last_id, 'missed': missed}), 200
+
+
+class IngestStatsRessource(MethodView):
+    """
+    Write-behind ingest queue depth, counters and latencies
+    """
+    decorators = [auth.login_required]
+
+    def get(self):
+        stats = ingest_queue.stats()
+        if stats is None:
+            return as_json(issues='Write-behind ingestion is disabled'), 404
+        return as_json(result=stats), 200
+
+
+class PoolStatsRessource(MethodView):
     """
-    Insert Livestates in DB for an parent entity
-    :param rec_parent: models.Entity (Host or Service)
-    :param livestates: list of dict. The livestates to insert
-    :return: Nothing
+    Database connection pool occupancy, checkouts and wait times
     """
-    # current_app.logger.debug(livestates)
-    for livestate in livestates:
-        timestamp = livestate.get('timestamp', dt.datetime.now().timestamp())
-        state = livestate.get('state')
-        output = livestate.get('output')
-        long_output = livestate.get('long_output')
-
-        rec_state = models.State.query.filter_by(name=state).first()
-        rec_livestate = models.Livestate(
-            timestamp=dt.datetime.fromtimestamp(timestamp),
-            output=output,
-            long_output=long_output,
-            entity_id=rec_parent.id,
-            state_id=rec_state.id,
-            is_acknowledged=rec_parent.is_auto_acknowledge
-        )
-        # Metric create
-        raw_metrics = livestate.get('perf_data', None)
-        if raw_metrics:
-            insert_metrics(rec_livestate=rec_livestate, raw_metrics=raw_metrics)
-
-        rec_parent.livestates.append(rec_livestate)
-        models.db.session.add(rec_livestate)
-
-
-def insert_metrics(rec_livestate, raw_metrics):
+    decorators = [auth.login_required]
+
+    def get(self):
+        return as_json(result=pool.stats()), 200
+
+
+class TimingsRessource(MethodView):
     """
-    Insert Metrics in DB
-    :param rec_livestate: models.Livestate. A Livestate record
-    :param raw_metrics: str. Metrics in raw format
-        raw_metrics (perf_data) format: "'metric1_name'=metric1_value(c) 'metric2_name'= metric2_value(c)..."
-        if value ends with 'c', then it's cumulative, else raw value
-    :return: Nothing
+    Per endpoint histograms of the requests durations, SQL queries and phases
     """
+    decorators = [auth.login_required]
+
+    def get(self):
+        result = histograms()
+        if result is None:
+            return as_json(issues='Instrumentation is disabled'), 404
+        return as_json(result=result), 200
 
-    for raw_metric in raw_metrics.strip().split(' '):
-        name, value = raw_metric.split('=')
-        if value.endswith('c'):
-            value = value[:-1].replace("'", "")
-            rec_metric_type = models.MetricType.query.filter_by(name='cumulative').first()
-        else:
-            rec_metric_type = models.MetricType.query.filter_by(name='raw').first()
 
-        rec_metric = models.Metric(
-            timestamp=rec_livestate.timestamp,
-            name=name,
-            value=float(value),
-            metric_type_id=rec_metric_type.id
-        )
-        rec_livestate.metrics.append(rec_metric)
-        models.db.session.add(rec_metric)
+class MetricsRessource(MethodView):
+    """
+    The server own metrics (ingest counters, requests latencies, pool and queue statistics) in the Prometheus
+    text format. Not authenticated, for the scrapers.
+    """
+
+    def get(self):
+        if not current_app.config.get('METRICS_ENABLED', True):
+            return as_json(issues='Metrics are disabled'), 404
+        return Response(exporter.exposition(), content_type=exporter.CONTENT_TYPE)
 
 
 def api(app):
     app.add_url_rule('/login', view_func=LoginRessource.as_view('login'))
     app.add_url_rule('/host', view_func=HostRessource.as_view('host'))
+    app.add_url_rule('/hosts', view_func=HostsRessource.as_view('hosts'))
+    app.add_url_rule('/current/<path:name>', view_func=CurrentStatesRessource.as_view('current'))
+    app.add_url_rule('/tree/<path:name>', view_func=TreeRessource.as_view('tree'))
+    app.add_url_rule('/events', view_func=EventsRessource.as_view('events'))
+    app.add_url_rule('/_internal/ingest', view_func=IngestStatsRessource.as_view('ingest_stats'))
+    app.add_url_rule('/_internal/pool', view_func=PoolStatsRessource.as_view('pool_stats'))
+    app.add_url_rule('/_internal/timings', view_func=TimingsRessource.as_view('timings'))
+    app.add_url_rule('/metrics', view_func=MetricsRessource.as_view('metrics'))
+    app.add_url_rule('/metrics/<path:name>', view_func=SeriesRessource.as_view('series'))
@@ -0,0 +1,370 @@
+"""
+Metrics downsampling: incremental rollups of the raw metrics into 1 minute, 1 hour and 1 day buckets
+
+Each run aggregates the metrics inserted since the previous one (metric ids above the high-water mark
+stored in rollup_state) and merges them into the existing buckets, in a single transaction.
+Cumulative metrics (counters) are aggregated as rates per second between consecutive samples of a series,
+counter resets being skipped.
+
+Metric ids are taken before their transaction commits, so a lower id may become visible after a higher one.
+The ids are only aggregated up to a safe mark: the highest id seen at a previous run, once every transaction
+running at that time has ended (PostgreSQL, from pg_stat_activity), or ROLLUP_GRACE seconds later elsewhere.
+The series read from the rollups add the metrics above the high-water mark, aggregated when read.
+"""
+
+import datetime as dt
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import models
+from .caches import references, TTLCache
+
+RESOLUTIONS = (  # (bucket seconds, model), finest first
+    (60, models.MetricRollupMinute),
+    (3600, models.MetricRollupHour),
+    (86400, models.MetricRollupDay),
+)
+STATE_NAME = 'metrics'
+
+PENDING_KEY = 'pamose_rollups_previous'  # Session.info key of the last samples waiting for the commit
+
+# (entity_id, name) -> (timestamp, value) of the last aggregated sample of cumulative series, updated once
+# committed (also read from the rollups, see previous_sample)
+_previous = TTLCache(maxsize=100000, ttl=3600)
+
+
+def bucket_start(timestamp, seconds):
+    """
+    :param timestamp: datetime.datetime
+    :param seconds: int. The bucket size, one of RESOLUTIONS
+    :return: datetime.datetime. The start of the bucket holding the timestamp
+    """
+    if seconds == 60:
+        return timestamp.replace(second=0, microsecond=0)
+    if seconds == 3600:
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def advance_safe_id(session, state, grace):
+    """
+    Move the safe mark of the rollups to the highest metric id seen at a previous run, if every transaction
+    running then has ended since, and see the current highest id again
+    :param session: sqlalchemy Session (or scoped_session)
+    :param state: models.RollupState
+    :param grace: float. Seconds a transaction is assumed to last at most, when it can't be checked
+    """
+    connection = session.connection()
+    postgresql = connection.dialect.name == 'postgresql'
+    if postgresql:
+        now = session.execute(models.db.text('SELECT clock_timestamp()::timestamp')).scalar()
+    else:
+        now = dt.datetime.now()
+
+    if state.seen_at is not None:
+        if postgresql:  # The writing transactions, but this one
+            oldest = session.execute(models.db.text(
+                'SELECT min(xact_start)::timestamp FROM pg_stat_activity '
+                'WHERE backend_xid IS NOT NULL AND pid <> pg_backend_pid()')).scalar()
+            ended = oldest is None or oldest > state.seen_at
+        else:
+            ended = (now - state.seen_at).total_seconds() >= grace
+        if not ended:
+            return
+        state.safe_metric_id = max(state.safe_metric_id or 0, state.seen_metric_id or 0)
+
+    metric = models.Metric.__table__
+    state.seen_metric_id = session.execute(models.db.select([models.db.func.max(metric.c.id)])).scalar() or 0
+    state.seen_at = now
+    if not postgresql and grace <= 0:
+        state.safe_metric_id = state.seen_metric_id
+
+
+def rollup(batch_size=50000, grace=None):
+    """
+    Aggregate the next batch of raw metrics and commit
+    :param batch_size: int. Maximum number of metrics aggregated
+    :param grace: float. See advance_safe_id, default to ROLLUP_GRACE
+    :return: int. The number of metrics aggregated (lower than batch_size when caught up)
+    """
+    session = models.db.session
+    state = models.RollupState.query.get(STATE_NAME)
+    if state is None:
+        state = models.RollupState(name=STATE_NAME, last_metric_id=0, safe_metric_id=0)
+        session.add(state)
+    grace = current_app.config.get('ROLLUP_GRACE', 60) if grace is None else grace
+    advance_safe_id(session, state, grace)
+
+    metric = models.Metric.__table__
+    livestate = models.Livestate.__table__
+    query = models.db.select([
+        metric.c.id, livestate.c.entity_id, metric.c.name, metric.c.timestamp, metric.c.value, metric.c.metric_type_id
+    ]).select_from(
+        metric.join(livestate, livestate.c.id == metric.c.livestate_id)
+    ).where(metric.c.id > state.last_metric_id).where(
+        metric.c.id <= state.safe_metric_id).order_by(metric.c.id).limit(batch_size)
+    rows = session.execute(query).fetchall()
+    if not rows:
+        session.commit()
+        return 0
+
+    samples = series_samples(rows, session.info.setdefault(PENDING_KEY, {}))
+    for seconds, model in RESOLUTIONS:
+        merge_buckets(model, aggregate(samples, seconds))
+
+    state.last_metric_id = rows[-1].id
+    session.commit()
+    return len(rows)
+
+
+def series_samples(rows, last_samples=None):
+    """
+    Turn raw metric rows into the samples to aggregate, per series: the values themselves for raw metrics,
+    the rates between consecutive values for cumulative ones
+    :param rows: list of rows (id, entity_id, name, timestamp, value, metric_type_id)
+    :param last_samples: dict. Gets the last sample of each cumulative series, (entity_id, name) ->
+        (timestamp, value), to remember once committed
+    :return: dict. (entity_id, name) -> list of (timestamp, sample value, raw value), sorted by timestamp
+    """
+    cumulative_id = references.get(models.MetricType, 'cumulative')
+    series = {}
+    cumulative = set()
+    for row in rows:
+        if row.value is None:
+            continue
+        key = (row.entity_id, row.name)
+        series.setdefault(key, []).append((row.timestamp, row.value))
+        if row.metric_type_id == cumulative_id:
+            cumulative.add(key)
+
+    samples = {}
+    for key, values in series.items():
+        values.sort(key=lambda value: value[0])
+        if key not in cumulative:
+            samples[key] = [(timestamp, value, value) for timestamp, value in values]
+            continue
+        previous = _previous.get(key) or previous_sample(key)  # The cache is updated once committed
+        rates = []
+        for timestamp, value in values:
+            if previous is not None and timestamp > previous[0] and value >= previous[1]:
+                rates.append((timestamp, (value - previous[1]) / (timestamp - previous[0]).total_seconds(), value))
+            if previous is None or timestamp > previous[0]:
+                previous = (timestamp, value)
+        if last_samples is not None:
+            last_samples[key] = previous
+        samples[key] = rates
+    return samples
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for key, previous in session.info.pop(PENDING_KEY, {}).items():
+        _previous.set(key, previous)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+def previous_sample(key):
+    """
+    The last aggregated sample of a cumulative series, from the finest rollup
+    :param key: (entity_id, name)
+    :return: (timestamp, value) or None
+    """
+    model = RESOLUTIONS[0][1]
+    row = models.db.session.query(model.last_timestamp, model.last).filter(
+        model.entity_id == key[0], model.name == key[1]
+    ).order_by(model.bucket.desc()).first()
+    if row is None or row.last_timestamp is None:
+        return None
+    return row.last_timestamp, row.last
+
+
+def aggregate(samples, seconds):
+    """
+    :param samples: dict, see series_samples
+    :param seconds: int. The bucket size
+    :return: dict. (entity_id, name, bucket) -> dict of aggregates
+    """
+    buckets = {}
+    for (entity_id, name), values in samples.items():
+        for timestamp, value, raw in values:
+            key = (entity_id, name, bucket_start(timestamp, seconds))
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = {'count': 1, 'sum': value, 'min': value, 'max': value,
+                                'last': raw, 'last_timestamp': timestamp}
+            else:
+                bucket['count'] += 1
+                bucket['sum'] += value
+                bucket['min'] = min(bucket['min'], value)
+                bucket['max'] = max(bucket['max'], value)
+                if timestamp >= bucket['last_timestamp']:
+                    bucket['last'] = raw
+                    bucket['last_timestamp'] = timestamp
+    return buckets
+
+
+def merge_buckets(model, buckets, chunk_size=500):
+    """
+    Merge aggregated buckets into a rollup table: existing rows are updated, missing ones inserted
+    :param model: One of the RESOLUTIONS models
+    :param buckets: dict, see aggregate
+    :return: Nothing
+    """
+    if not buckets:
+        return
+    table = model.__table__
+    connection = models.db.session.connection()
+    entity_ids = sorted(set(key[0] for key in buckets))
+    oldest = min(key[2] for key in buckets)
+
+    stored = {}
+    for i in range(0, len(entity_ids), chunk_size):
+        query = models.db.select([table]).where(
+            table.c.entity_id.in_(entity_ids[i:i + chunk_size])).where(table.c.bucket >= oldest)
+        for row in connection.execute(query):
+            key = (row.entity_id, row.name, row.bucket)
+            if key in buckets:
+                stored[key] = row
+
+    updates, inserts = [], []
+    for key, bucket in buckets.items():
+        row = stored.get(key)
+        if row is None:
+            inserts.append(dict(bucket, entity_id=key[0], name=key[1], bucket=key[2]))
+            continue
+        merged = {
+            '_entity_id': key[0], '_name': key[1], '_bucket': key[2],
+            'count': row.count + bucket['count'],
+            'sum': row.sum + bucket['sum'],
+            'min': min(row.min, bucket['min']),
+            'max': max(row.max, bucket['max']),
+            'last': row.last, 'last_timestamp': row.last_timestamp,
+        }
+        if row.last_timestamp is None or bucket['last_timestamp'] >= row.last_timestamp:
+            merged['last'] = bucket['last']
+            merged['last_timestamp'] = bucket['last_timestamp']
+        updates.append(merged)
+
+    if updates:
+        connection.execute(table.update().where(
+            (table.c.entity_id == models.db.bindparam('_entity_id')) &
+            (table.c.name == models.db.bindparam('_name')) &
+            (table.c.bucket == models.db.bindparam('_bucket'))
+        ), updates)
+    if inserts:
+        connection.execute(table.insert(), inserts)
+
+
+def pick_resolution(start, end, points):
+    """
+    The coarsest rollup still giving at least `points` buckets over a time range
+    :param start: datetime.datetime
+    :param end: datetime.datetime
+    :param points: int. The number of points wanted
+    :return: (bucket seconds, model), or None if the raw metrics are needed
+    """
+    span = (end - start).total_seconds()
+    chosen = None
+    for seconds, model in RESOLUTIONS:
+        if span / seconds >= points:
+            chosen = (seconds, model)
+    return chosen
+
+
+def rolled_up_id():
+    """
+    :return: int. The highest metric id aggregated in the rollups, 0 if none
+    """
+    table = models.RollupState.__table__  # Not the ORM object, kept in the session identity map
+    return models.db.session.execute(models.db.select([table.c.last_metric_id]).where(
+        table.c.name == STATE_NAME)).scalar() or 0
+
+
+def raw_metrics(entity_id, names, start, end, after_id=None):
+    """
+    :param entity_id: int
+    :param names: list of str. The metrics names
+    :param start: datetime.datetime
+    :param end: datetime.datetime
+    :param after_id: int. Only the metrics of higher ids (not rolled up yet), None for all of them
+    :return: list of rows (id, entity_id, name, timestamp, value, metric_type_id), sorted by timestamp
+    """
+    metric = models.Metric.__table__
+    livestate = models.Livestate.__table__
+    query = models.db.select([
+        metric.c.id, livestate.c.entity_id, metric.c.name, metric.c.timestamp, metric.c.value, metric.c.metric_type_id
+    ]).select_from(
+        metric.join(livestate, livestate.c.id == metric.c.livestate_id)
+    ).where(livestate.c.entity_id == entity_id).where(  # Uses the livestate (entity_id, timestamp) index
+        livestate.c.timestamp >= start).where(livestate.c.timestamp < end).where(
+        metric.c.timestamp >= start).where(metric.c.timestamp < end).where(  # Prunes the metric partitions
+        metric.c.name.in_(names)).order_by(metric.c.timestamp)
+    if after_id is not None:
+        query = query.where(metric.c.id > after_id)
+    return models.db.session.execute(query).fetchall()
+
+
+def query_series(entity_id, names, start, end, points):
+    """
+    Metrics series of an entity over a time range, read from the coarsest resolution satisfying the
+    requested number of points (raw metrics if none does). Cumulative metrics are returned as rates.
+    The metrics not rolled up yet (all of them when `pamose rollup` doesn't run) are aggregated on the fly
+    into the buckets read from the rollups.
+    :param entity_id: int
+    :param names: list of str. The metrics names
+    :param start: datetime.datetime
+    :param end: datetime.datetime
+    :param points: int. The wanted number of points (a minimum, see pick_resolution)
+    :return: (resolution seconds or None for raw, dict. name -> list of (timestamp, avg, min, max, count))
+    """
+    resolution = pick_resolution(start, end, points)
+    series = dict((name, []) for name in names)
+    if resolution is None:
+        cumulative_id = references.get(models.MetricType, 'cumulative')
+        previous = {}
+        for row in raw_metrics(entity_id, names, start, end):
+            if row.value is None:
+                continue
+            value = row.value
+            if row.metric_type_id == cumulative_id:  # As rates, like the rollups
+                last = previous.get(row.name)
+                previous[row.name] = (row.timestamp, row.value)
+                if last is None or row.timestamp <= last[0] or row.value < last[1]:
+                    continue
+                value = (row.value - last[1]) / (row.timestamp - last[0]).total_seconds()
+            series[row.name].append((row.timestamp, value, value, value, 1))
+        return None, series
+
+    seconds, model = resolution
+    start = bucket_start(start, seconds)
+    for attempt in range(3):  # The rollups read as of a single high-water mark, unless a run keeps committing
+        last_metric_id = rolled_up_id()
+        query = models.db.session.query(
+            model.name, model.bucket, model.sum, model.min, model.max, model.count
+        ).filter(
+            model.entity_id == entity_id, model.name.in_(names), model.bucket >= start, model.bucket < end
+        )
+        buckets = dict(((row.name, row.bucket), [row.sum, row.min, row.max, row.count]) for row in query)
+        if rolled_up_id() == last_metric_id:
+            break
+
+    samples = series_samples(raw_metrics(entity_id, names, start, end, after_id=last_metric_id))
+    for (_, name, bucket), aggregates in aggregate(samples, seconds).items():
+        merged = buckets.get((name, bucket))
+        if merged is None:
+            buckets[(name, bucket)] = [aggregates['sum'], aggregates['min'], aggregates['max'], aggregates['count']]
+        else:
+            merged[0] += aggregates['sum']
+            merged[1] = min(merged[1], aggregates['min'])
+            merged[2] = max(merged[2], aggregates['max'])
+            merged[3] += aggregates['count']
+
+    for (name, bucket), (total, minimum, maximum, count) in sorted(buckets.items()):
+        series[name].append((bucket, total / count, minimum, maximum, count))
+    return seconds, series
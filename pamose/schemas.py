@@ -61,6 +61,11 @@ class LivestateSchema(ma.ModelSchema):
         model = models.Livestate
 
 
+class CurrentLivestateSchema(ma.ModelSchema):
+    class Meta:
+        model = models.CurrentLivestate
+
+
 class MetricSchema(ma.ModelSchema):
     class Meta:
         model = models.Metric
@@ -0,0 +1,78 @@
+"""
+Fast JSON serialization of the read endpoints results
+
+Results are built from Core rows (never ORM instances) into plain dicts and lists, column oriented for the
+time series ({'timestamps': [...], 'values': [...]}), and encoded with orjson when installed (optional,
+`pip install orjson`), the standard json module otherwise. Datetimes are encoded as epoch seconds.
+"""
+
+import json
+import datetime as dt
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:  # Optional
+    orjson = None
+
+MIMETYPE = 'application/json'
+
+
+def default(obj):
+    if isinstance(obj, dt.datetime):
+        return obj.timestamp()
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(obj):
+        """
+        :return: bytes. The compact JSON encoding of obj
+        """
+        return orjson.dumps(obj, default=default, option=_OPTIONS)
+else:
+    _encoder = json.JSONEncoder(default=default, separators=(',', ':'), ensure_ascii=False)
+
+    def dumps(obj):
+        """
+        :return: bytes. The compact JSON encoding of obj
+        """
+        return _encoder.encode(obj).encode('UTF-8')
+
+
+def response(obj, status=200):
+    """
+    :return: flask.Response. obj encoded as JSON
+    """
+    return Response(dumps(obj), status=status, mimetype=MIMETYPE)
+
+
+def records(rows):
+    """
+    :param rows: iterable of Core rows (RowProxy)
+    :return: list of dict, one per row
+    """
+    return [dict(row) for row in rows]
+
+
+def columns(rows, keys=None):
+    """
+    Column oriented results: one list of values per column
+    :param rows: iterable of Core rows (RowProxy) or tuples
+    :param keys: list of str. The columns names, default to the rows keys
+    :return: dict. column name -> list of values (datetimes as epoch seconds)
+    """
+    rows = list(rows)
+    if keys is None:
+        keys = list(rows[0].keys()) if rows else []
+    result = dict((key, []) for key in keys)
+    appends = [result[key].append for key in keys]
+    for row in rows:
+        for append, value in zip(appends, row):
+            append(value.timestamp() if isinstance(value, dt.datetime) else value)
+    return result
@@ -0,0 +1,358 @@
+"""
+Pre-forking HTTP server (`pamose serve`)
+
+A master process binds the address, forks SERVER_WORKERS worker processes (default to the CPU count) and
+keeps them running. Each worker creates its application (so its own engine and connection pool) after the
+fork, and serves up to SERVER_THREADS connections at once, one thread each (idle keep-alive connections are
+closed after SERVER_KEEPALIVE seconds).
+
+With SERVER_REUSE_PORT (Linux, BSD), each worker listens on its own SO_REUSEPORT socket and the kernel
+balances the connections between them. Otherwise, the workers accept on the socket of the master.
+
+Signals (to the master):
+    SIGHUP: graceful reload. New workers are started (with the reloaded settings, unless preloaded), then the
+        old ones stopped
+    SIGTERM, SIGINT: graceful stop. The workers finish their requests (SERVER_GRACEFUL_TIMEOUT seconds at most)
+
+A worker is replaced after SERVER_MAX_REQUESTS requests (plus a random jitter, so they don't all restart
+together), bounding its memory growth. Retiring workers (recycled, or of the previous generation on reload)
+are stopped one per new worker ready: some worker is always accepting the connections, and the capacity
+doesn't drop during a reload.
+"""
+
+import os
+import time
+import errno
+import functools
+import logging
+import random
+import signal
+import socket
+import threading
+import multiprocessing
+
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+
+from . import models
+from .writebehind import ingest_queue
+
+
+class _RequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, for the agents sending many requests
+
+
+class _WorkerServer(ThreadedWSGIServer):
+    """
+    Threaded WSGI server on an existing socket, with a bounded number of threads, waiting for the running
+    requests when closed
+    """
+    daemon_threads = False
+    block_on_close = True
+
+    DRAIN_MAX = 1000  # Queued connections served at most when closing
+
+    def __init__(self, sock, app, threads, keepalive, private_socket):
+        """
+        :param private_socket: bool. The socket is this worker's own (SO_REUSEPORT), see server_close
+        """
+        host, port = sock.getsockname()[:2]
+        handler = type('RequestHandler', (_RequestHandler,), {'timeout': keepalive})
+        super(_WorkerServer, self).__init__(host, port, app, handler=handler, fd=sock.fileno())
+        self.private_socket = private_socket
+        self.slots = threading.BoundedSemaphore(threads)
+        self.stopping = False
+        self._stop_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()  # The next connections wait in the listen backlog
+        super(_WorkerServer, self).process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super(_WorkerServer, self).process_request_thread(request, client_address)
+        finally:
+            self.slots.release()
+
+    def server_close(self):
+        # With SO_REUSEPORT, the connections already queued on this socket would be reset when it's closed
+        # (the other workers can't accept them): serve them first. A shared socket is left to the others.
+        if self.private_socket:
+            self.socket.setblocking(False)
+            for _ in range(self.DRAIN_MAX):
+                try:
+                    request, client_address = self.socket.accept()
+                except OSError:
+                    break
+                request.setblocking(True)
+                self.process_request(request, client_address)
+        super(_WorkerServer, self).server_close()
+
+    def stop(self):
+        """
+        Stop accepting connections, from any thread (or a signal handler)
+        """
+        with self._stop_lock:
+            if self.stopping:
+                return
+            self.stopping = True
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+
+class _Recycler(object):
+    """
+    WSGI middleware asking the master to replace the worker after a number of requests
+    """
+
+    def __init__(self, app, retire, max_requests):
+        self.app = app
+        self.retire = retire
+        self.max_requests = max_requests
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self.lock:
+            self.requests += 1
+            recycle = self.requests == self.max_requests
+        if recycle:
+            self.retire()
+        return self.app(environ, start_response)
+
+
+class Server(object):
+    """
+    The master process
+    """
+
+    def __init__(self, app_factory, host='127.0.0.1', port=5000, workers=None, threads=8, max_requests=10000,
+                 max_requests_jitter=1000, graceful_timeout=30, keepalive=5, reuse_port=True, backlog=1024,
+                 logger=None):
+        """
+        :param app_factory: function. Returns the WSGI application, called in each worker after the fork
+        :param workers: int. Number of worker processes, default to the CPU count
+        :param max_requests: int. Requests served before a worker is replaced, 0 to never replace them
+        :param logger: logging.Logger
+        """
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers or multiprocessing.cpu_count()
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.keepalive = keepalive
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        self.backlog = backlog
+        self.logger = logger
+        self.socket = None
+        self.children = {}  # pid -> (generation, start time), generation None for the retiring workers
+        self.generation = 0
+        self.pipe = None  # Workers -> master messages
+        self.stopping_pids = set()  # Retiring workers already sent SIGTERM
+        self.reloading = False
+        self.stopping = False
+
+    def _log(self, level, message, *args):
+        if self.logger is not None:
+            self.logger.log(level, message, *args)
+
+    def _socket(self, listen):
+        sock = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        if listen:
+            sock.listen(self.backlog)
+        return sock
+
+    def run(self):
+        """
+        Start the workers and supervise them until stopped. Blocks.
+        """
+        # With SO_REUSEPORT, the master only holds the port (a bound socket not listening gets no connection)
+        self.socket = self._socket(listen=not self.reuse_port)
+        self.port = self.socket.getsockname()[1]
+        self.pipe = os.pipe()
+        os.set_blocking(self.pipe[0], False)
+        self._log(logging.INFO, "Listening on %s:%s with %s workers (%s)", self.host, self.port, self.workers,
+                  'SO_REUSEPORT' if self.reuse_port else 'shared socket')
+
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        try:
+            while not self.stopping:
+                self._reap()
+                self._read_messages()
+                if self.reloading:
+                    self._reload()
+                self._spawn_missing()
+                time.sleep(0.2)
+        finally:
+            self._stop_workers(list(self.children))
+            self.socket.close()
+            for fd in self.pipe:
+                os.close(fd)
+        self._log(logging.INFO, "Stopped")
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _reload(self):
+        self.reloading = False
+        for pid, (generation, _) in list(self.children.items()):
+            if generation == self.generation:
+                self._retire(pid)
+        self.generation += 1
+        self._log(logging.INFO, "Reloading: starting %s new workers", self.workers)
+
+    def _retire(self, pid):
+        """
+        Replace a worker. It's stopped once a new one is ready (see _read_messages).
+        """
+        if pid in self.children:
+            self.children[pid] = (None, self.children[pid][1])
+
+    def _read_messages(self):
+        try:
+            data = os.read(self.pipe[0], 65536)
+        except BlockingIOError:
+            return
+        for line in data.decode('ascii').splitlines():
+            message, pid = line.split()
+            if message == 'retire':
+                self._log(logging.INFO, "Worker %s retiring", pid)
+                self._retire(int(pid))
+            elif message == 'ready':  # Replaces one retiring worker
+                retiring = sorted((started, pid) for pid, (generation, started) in self.children.items()
+                                  if generation is None and pid not in self.stopping_pids)
+                if retiring:
+                    self.stopping_pids.add(retiring[0][1])
+                    self._kill(retiring[0][1], signal.SIGTERM)
+
+    def _spawn_missing(self):
+        current = [started for generation, started in self.children.values() if generation == self.generation]
+        for _ in range(self.workers - len(current)):
+            if self.stopping:
+                return
+            self._spawn()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (self.generation, time.monotonic())
+            return
+        status = 0
+        try:
+            self._worker()
+        except BaseException:
+            status = 1
+            if self.logger is not None:
+                self.logger.exception("Worker %s failed", os.getpid())
+        finally:
+            os._exit(status)
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    self.children.clear()
+                    return
+                raise
+            if not pid:
+                return
+            generation, started = self.children.pop(pid, (None, None))
+            self.stopping_pids.discard(pid)
+            if status:
+                self._log(logging.ERROR, "Worker %s exited with status %s", pid, status)
+                if started is not None and time.monotonic() - started < 1:  # Crashing at boot, don't fork bomb
+                    time.sleep(1)
+            else:
+                self._log(logging.INFO, "Worker %s exited", pid)
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _stop_workers(self, pids):
+        for pid in pids:
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            self._log(logging.WARNING, "Worker %s killed after %ss", pid, self.graceful_timeout)
+            self._kill(pid, signal.SIGKILL)
+        while self.children:
+            self._reap()
+            time.sleep(0.05)
+
+    def _worker(self):
+        for signum in (signal.SIGHUP, signal.SIGINT):  # Reloads and Ctrl-C are handled by the master
+            signal.signal(signum, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        random.seed()
+
+        os.close(self.pipe[0])
+        if self.reuse_port:
+            self.socket.close()
+            self.socket = self._socket(listen=True)
+        app = self.app_factory()
+        server = _WorkerServer(self.socket, app, self.threads, self.keepalive, self.reuse_port)
+        self.socket.close()  # The server has its own copy
+        if self.max_requests:
+            server.app = _Recycler(app, functools.partial(self._send, 'retire'),
+                                   self.max_requests + random.randint(0, self.max_requests_jitter))
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        self._log(logging.INFO, "Worker %s started", os.getpid())
+        self._send('ready')
+        server.serve_forever()
+        with app.app_context():  # Exiting with os._exit, without the atexit handlers
+            ingest_queue.flush()
+
+    def _send(self, message):
+        os.write(self.pipe[1], '{0} {1}\n'.format(message, os.getpid()).encode('ascii'))  # Atomic (< PIPE_BUF)
+
+
+def serve(app, **options):
+    """
+    Run the pre-forking server for an application created by pamose.app.create_app
+    :param app: flask.Flask. The application of the master, giving the settings. Its database connections
+        are closed before forking
+    :param options: Server options overriding the SERVER_* settings
+    """
+    from .app import create_app
+    config = app.config
+    settings = {
+        'host': config.get('SERVER_HOST', '127.0.0.1'),
+        'port': config.get('SERVER_PORT', 5000),
+        'workers': config.get('SERVER_WORKERS'),
+        'threads': config.get('SERVER_THREADS', 8),
+        'max_requests': config.get('SERVER_MAX_REQUESTS', 10000),
+        'max_requests_jitter': config.get('SERVER_MAX_REQUESTS_JITTER', 1000),
+        'graceful_timeout': config.get('SERVER_GRACEFUL_TIMEOUT', 30),
+        'keepalive': config.get('SERVER_KEEPALIVE', 5),
+        'reuse_port': config.get('SERVER_REUSE_PORT', True),
+        'backlog': config.get('SERVER_BACKLOG', 1024),
+    }
+    settings.update((key, value) for key, value in options.items() if value is not None)
+    preload = settings.pop('preload', False)
+
+    if config.get('METRICS_ENABLED', True) and not (config.get('METRICS_MULTIPROC_DIR') or
+                                                    os.environ.get('PROMETHEUS_MULTIPROC_DIR')):
+        app.logger.warning("Without METRICS_MULTIPROC_DIR, /metrics only gives the metrics of one worker")
+    with app.app_context():
+        models.db.get_engine(app).dispose()  # No connection inherited by the workers
+    server = Server(lambda: app if preload else create_app(), logger=app.logger, **settings)
+    server.run()
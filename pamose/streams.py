@@ -0,0 +1,169 @@
+"""
+Incremental parsing of request bodies holding many JSON documents
+
+The bodies are scanned once, for their structure only (brackets, braces and strings, the UTF-8 multibyte
+characters never containing these ASCII bytes), and each document is decoded once, when it is complete.
+"""
+
+import re
+import json
+
+_NON_SPACE = re.compile(rb'\S')
+_STRUCTURE = re.compile(rb'[\[\]{}"]')  # Out of a string
+_STRING_BODY = re.compile(rb'(?:[^"\\]+|\\.)*', re.DOTALL)  # Up to the closing quote, or an incomplete escape
+_SCALAR_END = re.compile(rb'[\s,\]]')
+
+
+class BodyTooLarge(ValueError):
+    """
+    The body, or one of its documents, is larger than allowed, as received or once decompressed
+    """
+
+
+def iter_documents(stream, chunk_size=65536, max_size=None):
+    """
+    Iterate over the documents of a JSON array or of a NDJSON (one document per line) body, reading
+    the stream chunk by chunk so memory stays flat whatever the body size
+    :param stream: file-like object of bytes (the request stream)
+    :param chunk_size: int. Bytes read at once
+    :param max_size: int. Maximum size of a document, None for no limit
+    :return: generator of decoded documents
+    :raise BodyTooLarge: a document larger than max_size
+    :raise ValueError: on malformed JSON
+    """
+    chunks = iter(lambda: stream.read(chunk_size), b'')
+    first = b''
+    for chunk in chunks:
+        first += chunk
+        if first.strip():
+            break
+    if first.lstrip()[:1] == b'[':
+        return _iter_array(_prepend(first, chunks), max_size)
+    return _iter_lines(_prepend(first, chunks), max_size)
+
+
+def _prepend(first, chunks):
+    yield first
+    for chunk in chunks:
+        yield chunk
+
+
+def _check_size(size, max_size):
+    if max_size is not None and size > max_size:
+        raise BodyTooLarge('Document larger than {0} bytes'.format(max_size))
+
+
+def _decode(data):
+    return json.loads(bytes(data).decode('UTF-8'))
+
+
+def _iter_lines(chunks, max_size):
+    buffer = bytearray()
+    for chunk in chunks:
+        position = len(buffer)  # The buffer holds no newline
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b'\n', position)
+            if end < 0:
+                break
+            _check_size(end - start, max_size)
+            if buffer[start:end].strip():
+                yield _decode(buffer[start:end])
+            start = position = end + 1
+        del buffer[:start]
+        _check_size(len(buffer), max_size)
+    if buffer.strip():
+        yield _decode(buffer)
+
+
+def _iter_array(chunks, max_size):
+    buffer = bytearray()
+    position = 0  # Next byte to scan
+    start = None  # Start of the current document
+    depth = 0  # Of the current document, in brackets and braces
+    in_string = False
+    expecting = '['  # '[', 'value' (or ']' right after '['), ',' (or ']')
+    started = False
+    eof = False
+    while True:
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+        offset = start if start is not None else position
+        del buffer[:offset]  # Once per chunk: the bytes of the yielded documents
+        position -= offset
+        if start is not None:
+            start = 0
+        if chunk is not None:
+            buffer += chunk
+
+        while True:
+            if start is None:  # Between documents
+                match = _NON_SPACE.search(buffer, position)
+                if match is None:
+                    position = len(buffer)
+                    break
+                position = match.start()
+                char = buffer[position:position + 1]
+                if expecting == '[':
+                    if char != b'[':
+                        raise ValueError('JSON array expected')
+                    position += 1
+                    expecting = 'value'
+                    continue
+                if expecting == ',':
+                    if char == b']':
+                        return
+                    if char != b',':
+                        raise ValueError("',' or ']' expected")
+                    position += 1
+                    expecting = 'value'
+                    started = True
+                    continue
+                if char == b']' and not started:
+                    return
+                start = position
+                depth = 0
+                in_string = False
+
+            if buffer[start:start + 1] in (b'[', b'{', b'"'):
+                complete = False
+                while not complete:
+                    if in_string:
+                        position = _STRING_BODY.match(buffer, position).end()
+                        if buffer[position:position + 1] != b'"':  # The rest is in the next chunks
+                            break
+                        position += 1
+                        in_string = False
+                        complete = depth <= 0
+                        continue
+                    match = _STRUCTURE.search(buffer, position)
+                    if match is None:
+                        position = len(buffer)
+                        break
+                    position = match.end()
+                    char = buffer[match.start()]
+                    if char == ord('"'):
+                        in_string = True
+                    elif char in b'[{':
+                        depth += 1
+                    else:
+                        depth -= 1
+                        complete = depth <= 0
+            else:  # Number, true, false or null
+                match = _SCALAR_END.search(buffer, position)
+                complete = match is not None
+                position = match.start() if complete else len(buffer)
+
+            if not complete:
+                _check_size(len(buffer) - start, max_size)
+                break
+            _check_size(position - start, max_size)
+            document = _decode(buffer[start:position])
+            start = None
+            expecting = ','
+            yield document
+
+        if eof:
+            raise ValueError('Unterminated JSON array')
@@ -0,0 +1,90 @@
+"""
+Authentication tokens creation and verification
+"""
+
+import time
+
+from flask import current_app, has_app_context
+from itsdangerous import (TimedJSONWebSignatureSerializer as Serializer, BadSignature, SignatureExpired)
+from sqlalchemy import event
+
+from . import models
+from .caches import TTLCache
+
+
+class TokenStore(object):
+    """
+    Creates and verifies the users tokens, with one serializer per application and a cache of the
+    verified tokens so the signature check and the user lookup are done once per token (or per
+    TOKEN_CACHE_TTL seconds). A cached token never outlives its own expiration, and the tokens of
+    a deleted user are dropped from the cache of the process deleting it.
+    """
+    EXTENSION_KEY = 'pamose_tokens'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions[self.EXTENSION_KEY] = _Tokens(app)
+
+    @property
+    def _tokens(self):
+        return current_app.extensions[self.EXTENSION_KEY]
+
+    def new_token(self, user_id):
+        """
+        :param user_id: int. The id stored in the token
+        :return: bytes. A new serialized token, expiring after TOKEN_EXPIRATION_TIME seconds
+        """
+        return self._tokens.serializer.dumps({'id': user_id})
+
+    def verify(self, token):
+        """
+        :param token: bytes. The token to verify
+        :return: int. The token's user id, or None if the token is invalid/expired or the user doesn't exist
+        """
+        return self._tokens.verify(token)
+
+    def invalidate_user(self, user_id):
+        """
+        Forget the verified tokens of an user
+        :param user_id: int
+        """
+        if has_app_context() and self.EXTENSION_KEY in current_app.extensions:
+            self._tokens.cache.discard_where(lambda token, cached_user_id: cached_user_id == user_id)
+
+
+class _Tokens(object):
+    """
+    The per application serializer and verified tokens cache
+    """
+
+    def __init__(self, app):
+        self.serializer = Serializer(app.config['SECRET_KEY'], expires_in=app.config['TOKEN_EXPIRATION_TIME'])
+        self.cache = TTLCache(maxsize=app.config.get('TOKEN_CACHE_SIZE', 10000),
+                              ttl=app.config.get('TOKEN_CACHE_TTL', 300))
+
+    def verify(self, token):
+        user_id = self.cache.get(token)
+        if user_id is not None:
+            return user_id
+
+        try:
+            data, header = self.serializer.loads(token, return_header=True)
+        except (SignatureExpired, BadSignature):
+            return None
+        user = models.User.query.get(data['id'])
+        if user is None:
+            return None
+
+        self.cache.set(token, user.id, ttl=min(self.cache.ttl, header['exp'] - time.time()))
+        return user.id
+
+
+tokens = TokenStore()
+
+
+@event.listens_for(models.User, 'after_delete')
+def _invalidate_user_tokens(mapper, connection, target):
+    tokens.invalidate_user(target.id)
@@ -0,0 +1,218 @@
+"""
+Write-behind ingestion: PATCH /host payloads are queued in process and committed in batches by a writer thread
+"""
+
+import atexit
+import queue
+import threading
+import time
+
+from flask import current_app
+
+from . import models, exporter
+from .ingest import ingest_host, host_feedback
+from .entityconfig import entity_configs
+
+_STOP = object()  # Queue sentinel asking the writer thread to exit
+
+
+class IngestQueue(object):
+    """
+    Bounded in-process queue of host payloads, drained by a background writer thread which commits them
+    in batches of INGEST_BATCH_SIZE (or whatever arrived within INGEST_BATCH_INTERVAL seconds).
+
+    Only active if INGEST_ASYNC is set. The writer thread is started on the first queued payload, so it
+    lives in the process actually serving requests (after a fork). Pending payloads are flushed at exit.
+    """
+    EXTENSION_KEY = 'pamose_ingest_queue'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('INGEST_ASYNC', False):
+            app.extensions[self.EXTENSION_KEY] = _WriteBehind(app)
+
+    @property
+    def _writer(self):
+        return current_app.extensions.get(self.EXTENSION_KEY)
+
+    @property
+    def enabled(self):
+        return self._writer is not None
+
+    def put(self, json_data):
+        """
+        Queue a validated host payload
+        :param json_data: dict. The host payload
+        :raise queue.Full: if the queue is full (backpressure)
+        """
+        self._writer.put(json_data)
+
+    def feedback(self, json_data):
+        """
+        The feedback for the host of a queued payload, without touching the database
+        :param json_data: dict. The host payload
+        :return: dict
+        """
+        return self._writer.feedback(json_data)
+
+    def stats(self):
+        """
+        :return: dict. Queue depth, counters and enqueue -> commit latencies (seconds), or None if disabled
+        """
+        writer = self._writer
+        return writer.stats() if writer is not None else None
+
+    def flush(self, timeout=None):
+        """
+        Stop the writer thread after it committed all the queued payloads
+        :param timeout: float. Maximum seconds to wait, default to INGEST_SHUTDOWN_TIMEOUT
+        """
+        writer = self._writer
+        if writer is not None:
+            writer.stop(timeout)
+
+
+class _WriteBehind(object):
+    """
+    The per application queue, writer thread and statistics
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config.get('INGEST_QUEUE_SIZE', 10000))
+        self.batch_size = app.config.get('INGEST_BATCH_SIZE', 100)
+        self.batch_interval = app.config.get('INGEST_BATCH_INTERVAL', 1.0)
+        self.shutdown_timeout = app.config.get('INGEST_SHUTDOWN_TIMEOUT', 30)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.feedbacks = {}  # host name -> last committed feedback
+        self.counters = {
+            'enqueued': 0,
+            'rejected': 0,  # Queue full
+            'written': 0,
+            'failed': 0,
+            'batches': 0,
+            'max_depth': 0,
+            'last_latency': 0.0,
+            'max_latency': 0.0,
+            'total_latency': 0.0,
+        }
+
+    def put(self, json_data):
+        self._start()
+        try:
+            self.queue.put_nowait((time.monotonic(), json_data))
+        except queue.Full:
+            with self.lock:
+                self.counters['rejected'] += 1
+            raise
+        with self.lock:
+            self.counters['enqueued'] += 1
+            self.counters['max_depth'] = max(self.counters['max_depth'], self.queue.qsize())
+
+    def feedback(self, json_data):
+        host_name = json_data.get('name')
+        config = entity_configs.get(host_name)  # Up to date with the entities changes
+        feedback = host_feedback(config) if config is not None else self.feedbacks.get(host_name)
+        if feedback is None:  # Not yet written, the host defaults
+            feedback = {
+                'check_interval': models.Entity.checkall_interval.default.arg,
+                'freshness_threshold': models.Entity.heartbeat_interval.default.arg,
+                'passive_check_enabled': json_data.get('passive_checks_enabled', False),
+                'active_check_enabled': False
+            }
+        return feedback
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['depth'] = self.queue.qsize()
+        stats['capacity'] = self.queue.maxsize
+        total_latency = stats.pop('total_latency')
+        stats['avg_latency'] = total_latency / stats['written'] if stats['written'] else 0.0
+        return stats
+
+    def _start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name='pamose-writebehind', daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=None):
+        if self.thread is None or not self.thread.is_alive():
+            return
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        self.queue.put(_STOP, timeout=timeout)  # Blocks while the queue is full
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            self.app.logger.warning("Write-behind writer still running after %ss, %s payloads pending",
+                                    timeout, self.queue.qsize())
+
+    def _run(self):
+        with self.app.app_context():
+            running = True
+            while running:
+                batch = [self.queue.get()]
+                deadline = time.monotonic() + self.batch_interval
+                while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                    try:
+                        batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                    except queue.Empty:
+                        break
+                if batch[-1] is _STOP:
+                    running = False
+                    batch.pop()
+                if batch:
+                    self._write(batch)
+
+    def _write(self, batch):
+        """
+        Commit a batch of payloads in one transaction. If it fails, retry them one by one so a single
+        bad payload only loses itself.
+        """
+        try:
+            feedbacks = self._ingest(batch)
+        except Exception:
+            models.db.session.rollback()
+            self.app.logger.exception("Write-behind batch of %s payloads failed, retrying one by one", len(batch))
+            feedbacks = {}
+            for item in batch:
+                try:
+                    feedbacks.update(self._ingest([item]))
+                except Exception:
+                    models.db.session.rollback()
+                    self.app.logger.exception("Write-behind payload for host %s dropped", item[1].get('name'))
+                    with self.lock:
+                        self.counters['failed'] += 1
+        finally:
+            models.db.session.remove()
+
+        self.feedbacks.update(feedbacks)
+        now = time.monotonic()
+        with self.lock:
+            self.counters['batches'] += 1
+            for enqueued_at, json_data in batch:
+                if json_data.get('name') in feedbacks:
+                    latency = now - enqueued_at
+                    self.counters['written'] += 1
+                    self.counters['last_latency'] = latency
+                    self.counters['max_latency'] = max(self.counters['max_latency'], latency)
+                    self.counters['total_latency'] += latency
+                    exporter.registry.observe(exporter.INGEST_QUEUE_LATENCY, latency)
+
+    def _ingest(self, batch):
+        rec_hosts = [ingest_host(json_data) for _, json_data in batch]
+        models.db.session.flush()
+        feedbacks = {rec_host.name: host_feedback(rec_host) for rec_host in rec_hosts}  # Before commit expires them
+        models.db.session.commit()
+        return feedbacks
+
+
+ingest_queue = IngestQueue()
@@ -22,6 +22,11 @@ setup(
         'flask_marshmallow',
         'flask_httpauth'
     ],
+    extras_require={
+        'fast': ['orjson'],  # Faster JSON responses (see pamose.serializers)
+        'formats': ['msgpack', 'zstandard'],  # MessagePack and zstd request bodies (see pamose.formats)
+        'redis': ['redis'],  # Entity configurations shared between processes (see pamose.entityconfig)
+    },
     entry_points='''
         [console_scripts]
         pamose=pamose.launcher:cli
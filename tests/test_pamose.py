@@ -1,7 +1,17 @@
 # from http://alexmic.net/flask-sqlalchemy-pytest/
 
+import io
+import gzip
+import zlib
 import os
+import json
+import base64
+import gc
+import datetime as dt
+import threading
+import queue
 import pytest
+import sqlalchemy
 
 import requests
 from requests.auth import HTTPBasicAuth
@@ -9,6 +19,15 @@ from requests.auth import HTTPBasicAuth
 from pamose.app import create_app
 from pamose.models import db as _db
 from pamose import models
+from pamose.caches import references, TTLCache
+from pamose.tokens import tokens
+from pamose import rollups, streams, exporter, writebehind
+from pamose.expiry import ExpiryScheduler
+from pamose.pool import TimedQueuePool, engine_options
+from pamose.events import events, EventBus
+from pamose.entityconfig import entity_configs, HostConfig
+from pamose.passwords import passwords, RateLimiter
+from pamose.writebehind import ingest_queue, _WriteBehind
 
 
 TESTDB = 'test_project.db'
@@ -23,7 +42,8 @@ def app(request):
     """Session-wide test `Flask` application."""
     config_override = {
         'TESTING': True,
-        'SQLALCHEMY_DATABASE_URI': TEST_DATABASE_URI
+        'SQLALCHEMY_DATABASE_URI': TEST_DATABASE_URI,
+        'SQLALCHEMY_ENGINE_OPTIONS': {'connect_args': {'check_same_thread': False}}  # Write-behind writer thread
     }
     app = create_app(config=config_override)
 
@@ -85,11 +105,56 @@ def session(db, request):
         transaction.rollback()
         connection.close()
         session.remove()
+        entity_configs.clear()  # Built from the rolled back entities
 
     request.addfinalizer(teardown)
     return session
 
 
+@pytest.fixture(scope='function')
+def client(app, session):
+    """A test client with a valid token in its Authorization header"""
+    client = app.test_client()
+    token = models.User.query.get(0).new_token().decode('UTF-8')
+    credentials = base64.b64encode('{0}:'.format(token).encode('UTF-8')).decode('UTF-8')
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Basic {0}'.format(credentials)
+    return client
+
+
+@pytest.fixture(scope='function', params=['orm', 'bulk'])
+def ingest_mode(client, monkeypatch, request):
+    """Runs the test in each INGEST_MODE"""
+    monkeypatch.setitem(client.application.config, 'INGEST_MODE', request.param)
+    return request.param
+
+
+@pytest.fixture(scope='function')
+def write_behind(client, monkeypatch, request):
+    """The write-behind ingest queue enabled for the test, its writer thread stopped after it"""
+    monkeypatch.setitem(client.application.config, 'INGEST_BATCH_INTERVAL', 0.05)
+    writer = _WriteBehind(client.application)
+    monkeypatch.setitem(client.application.extensions, ingest_queue.EXTENSION_KEY, writer)
+    request.addfinalizer(lambda: writer.stop(5))
+    return writer
+
+
+def host_payload(host_name, services=3, timestamp=1500000000):
+    return {
+        'name': host_name,
+        'passive_checks_enabled': True,
+        'template': {'_realm': 'simulation'},
+        'livestate': [{'timestamp': timestamp, 'state': 'UP', 'output': 'Host output'}],
+        'services': [
+            {
+                'name': 'service{0}'.format(i),
+                'passive_checks_enabled': True,
+                'livestate': [{'timestamp': timestamp, 'state': 'OK', 'output': 'Service output',
+                               'perf_data': 'metric1=1 metric2=2c'}]
+            } for i in range(services)
+        ]
+    }
+
+
 def test_post_new_entity_type(session):
     realm = models.EntityType(name='Realm')
     host = models.EntityType(name='Host')
@@ -103,6 +168,675 @@ def test_post_new_entity_type(session):
     assert realm.id > 0
 
 
+def test_reference_cache(session):
+    ok = session.query(models.State).filter_by(name='OK').first()
+    assert references.get(models.State, 'OK') == ok.id
+    assert references.get(models.EntityType, 'realm') == 0
+
+    # Changing a reference table invalidates its mapping
+    state = models.State(name='PENDING', severity_id=1)
+    session.add(state)
+    session.commit()
+    assert references.get(models.State, 'PENDING') == state.id
+    assert references.get(models.State, 'UNKNOWN_STATE') is None
+
+
+def test_patch_host(client, session, ingest_mode):
+    response = client.patch('/host', json=host_payload('host1'))
+    assert response.status_code == 200
+    assert response.get_json()['_feedback']['check_interval'] == 60
+
+    # Existing entities are reused, only the new service is created
+    payload = host_payload('host1', services=4, timestamp=1500000060)
+    response = client.patch('/host', json=payload)
+    assert response.status_code == 200
+    names = [name for name, in session.query(models.Entity.name).filter(models.Entity.name.like('host1%'))]
+    assert sorted(names) == ['host1'] + ['host1||service{0}'.format(i) for i in range(4)]
+    assert session.query(models.Livestate).count() == 2 + 3 + 4
+    assert session.query(models.Metric).count() == 2 * (3 + 4)
+    assert session.query(models.Metric).filter(models.Metric.livestate_id.is_(None)).count() == 0
+
+
+def test_current_states(client, session, ingest_mode):
+    client.patch('/host', json=host_payload('host2', services=2, timestamp=1500000060))
+    payload = host_payload('host2', services=2, timestamp=1500000000)  # Older, must not replace the current one
+    payload['services'][0]['livestate'][0]['state'] = 'CRITICAL'
+    client.patch('/host', json=payload)
+    payload = host_payload('host2', services=2, timestamp=1500000120)
+    payload['services'][1]['livestate'][0]['state'] = 'WARNING'
+    client.patch('/host', json=payload)
+
+    response = client.get('/current/simulation')
+    assert response.status_code == 200
+    states = {result['name']: result for result in response.get_json()['_result']}
+    assert sorted(states) == ['host2', 'host2||service0', 'host2||service1']
+    assert states['host2||service0']['state'] == 'OK'
+    assert states['host2||service1']['state'] == 'WARNING'
+    assert states['host2||service1']['timestamp'] == 1500000120
+    assert states['host2']['entity_type'] == 'host'
+
+    assert client.get('/current/unknown').status_code == 404
+
+
+def test_tree(client, session):
+    payload = host_payload('host5', services=2, timestamp=1500000000)
+    payload['services'][1]['livestate'][0]['state'] = 'CRITICAL'
+    client.patch('/host', json=payload)
+    rec_host = models.Entity.query.filter_by(name='host5').first()
+    rec_host.tags.append(models.Tag(name='linux'))
+    session.commit()
+
+    response = client.get('/tree/host5')
+    assert response.status_code == 200
+    root = response.get_json()['_result']
+    assert root['name'] == 'host5' and root['tags'] == ['linux'] and root['entity_type'] == 'host'
+    assert root['state'] == 'UP' and root['severity'] == 0
+    assert root['worst_severity'] == 3
+    children = dict((child['name'], child) for child in root['children'])
+    assert sorted(children) == ['host5||service0', 'host5||service1']
+    assert children['host5||service1']['state'] == 'CRITICAL'
+    assert children['host5||service0']['worst_severity'] == 0
+
+    root = client.get('/tree/simulation').get_json()['_result']
+    assert root['entity_type'] == 'realm' and root['state'] is None and root['worst_severity'] == 3
+    assert client.get('/tree/unknown').status_code == 404
+
+
+def test_rollups(client, session):
+    for i, (value, counter) in enumerate([(1, 100), (3, 160), (5, 280)]):
+        payload = host_payload('host3', services=1, timestamp=1500000000 + 30 * i)
+        payload['services'][0]['livestate'][0]['perf_data'] = 'metric1={0} metric2={1}c'.format(value, counter)
+        client.patch('/host', json=payload)
+    service = models.Entity.query.filter_by(name='host3||service0').first()
+    start = rollups.bucket_start(dt.datetime.fromtimestamp(1500000000), 3600)
+
+    def hourly():
+        resolution, series = rollups.query_series(service.id, ['metric1', 'metric2'], start,
+                                                  start + dt.timedelta(days=1), 20)
+        assert resolution == 3600
+        return series['metric1'][0][1:], series['metric2'][0][2:]
+
+    assert hourly() == ((3, 1, 5, 3), (2, 4, 2))  # Not rolled up yet: aggregated from the raw metrics
+    assert rollups.rollup(grace=60) == 0  # Maybe not all committed yet: only seen
+    assert rollups.rollup(batch_size=3, grace=0) == 3
+    assert hourly() == ((3, 1, 5, 3), (2, 4, 2))  # Partly rolled up
+    assert rollups.rollup(grace=0) == 3
+    assert rollups.rollup(grace=0) == 0  # Nothing new
+    assert hourly() == ((3, 1, 5, 3), (2, 4, 2))
+
+    rows = models.MetricRollupHour.query.filter_by(entity_id=service.id).all()
+    rows = {row.name: row for row in rows}
+    assert (rows['metric1'].count, rows['metric1'].sum, rows['metric1'].min, rows['metric1'].max) == (3, 9, 1, 5)
+    assert (rows['metric2'].count, rows['metric2'].min, rows['metric2'].max) == (2, 2, 4)  # Rates per second
+    assert rows['metric2'].last == 280
+
+    start = rows['metric1'].bucket
+    resolution, series = rollups.query_series(service.id, ['metric1'], start, start + dt.timedelta(days=1), 20)
+    assert resolution == 3600
+    assert series['metric1'][0][1:] == (3, 1, 5, 3)
+    resolution, series = rollups.query_series(service.id, ['metric2'], start, start + dt.timedelta(hours=1), 200)
+    assert resolution is None
+    assert [point[1] for point in series['metric2']] == [2, 4]
+
+
+def test_expiry(client, session):
+    client.patch('/host', json=host_payload('host4', services=2, timestamp=1500000000))
+    client.patch('/host', json=host_payload('host4', services=0, timestamp=1500001000))  # Host only
+    scheduler = ExpiryScheduler()
+    scheduler.load()
+    host = models.Entity.query.filter_by(name='host4').first()
+    assert scheduler.deadlines[host.id] == 1500001000 + host.heartbeat_interval
+
+    assert scheduler.tick(now=1500001100) == 0
+    assert scheduler.tick(now=1500001300) == 2  # The services
+    assert scheduler.tick(now=1500001300) == 0
+    assert scheduler.tick(now=1500002300) == 1  # The host, services already expired
+    expired = references.get(models.State, 'EXPIRED')
+    assert session.query(models.CurrentLivestate).filter_by(state_id=expired).count() == 3
+    assert scheduler.stats()['lag'] == 0
+
+
+def test_patch_hosts(client, session, monkeypatch, ingest_mode):
+    monkeypatch.setitem(client.application.config, 'BULK_CHUNK_SIZE', 2)
+    payloads = [host_payload('bulk{0}'.format(i)) for i in range(5)] + [{'services': []}]
+    response = client.patch('/hosts', json=payloads)
+    assert response.status_code == 200
+    results = response.get_json()['_result']
+    assert [result['_status'] for result in results] == ['OK'] * 5 + ['ERR']
+    assert results[0]['name'] == 'bulk0'
+    assert results[0]['_feedback']['check_interval'] == 60
+    assert session.query(models.Entity).filter(models.Entity.name.like('bulk%')).count() == 5 * 4
+    assert session.query(models.Entity).filter_by(name='simulation').count() == 1
+
+    ndjson = '\n'.join(json.dumps(host_payload('bulk{0}'.format(i), timestamp=1500000060)) for i in range(5))
+    response = client.patch('/hosts', data=ndjson, content_type='application/x-ndjson')
+    assert [result['_status'] for result in response.get_json()['_result']] == ['OK'] * 5
+    assert session.query(models.Livestate).count() == 2 * 5 * 4
+
+    assert client.patch('/hosts', data='[{"name": "bulk0"}, {', content_type='application/json').status_code == 400
+
+
+def test_patch_host_duplicates(client, session, monkeypatch, ingest_mode):
+    payload = host_payload('host10', services=2)
+    payload['services'][0]['livestate'][0]['perf_data'] = 'metric1=1 metric1=3 metric2=2c'
+    assert client.patch('/host', json=payload).status_code == 200
+    assert client.patch('/host', json=payload).status_code == 200  # Retried
+    assert client.patch('/hosts', json=[payload, payload]).status_code == 200
+    livestates = session.query(models.Livestate).join(models.Entity).filter(models.Entity.name.like('host10%'))
+    assert livestates.count() == 3
+    assert session.query(models.Metric).filter(models.Metric.livestate_id.in_(
+        [rec.id for rec in livestates])).count() == 2 * 2
+
+    # Answers replayed from the Idempotency-Key cache
+    other = host_payload('host11', services=1)
+    first = client.patch('/host', json=other, headers={'Idempotency-Key': ingest_mode + '-1'})
+    other['services'][0]['livestate'][0]['timestamp'] += 60
+    replayed = client.patch('/host', json=other, headers={'Idempotency-Key': ingest_mode + '-1'})
+    assert replayed.headers['Idempotent-Replayed'] == 'true' and replayed.get_data() == first.get_data()
+    response = client.patch('/host', json=other, headers={'Idempotency-Key': ingest_mode + '-2'})
+    assert 'Idempotent-Replayed' not in response.headers
+    assert session.query(models.Livestate).join(models.Entity).filter(
+        models.Entity.name == 'host11||service0').count() == 2
+
+    # The database ignores the duplicates the ingest path didn't drop (bulk mode), or refuses them (orm mode)
+    monkeypatch.setitem(client.application.config, 'INGEST_DEDUPLICATE', False)
+    if ingest_mode == 'bulk':
+        assert client.patch('/host', json=payload).status_code == 200
+        assert livestates.count() == 3
+    else:
+        assert client.patch('/host', json=payload).status_code == 409
+
+
+def test_idempotency_write_behind(client, session, write_behind):
+    payload = host_payload('host14', services=1)
+    for i in range(2):  # Not committed when answered: not replayed, written again
+        response = client.patch('/host', json=payload, headers={'Idempotency-Key': 'write-behind'})
+        assert response.status_code == 200 and 'Idempotent-Replayed' not in response.headers
+    ingest_queue.flush(5)
+    assert ingest_queue.stats()['written'] == 2
+    assert session.query(models.Livestate).join(models.Entity).filter(
+        models.Entity.name == 'host14||service0').count() == 1
+
+
+def test_write_behind(client, session, monkeypatch, write_behind):
+    assert client.get('/_internal/ingest').status_code == 200
+    payloads = [host_payload('host15', services=2, timestamp=1500000000 + 60 * i) for i in range(3)]
+    responses = [client.patch('/host', json=payload) for payload in payloads]
+    assert [response.status_code for response in responses] == [200] * 3
+    assert responses[0].get_json()['_feedback'] == {  # Not written yet: the defaults
+        'check_interval': 60, 'freshness_threshold': 1200, 'passive_check_enabled': True,
+        'active_check_enabled': False}
+    ingest_queue.flush(5)  # Stops the writer once the queue is committed
+    assert session.query(models.Livestate).join(models.Entity).filter(
+        models.Entity.name.like('host15%')).count() == 3 * 3
+    stats = client.get('/_internal/ingest').get_json()['_result']
+    assert (stats['enqueued'], stats['written'], stats['failed'], stats['rejected']) == (3, 3, 0, 0)
+    assert stats['depth'] == 0
+    assert stats['batches'] >= 1 and stats['max_latency'] >= stats['avg_latency'] > 0
+    assert exporter.registry.collect()[(exporter.INGEST_QUEUE_LATENCY, ())][-1] >= 3  # Count
+
+    # Written: the feedback of the cached host configuration, else of the last commit of the host
+    assert entity_configs.get('host15') is not None
+    rec_host = models.Entity.query.filter_by(name='host15').first()
+    rec_host.heartbeat_interval = 300
+    session.commit()  # Invalidates the cached configuration
+    assert entity_configs.get('host15') is None
+    assert ingest_queue.feedback({'name': 'host15'}) == write_behind.feedbacks['host15']
+
+    # A failing payload only loses itself, the others of its batch are retried one by one
+    ingest_host = writebehind.ingest_host
+
+    def failing(json_data):
+        if json_data['name'] == 'host16':
+            raise ValueError('Unwritable')
+        return ingest_host(json_data)
+
+    monkeypatch.setattr(writebehind, 'ingest_host', failing)
+    monkeypatch.setattr(write_behind, 'batch_interval', 5)  # A single batch, the writer not started yet
+    for name in ('host16', 'host17', 'host18'):
+        client.patch('/host', json=host_payload(name, services=1))
+    ingest_queue.flush(5)
+    stats = ingest_queue.stats()
+    assert (stats['written'], stats['failed']) == (3 + 2, 1)
+    assert session.query(models.Entity).filter(models.Entity.name.in_(['host16', 'host17', 'host18'])).count() == 2
+
+
+def test_write_behind_full(client, write_behind, monkeypatch):
+    def full(item):
+        raise queue.Full
+
+    monkeypatch.setattr(write_behind.queue, 'put_nowait', full)
+    response = client.patch('/host', json=host_payload('host19', services=1))
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert ingest_queue.stats()['rejected'] == 1
+
+    monkeypatch.setitem(client.application.extensions, ingest_queue.EXTENSION_KEY, None)
+    assert client.get('/_internal/ingest').status_code == 404
+
+
+def test_entity_configs(client, session, ingest_mode):
+    loaded = []
+    listener = lambda target, context: loaded.append(target.name)
+    sqlalchemy.event.listen(models.Entity, 'load', listener)
+    try:
+        client.patch('/host', json=host_payload('host12', services=2))
+        del loaded[:]
+        # Known host and services: answered from the cached configuration
+        response = client.patch('/hosts', json=[host_payload('host12', services=2, timestamp=1500000060)])
+        assert response.get_json()['_result'][0]['_feedback']['check_interval'] == 60
+        response = client.patch('/host', json=host_payload('host12', services=1, timestamp=1500000120))
+        assert response.get_json()['_feedback']['freshness_threshold'] == 1200
+        assert loaded == []
+        assert session.query(models.Livestate).join(models.Entity).filter(
+            models.Entity.name == 'host12||service0').count() == 3
+
+        # Updated entities are invalidated, new services take the slow path
+        rec_host = models.Entity.query.filter_by(name='host12').first()
+        rec_host.heartbeat_interval = 300
+        session.commit()
+        assert entity_configs.get('host12') is None
+        response = client.patch('/host', json=host_payload('host12', services=3, timestamp=1500000180))
+        assert response.get_json()['_feedback']['freshness_threshold'] == 300
+        config = entity_configs.get('host12')
+        assert sorted(config.services) == ['host12||service{0}'.format(i) for i in range(3)]
+        assert HostConfig.loads(config.dumps()) == config
+    finally:
+        sqlalchemy.event.remove(models.Entity, 'load', listener)
+
+
+def test_iter_documents():
+    documents = [{'name': 'a', 'services': [{'name': 'x]'}]}, {'name': 'b'}, {'name': 'c'}]
+    body = json.dumps(documents).encode('UTF-8')
+    assert list(streams.iter_documents(io.BytesIO(body), chunk_size=3)) == documents
+    body = '\n'.join(json.dumps(document) for document in documents).encode('UTF-8')
+    assert list(streams.iter_documents(io.BytesIO(body), chunk_size=3)) == documents
+    assert list(streams.iter_documents(io.BytesIO(b' [ ] '))) == []
+    body = b'[1, "a\\"]\\u00e9", [true, {"b": null}], -2.5e3 ,"c"]'
+    assert list(streams.iter_documents(io.BytesIO(body), chunk_size=1)) == [1, 'a"]\u00e9', [True, {'b': None}],
+                                                                          -2500.0, 'c']
+    body = json.dumps([{'name': 'x' * 100}, {'name': 'y'}]).encode('UTF-8')
+    with pytest.raises(streams.BodyTooLarge):
+        list(streams.iter_documents(io.BytesIO(body), chunk_size=7, max_size=50))
+    with pytest.raises(ValueError):
+        list(streams.iter_documents(io.BytesIO(b'[{"a": 1}, {"b": '), chunk_size=4))
+    with pytest.raises(ValueError):
+        list(streams.iter_documents(io.BytesIO(b'[{"a": 1}}]')))
+
+
+def test_patch_host_unknown_state(client, session, ingest_mode):
+    payload = host_payload('host12', services=2)
+    payload['services'][1]['livestate'][0]['state'] = 'WEIRD'
+    response = client.patch('/host', json=payload)
+    assert response.status_code == 400
+    assert response.get_json()['_issues'] == "Unknown state 'WEIRD'"
+    assert session.query(models.Livestate).join(models.Entity).filter(
+        models.Entity.name.like('host12%')).count() == 0
+
+    response = client.patch('/hosts', json=[payload, host_payload('host13', services=1)])
+    assert [(result['_status'], result.get('_issues')) for result in response.get_json()['_result']] == [
+        ('ERR', "Unknown state 'WEIRD'"), ('OK', None)]
+
+
+def test_patch_host_invalid(client, monkeypatch):
+    response = client.patch('/host', json={'services': []})
+    assert response.status_code == 400
+    assert response.get_json()['_issues'] == 'Missing host name'
+    response = client.patch('/host', data=b'', content_type='application/json')
+    assert response.status_code == 400
+    assert response.get_json()['_issues'] == 'No input data provided'
+
+    monkeypatch.setitem(client.application.config, 'INGEST_MAX_BODY_SIZE', 100)
+    body = json.dumps(host_payload('host1')).encode('UTF-8')
+    assert client.patch('/host', data=body, content_type='application/json').status_code == 413
+    assert client.patch('/host', data=gzip.compress(body), content_type='application/json',
+                        headers={'Content-Encoding': 'gzip'}).status_code == 413
+    response = client.patch('/hosts', json=[host_payload('host1', services=0), host_payload('host2')])
+    assert response.status_code == 413
+
+    # The bulk bodies are bounded once decompressed, whatever their encoding
+    monkeypatch.setitem(client.application.config, 'INGEST_MAX_BODY_SIZE', 1000)
+    monkeypatch.setitem(client.application.config, 'INGEST_MAX_BULK_SIZE', 100000)
+    body = b'[' + b' ' * 1000000 + b']'
+    for encoding, data in (('gzip', gzip.compress(body)), ('deflate', zlib.compress(body))):
+        response = client.patch('/hosts', data=data, content_type='application/json',
+                                headers={'Content-Encoding': encoding})
+        assert response.status_code == 413
+    msgpack = pytest.importorskip('msgpack')
+    response = client.patch('/hosts', data=msgpack.packb([{'name': 'x' * 70000}]), content_type='application/msgpack')
+    assert response.status_code == 413
+
+
+def test_ttl_cache():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)  # Evicts 'b', the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    cache.set('d', 4, ttl=-1)  # Already expired
+    assert cache.get('d') is None
+    cache.discard_where(lambda key, value: value == 3)
+    assert cache.get('c') is None
+
+
+def test_login_passwords(client, session, monkeypatch):
+    state = client.application.extensions[passwords.EXTENSION_KEY]
+    monkeypatch.setattr(state, 'cache', TTLCache(ttl=60))
+    monkeypatch.setattr(state, 'addresses', RateLimiter(5, 60))
+    monkeypatch.setattr(state, 'failures', RateLimiter(2, 60))
+    user = models.User.query.get(0)
+    user.password_hash = state.context.handler('sha256_crypt').hash('admin')  # Deprecated scheme
+    session.commit()
+
+    def login(password):
+        return client.post('/login', json={'username': 'admin', 'password': password})
+
+    assert login('admin').status_code == 200
+    session.expire_all()
+    assert models.User.query.get(0).password_hash.startswith('$6$')  # Rehashed with sha512_crypt
+    assert len(state.cache) == 1
+    assert login('admin').status_code == 200  # Cached verification
+    assert [login('bad').status_code for _ in range(3)] == [400, 400, 429]
+    response = login('admin')  # Over the failures limit of the user name
+    assert response.status_code == 429 and int(response.headers['Retry-After']) > 0
+    monkeypatch.setattr(state, 'failures', None)
+    assert [login('admin').status_code for _ in range(2)] == [200, 429]  # 5 attempts allowed from this address
+
+
+def test_token_cache(app, session):
+    user = models.User(name='agent', role_id=0)
+    session.add(user)
+    session.commit()
+    token = tokens.new_token(user.id)
+    assert tokens.verify(token) == user.id
+    assert models.User.verify_token(token)
+    assert not models.User.verify_token(b'not a token')
+
+    # Deleting the user drops its tokens from the cache
+    session.delete(user)
+    session.commit()
+    assert tokens.verify(token) is None
+
+
+def test_pool(client):
+    assert engine_options({'SQLALCHEMY_DATABASE_URI': 'sqlite://'}) == {}
+    options = engine_options({'SQLALCHEMY_DATABASE_URI': 'postgresql://pamose@localhost/pamose',
+                              'DB_POOL_SIZE': 5, 'DB_STATEMENT_TIMEOUT': 1000})
+    assert options['poolclass'] is TimedQueuePool and options['pool_size'] == 5
+    assert options['connect_args'] == {'options': '-c statement_timeout=1000'}
+    options = engine_options({'SQLALCHEMY_DATABASE_URI': 'postgresql://pamose@localhost/pamose',
+                              'DB_PGBOUNCER': True})
+    assert 'pool_size' not in options
+
+    import sqlite3
+    pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0, timeout=0.01)
+    connection = pool.connect()
+    with pytest.raises(Exception):
+        pool.connect()  # Exhausted
+    stats = pool.stats()
+    assert stats['checked_out'] == 1 and stats['timeouts'] == 1 and stats['waits'] == 1
+    connection.close()
+
+    # A connection inherited from another process is replaced, not reused
+    record = pool._pool.queue[0]
+    record.info['pid'] = -1
+    pool.connect().close()
+    assert pool.stats()['forked'] == 1
+
+    response = client.get('/_internal/pool')
+    assert response.status_code == 200 and response.get_json()['_result']['pgbouncer'] is False
+
+
+def test_instrumentation(client, monkeypatch, caplog):
+    monkeypatch.setitem(client.application.config, 'SERVER_TIMING', True)
+    monkeypatch.setitem(client.application.config, 'SLOW_REQUEST_THRESHOLD', 0)
+    response = client.patch('/host', json=host_payload('host6'))
+    assert response.status_code == 200
+    timings = dict(metric.split(';')[0:2] for metric in response.headers['Server-Timing'].split(', '))
+    assert set(timings) >= {'sql', 'parse', 'lookup', 'livestates', 'perfdata', 'commit', 'total'}
+    assert 'Slow request PATCH /host' in caplog.text
+
+    histograms = client.get('/_internal/timings').get_json()['_result']['host']
+    assert histograms['total']['count'] >= 1 and histograms['queries']['sum'] > 0
+    assert histograms['total']['buckets']['+Inf'] == histograms['total']['count']
+
+
+def test_metrics(client, tmpdir, monkeypatch):
+    def samples():
+        response = client.get('/metrics')
+        assert response.status_code == 200 and response.mimetype == 'text/plain'
+        return dict(line.rsplit(' ', 1) for line in response.get_data(as_text=True).splitlines()
+                    if not line.startswith('#'))
+
+    before = samples()
+    client.patch('/host', json=host_payload('host7', services=2))
+    after = samples()
+    key = 'pamose_ingest_livestates_total'
+    assert float(after[key]) - float(before.get(key, 0)) == 3
+    key = 'pamose_ingest_metrics_total'
+    assert float(after[key]) - float(before.get(key, 0)) == 4
+    assert 'pamose_ingest_entities_total{type="service"}' in after
+    assert 'pamose_http_request_duration_seconds_count{route="/host",method="PATCH"}' in after
+
+    # Multiprocess mode: the files of all the processes are aggregated
+    monkeypatch.setitem(client.application.config, 'METRICS_MULTIPROC_DIR', str(tmpdir))
+    tmpdir.join('pamose_1.json').write(json.dumps({
+        'values': [['pamose_ingest_livestates_total', [], 10]], 'gauges': [['pamose_db_pool_size', [], 5]]}))
+    multi = samples()
+    assert float(multi['pamose_ingest_livestates_total']) == float(after['pamose_ingest_livestates_total']) + 10
+    assert multi['pamose_db_pool_size{pid="1"}'] == '5'
+    assert '# TYPE pamose_db_pool_checkouts_total counter' in exporter.render(
+        {}, {('pamose_db_pool_checkouts_total', ()): 1})
+
+    # The file of an exited process is removed: its counters retired, its gauges dropped
+    tmpdir.join('pamose_99999999.json').write(json.dumps({
+        'values': [['pamose_ingest_livestates_total', [], 5]], 'gauges': [['pamose_db_pool_size', [], 5]]}))
+    multi = samples()
+    assert float(multi['pamose_ingest_livestates_total']) == float(after['pamose_ingest_livestates_total']) + 15
+    assert 'pamose_db_pool_size{pid="99999999"}' not in multi
+    assert not tmpdir.join('pamose_99999999.json').exists() and tmpdir.join('pamose_retired.json').exists()
+
+
+def test_registry_threads():
+    registry = exporter.Registry()
+    name = registry.define('test_total', exporter.COUNTER, 'Test')
+    threads = [threading.Thread(target=registry.inc, args=(name,)) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    del threads, thread
+    gc.collect()
+    assert not registry._shards  # Folded into the retired values
+    assert registry.collect() == {(name, ()): 20}
+
+
+def test_series(client):
+    for i in range(20):
+        payload = host_payload('host8', services=1, timestamp=1500000000 + 10 * i)
+        payload['services'][0]['livestate'][0]['perf_data'] = 'load={0} bytes={1}c'.format(i % 5, 100 * i)
+        client.patch('/host', json=payload)
+
+    url = '/metrics/host8||service0?names=load,bytes&start=1499999990&end=1500000200'
+    response = client.get(url + '&points=100')
+    assert response.status_code == 200
+    result = response.get_json()['_result']
+    assert result['resolution'] is None  # Not enough points in the rollups, raw metrics
+    assert result['series']['load']['timestamps'][:2] == [1500000000, 1500000010]
+    assert result['series']['load']['values'][:5] == [0, 1, 2, 3, 4]
+    assert result['series']['bytes']['values'][0] == 10  # As a rate
+    assert len(result['series']['bytes']['timestamps']) == 19
+
+    for method in ('lttb', 'minmax'):
+        series = client.get(url + '&points=6&method=' + method).get_json()['_result']['series']['load']
+        assert len(series['timestamps']) <= 6 and series['timestamps'] == sorted(series['timestamps'])
+    series = client.get(url + '&points=6&method=minmax').get_json()['_result']['series']['load']
+    assert min(series['values']) == 0 and max(series['values']) == 4
+
+    assert client.get('/metrics/host8||service0').status_code == 400
+    assert client.get('/metrics/unknown?names=load').status_code == 404
+
+
+def test_patch_host_formats(client, session):
+    msgpack = pytest.importorskip('msgpack')
+    payload = host_payload('host9', services=2)
+    for service in payload['services']:
+        del service['livestate'][0]['perf_data']
+        service['livestate'][0]['metrics'] = [['load', 1.5], ['bytes', 100, True], ['bad'], [1, 2]]
+    body = gzip.compress(msgpack.packb(payload))
+    response = client.patch('/host', data=body, content_type='application/msgpack',
+                            headers={'Content-Encoding': 'gzip'})
+    assert response.status_code == 200
+    rows = session.query(models.Metric.name, models.Metric.value, models.MetricType.name).join(
+        models.MetricType).join(models.Livestate).join(models.Entity).filter(
+        models.Entity.name == 'host9||service0').order_by(models.Metric.name).all()
+    assert rows == [('bytes', 100, 'cumulative'), ('load', 1.5, 'raw')]
+
+    response = client.patch('/hosts', data=gzip.compress(b'\n'.join(json.dumps(host_payload(name)).encode('UTF-8')
+                                                                     for name in ('host10', 'host11'))),
+                            content_type='application/x-ndjson', headers={'Content-Encoding': 'gzip'})
+    assert [result['_status'] for result in response.get_json()['_result']] == ['OK', 'OK']
+
+    assert client.patch('/host', data=b'x', content_type='text/plain').status_code == 415
+    assert client.patch('/host', data=b'x', content_type='application/json',
+                        headers={'Content-Encoding': 'br'}).status_code == 415
+    assert client.patch('/host', data=b'not gzip', content_type='application/json',
+                        headers={'Content-Encoding': 'gzip'}).status_code == 400
+
+
+def test_events(client, session, monkeypatch, ingest_mode):
+    last_id = client.get('/events?timeout=0').get_json()['_result']['last_id']
+    client.patch('/host', json=host_payload('host8', services=2, timestamp=1500000000))
+    result = client.get('/events?since={0}&timeout=0'.format(last_id)).get_json()['_result']
+    assert sorted(item['entity'] for item in result['events']) == ['host8', 'host8||service0', 'host8||service1']
+    assert all(item['previous_state'] is None for item in result['events'])
+    last_id = result['last_id']
+
+    # Repeated states aren't transitions, and aren't stored without metrics in 'transitions' mode
+    monkeypatch.setitem(client.application.config, 'LIVESTATE_STORE', 'transitions')
+    payload = host_payload('host8', services=2, timestamp=1500000060)
+    payload['services'][1]['livestate'][0]['state'] = 'CRITICAL'
+    client.patch('/host', json=payload)
+    result = client.get('/events?since={0}&timeout=0&entity=host8'.format(last_id)).get_json()['_result']
+    assert [(item['entity'], item['previous_state'], item['state']) for item in result['events']] == [
+        ('host8||service1', 'OK', 'CRITICAL')]
+    rec_host = models.Entity.query.filter_by(name='host8').first()
+    assert session.query(models.Livestate).filter_by(entity_id=rec_host.id).count() == 1
+    assert session.query(models.Livestate).join(models.Entity).filter(
+        models.Entity.name.like('host8||%')).count() == 4  # Carrying metrics
+
+    # Other entities are filtered out, and nothing is published on rollback
+    client.patch('/host', json=host_payload('host9', services=0, timestamp=1500000000))
+    result = client.get('/events?since={0}&timeout=0&entity=host8'.format(result['last_id'])).get_json()['_result']
+    assert result['events'] == [] and not result['missed']
+    events.record(session, [{'entity_id': 0, 'entity': 'All', 'state': 'UP'}])
+    session.rollback()
+    assert events.bus.since(events.bus.last_id)[0] == []
+
+    bus = EventBus(size=2)
+    bus.publish([{'entity': 'a'}, {'entity': 'b'}, {'entity': 'c'}])
+    assert bus.since(0) == ([{'entity': 'b', 'id': 2}, {'entity': 'c', 'id': 3}], True)
+    assert bus.since(2) == ([{'entity': 'c', 'id': 3}], False)
+    assert bus.since(3, timeout=0.01) == ([], False)
+
+
+SERVER_SCRIPT = '''
+import sys
+from pamose.app import create_app
+from pamose import server
+server.Server(lambda: create_app(config={'SQLALCHEMY_DATABASE_URI': 'sqlite://'}), port=int(sys.argv[1]),
+              workers=2, max_requests=2, max_requests_jitter=0, graceful_timeout=5).run()
+'''
+
+
+def test_serve(tmpdir):
+    import socket
+    import signal
+    import subprocess
+    import sys
+    import time
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    script = tmpdir.join('serve.py')
+    script.write(SERVER_SCRIPT)
+    process = subprocess.Popen([sys.executable, str(script), str(port)], stderr=subprocess.DEVNULL,
+                               env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__))))
+    url = 'http://127.0.0.1:{0}/metrics'.format(port)
+    try:
+        for _ in range(100):  # Workers booting
+            try:
+                requests.get(url, timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        # Workers are replaced after 2 requests, and on reload, without refusing connections meanwhile
+        assert [requests.get(url, timeout=5).status_code for _ in range(10)] == [200] * 10
+        process.send_signal(signal.SIGHUP)
+        assert [requests.get(url, timeout=5).status_code for _ in range(4)] == [200] * 4
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=10) == 0
+
+
+ASGI_SCRIPT = '''
+import sys
+import json
+import base64
+import asyncio
+from pamose.asgi import create_asgi_app
+
+app = create_asgi_app(config={'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + sys.argv[1], 'ASGI_MAX_BODY_SIZE': 100000})
+app.app.test_cli_runner().invoke(args=['initdb'])
+
+
+async def call(method, path, body=b'', headers=()):
+    messages = [{'type': 'http.request', 'body': body[:10], 'more_body': True},
+                {'type': 'http.request', 'body': body[10:]}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': [
+        (b'content-type', b'application/json')] + list(headers)}
+    await app(scope, receive, send)
+    return sent[0]['status'], sent[1]['body']
+
+
+async def main():
+    status, login = await call('POST', '/login', json.dumps({'username': 'admin', 'password': 'admin'}).encode())
+    login = json.loads(login)
+    credentials = base64.b64encode('{0}:'.format(login['_result']).encode()).decode()
+    authorization = (b'authorization', 'Basic {0}'.format(credentials).encode())
+    results = [(status, login['_status'])]
+    for body in (sys.argv[2].encode(), b'x' * 200000):
+        status, answer = await call('PATCH', '/host', body, [authorization])
+        results.append((status, json.loads(answer)['_status']))
+    results.append((await call('PATCH', '/host', sys.argv[2].encode()))[0])
+    results.append((await call('GET', '/tree/host1'))[0])
+    print(json.dumps(results))
+
+asyncio.run(main())
+'''
+
+
+def test_asgi(tmpdir):
+    import subprocess
+    import sys
+    script = tmpdir.join('asgi.py')
+    script.write(ASGI_SCRIPT)
+    output = subprocess.check_output(
+        [sys.executable, str(script), str(tmpdir.join('asgi.db')), json.dumps(host_payload('host1'))],
+        env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__))))
+    # Login, PATCH, too large PATCH, unauthorized PATCH, not an ingest endpoint
+    assert json.loads(output.decode().splitlines()[-1]) == [[200, 'OK'], [200, 'OK'], [413, 'ERR'], 401, 404]
+
+
 def test_login(session):
     endpoint = URL + '/login'
     rsession = requests.Session()
@@ -0,0 +1,34 @@
+from pamose import perfdata
+
+
+def test_parse_simple():
+    metrics = perfdata.parse('load1=0.5 load5=0.75')
+    assert [(m.name, m.value) for m in metrics] == [('load1', 0.5), ('load5', 0.75)]
+    assert metrics[0].unit is None
+    assert not metrics[0].cumulative
+
+
+def test_parse_full_grammar():
+    raw = "'used space'=1.5KB;80:;90;0;100.5  'it''s'=12ms time=U rta=0.1ms;;;0 packets=1234c"
+    metrics = perfdata.parse(raw)
+    assert metrics[0] == perfdata.PerfData('used space', 1.5, 'KB', '80:', '90', 0.0, 100.5, False)
+    assert metrics[1].name == "it's"
+    assert metrics[1].unit == 'ms'
+    assert metrics[2].name == 'time'
+    assert metrics[2].value is None
+    assert metrics[3] == perfdata.PerfData('rta', 0.1, 'ms', None, None, 0.0, None, False)
+    assert metrics[4].cumulative
+    assert metrics[4].value == 1234
+
+
+def test_parse_thresholds_ranges():
+    metrics = perfdata.parse('pl=5%;@10:20;~:50 e=-1.5e2')
+    assert metrics[0].unit == '%'
+    assert metrics[0].warn == '@10:20'
+    assert metrics[0].crit == '~:50'
+    assert metrics[1].value == -150.0
+
+
+def test_parse_skips_malformed():
+    metrics = perfdata.parse('garbage ok=1 =2 bad=abc other=2')
+    assert [m.name for m in metrics] == ['ok', 'other']